@@ -1,2 +1,5 @@
-from .agent import A3CAgent # noqa
-from .config import AgentConfig # noqa
+from ..util import install_lazy_attributes
+from .config import AgentConfig  # noqa
+
+# The agent imports TensorFlow, so only load it when it's used
+install_lazy_attributes(globals(), {"A3CAgent": ".agent"})
@@ -1,10 +1,13 @@
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numpy as np
 import tensorflow as tf
 
 from ..state import MathyEnvState, MathyInputsType, MathyWindowObservation
-from .model import AgentModel
+from .model import AgentModel, call_agent_model
+
+if TYPE_CHECKING:
+    from .inference import InferenceBatcher
 
 
 def apply_pi_mask(logits: tf.Tensor, mask: tf.Tensor, predictions: int) -> tf.Tensor:
@@ -25,18 +28,53 @@ def apply_pi_mask(logits: tf.Tensor, mask: tf.Tensor, predictions: int) -> tf.Te
     return negative_mask_logits
 
 
+def get_valid_action_pairs(masks: List[np.ndarray]) -> np.ndarray:
+    """Return the (row, action) index pairs of the valid actions in a list of
+    0/1 action masks, as an int32 array with shape [n, 2]"""
+    rows = [np.flatnonzero(mask) for mask in masks]
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    row_ids = np.concatenate([np.full(len(r), i) for i, r in enumerate(rows)])
+    return np.stack([row_ids, np.concatenate(rows)], axis=1).astype(np.int32)
+
+
+def masked_softmax(logits: tf.Tensor, actions: np.ndarray) -> tf.Tensor:
+    """Softmax each row of a batch of policy logits over only its valid actions.
+
+    Only the valid logits are gathered and normalized, so the work depends on
+    the number of valid actions rather than the size of the action space.
+
+    # Arguments
+    logits (tf.Tensor): Policy logits with shape [batch, actions]
+    actions (np.ndarray): The (row, action) index pairs of the valid actions,
+        see `get_valid_action_pairs`
+
+    # Returns
+    (tf.Tensor): Probabilities shaped like `logits`, where invalid actions are
+        0.0. Rows without any valid actions are all 0.0.
+    """
+    logits_shape = tf.shape(logits)
+    actions = tf.convert_to_tensor(actions, dtype=tf.int32)
+    rows = actions[:, 0]
+    valid_logits = tf.gather_nd(logits, actions)
+    row_max = tf.math.unsorted_segment_max(valid_logits, rows, logits_shape[0])
+    exp_logits = tf.exp(valid_logits - tf.gather(row_max, rows))
+    row_sum = tf.math.unsorted_segment_sum(exp_logits, rows, logits_shape[0])
+    probs = exp_logits / tf.gather(row_sum, rows)
+    return tf.scatter_nd(actions, probs, logits_shape)
+
+
 def predict_next(
     model: AgentModel, inputs: MathyInputsType
 ) -> Tuple[tf.Tensor, tf.Tensor]:
     """Predict one probability distribution and value for the
     given sequence of inputs """
     mask = inputs.pop("mask_in")
-    logits, values, rewards = model.call(inputs)
-    masked = apply_pi_mask(logits, mask, model.predictions)
+    logits, values, rewards = call_agent_model(model, inputs)
     # take the last timestep
-    masked = masked[-1][:]
-    flat_logits = tf.reshape(tf.squeeze(masked), [-1])
-    probs = tf.nn.softmax(flat_logits)
+    flat_logits = tf.reshape(logits[-1], [1, -1])
+    actions = get_valid_action_pairs([np.asarray(mask[-1])])
+    probs = tf.reshape(masked_softmax(flat_logits, actions), [-1])
     return probs, tf.squeeze(values[-1])
 
 
@@ -46,11 +84,27 @@ class ActionSelector:
     model: AgentModel
     worker_id: int
     episode: int
+    batcher: Optional["InferenceBatcher"]
 
-    def __init__(self, *, model: AgentModel, episode: int, worker_id: int):
+    def __init__(
+        self,
+        *,
+        model: AgentModel,
+        episode: int,
+        worker_id: int,
+        batcher: Optional["InferenceBatcher"] = None,
+    ):
         self.model = model
         self.worker_id = worker_id
         self.episode = episode
+        self.batcher = batcher
+
+    def predict(self, window: MathyWindowObservation) -> Tuple[tf.Tensor, tf.Tensor]:
+        """Predict the action probabilities and value for the last timestep in
+        the window, through the shared batcher if there is one."""
+        if self.batcher is not None:
+            return self.batcher.predict(window)
+        return predict_next(self.model, window.to_inputs(as_tf_tensor=True))
 
     def select(
         self,
@@ -72,7 +126,7 @@ class GreedyActionSelector(ActionSelector):
         last_action: int,
         last_reward: float,
     ) -> Tuple[int, float]:
-        probs, value = predict_next(self.model, last_window.to_inputs())
+        probs, value = self.predict(last_window)
         action = np.argmax(probs)
         return action, float(value)
 
@@ -91,15 +145,12 @@ class A3CEpsilonGreedyActionSelector(ActionSelector):
         last_reward: float,
     ) -> Tuple[int, float]:
 
-        probs, value = predict_next(self.model, last_window.to_inputs())
-        last_move_mask = last_window.mask[-1]
+        probs, value = self.predict(last_window)
         no_random = bool(self.worker_id == 0)
         if not no_random and np.random.random() < self.epsilon:
-            # Select a random action
-            action_mask = last_move_mask[:]
-            # normalize all valid actions to equal probability
-            actions = action_mask / np.sum(action_mask)
-            action = np.random.choice(len(actions), p=actions)
+            # Select a random valid action
+            valid_actions = np.flatnonzero(last_window.mask[-1])
+            action = np.random.choice(valid_actions)
         else:
             action = np.argmax(probs)
         return action, float(value)
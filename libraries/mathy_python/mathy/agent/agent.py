@@ -4,9 +4,11 @@ import os
 import gym
 import numpy as np
 
+from ..spans import spans
 from ..teacher import Teacher
 from .model import get_or_create_agent_model, AgentModel
 from .config import AgentConfig
+from .inference import InferenceBatcher
 from .worker import A3CWorker
 from ..envs.gym import MathyGymEnv
 
@@ -21,6 +23,7 @@ class A3CAgent:
 
         self.args = args
         self.env_extra = env_extra if env_extra is not None else {}
+        spans.enabled = self.args.profile_spans
         if self.args.verbose:
             print(f"Agent: {os.path.join(args.model_dir, args.model_name)}")
             print(f"Config: {json.dumps(self.args.dict(), indent=2)}")
@@ -43,10 +46,20 @@ class A3CAgent:
             print(self.global_model.summary())
 
     def train(self):
+        if self.args.worker_mode == "process":
+            return self.train_processes()
+        assert self.args.worker_mode == "thread", "worker_mode must be thread/process"
         A3CWorker.global_episode = 0
         worker_exploration_epsilons = np.geomspace(
             self.args.e_greedy_min, self.args.e_greedy_max, self.args.num_workers
         )
+        batcher = None
+        if self.args.inference_batching:
+            batcher = InferenceBatcher(
+                self.global_model,
+                max_batch_size=self.args.num_workers,
+                max_latency=self.args.inference_max_latency_ms / 1000.0,
+            ).start()
         workers = [
             A3CWorker(
                 env_extra=self.env_extra,
@@ -58,6 +71,7 @@ class A3CAgent:
                 worker_idx=i,
                 optimizer=self.global_model.optimizer,
                 writer=self.writer,
+                batcher=batcher,
             )
             for i in range(self.args.num_workers)
         ]
@@ -76,7 +90,51 @@ class A3CAgent:
         model_path = os.path.join(self.args.model_dir, self.args.model_name)
         self.global_model.save(model_path)
         [w.join() for w in workers]
+        self.write_spans()
+        if batcher is not None:
+            batcher.stop()
+            if self.args.verbose:
+                print(f"Inference batching: {json.dumps(batcher.stats())}")
         # Do a final save after joining to get the very latest model
         self.global_model.save(model_path)
         print("Done. Bye!")
 
+    def train_processes(self):
+        """Train with one rollout process per worker, and apply their gradients
+        to the global model in this process."""
+        from .process_worker import run_learner, start_process_workers
+
+        worker_exploration_epsilons = np.geomspace(
+            self.args.e_greedy_min, self.args.e_greedy_max, self.args.num_workers
+        )
+        model_path = os.path.join(self.args.model_dir, self.args.model_name)
+        shared, processes = start_process_workers(
+            args=self.args,
+            env_extra=self.env_extra,
+            action_size=self.action_size,
+            greedy_epsilons=worker_exploration_epsilons,
+            global_model=self.global_model,
+        )
+        try:
+            run_learner(
+                args=self.args,
+                global_model=self.global_model,
+                shared=shared,
+                processes=processes,
+                save_fn=lambda: self.global_model.save(model_path),
+                save_every_n_episodes=A3CWorker.save_every_n_episodes,
+            )
+        except KeyboardInterrupt:  # pragma: no cover
+            print("Received Keyboard Interrupt. Shutting down.")
+        self.write_spans()
+        self.global_model.save(model_path)
+        print("Done. Bye!")
+
+    def write_spans(self):
+        """Write the collected timing spans to the model folder"""
+        if not self.args.profile_spans:
+            return
+        spans_path = os.path.join(self.args.model_dir, "spans.json")
+        spans.write_json(spans_path)
+        if self.args.verbose:
+            print(f"SPANS: saved {spans_path}")
@@ -22,7 +22,16 @@ class AgentConfig(BaseModel):
     # The number of timesteps use when making predictions. This includes the current timestep and
     # (n - 1) previous timesteps
     prediction_window_size: int = 6
+    # When true, action selection only embeds the newest timestep of each
+    # prediction window. The model's outputs for a timestep don't depend on the
+    # others (except for their padded length), so the predictions are the same.
+    predict_newest_only: bool = True
     units: int = 64
+    # When true, the agent calls the model through compiled graphs that pad the
+    # node sequences up to one of the fixed length buckets below. The padding
+    # is masked out, so the model outputs are the same as without buckets.
+    use_length_buckets: bool = False
+    length_buckets: List[int] = [16, 32, 64, 128, 256]
     embedding_units: int = 128
     topics: List[str] = ["poly"]
     difficulty: Optional[str] = None
@@ -67,6 +76,19 @@ class AgentConfig(BaseModel):
 
     # The number of worker agents to create.
     num_workers: int = 3
+    # One of "thread" or "process". Thread workers share the global model in
+    # one Python process. Process workers each run in their own process with a
+    # local model copy, and send gradients to the learner in the main process.
+    worker_mode: str = "thread"
+    # When using process workers, broadcast the global model weights to the
+    # workers after this many gradient updates.
+    weight_broadcast_interval: int = 1
+    # When true, thread workers select actions through a shared batcher that
+    # combines their windows into one model forward pass.
+    inference_batching: bool = False
+    # The longest time (in milliseconds) a worker's window waits for others to
+    # join its inference batch.
+    inference_max_latency_ms: float = 5.0
 
     # NOTE: scaling down h_loss is observed to be important to keep it from
     #       destabilizing the overall loss when it grows very small
@@ -97,6 +119,9 @@ class AgentConfig(BaseModel):
     # When profile is true, each A3C worker thread will output a .profile
     # file in the model save path when it exits.
     profile: bool = False
+    # When true, time the environment and agent hot paths and write the span
+    # percentiles to tensorboard and to "spans.json" in the model save path.
+    profile_spans: bool = False
 
     # Verbose setting to print out worker_0 training steps. Useful for trying
     # to find problems.
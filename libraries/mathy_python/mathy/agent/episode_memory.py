@@ -6,8 +6,10 @@ import numpy as np
 from ..types import Literal
 
 from ..state import (
+    MathyArrayWindowObservation,
     MathyObservation,
     MathyWindowObservation,
+    ObservationWindowBuffer,
     observations_to_window,
 )
 
@@ -28,6 +30,7 @@ class EpisodeMemory(object):
     values: List[float]
 
     def __init__(self):
+        self.window_buffer = ObservationWindowBuffer()
         self.clear()
 
     def clear(self):
@@ -45,11 +48,32 @@ class EpisodeMemory(object):
 
     def to_window_observation(
         self, observation: MathyObservation, window_size: int = 3
-    ) -> MathyWindowObservation:
+    ) -> MathyArrayWindowObservation:
+        """Return a window of the last (n - 1) stored observations and the given
+        observation. The window is written into a reusable buffer, so it's only
+        valid until the next call."""
         previous = -(max(window_size - 1, 1))
         window_observations = self.observations[previous:] + [observation]
         assert len(window_observations) <= window_size
-        return observations_to_window(window_observations)
+        return self.window_buffer.build(window_observations)
+
+    def to_prediction_window(
+        self, observation: MathyObservation, window_size: int = 3
+    ) -> MathyArrayWindowObservation:
+        """Return a window with only the given observation, padded to the length
+        of the window that `to_window_observation` would return.
+
+        The agent model treats each timestep of a window independently, and
+        actions are selected from the last one. The earlier timesteps only
+        change its outputs through the length the window is padded to, so this
+        gives the same last-timestep predictions without embedding them. The
+        window is written into a reusable buffer, so it's only valid until the
+        next call."""
+        previous = -(max(window_size - 1, 1))
+        length = len(observation.nodes)
+        for stored in self.observations[previous:]:
+            length = max(length, len(stored.nodes))
+        return self.window_buffer.build([observation], total_length=length)
 
     def to_window_observations(
         self,
@@ -0,0 +1,212 @@
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+from ..state import MathyArrayWindowObservation, MathyWindowObservation
+from .action_selectors import get_valid_action_pairs, masked_softmax
+from .model import AgentModel, call_agent_model
+
+AnyWindowObservation = Union[MathyWindowObservation, MathyArrayWindowObservation]
+PredictionResult = Tuple[np.ndarray, float]
+
+
+class InferenceRequest:
+    """A pending window that is waiting for its turn in a batch"""
+
+    __slots__ = ("window", "enqueued", "done", "result", "error")
+
+    def __init__(self, window: AnyWindowObservation):
+        self.window = window
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result: Optional[PredictionResult] = None
+        self.error: Optional[BaseException] = None
+
+
+class InferenceBatcher:
+    """Combine action selection requests from many workers (or the episodes
+    of a vector env) into one model forward pass.
+
+    Callers block in `predict` while a background thread collects pending
+    windows. It runs a batch when `max_batch_size` requests are waiting, or
+    when the oldest request has waited `max_latency` seconds. The windows are
+    padded to the longest sequence in the batch, and each caller gets the same
+    `(probs, value)` result that `predict_next` returns for its window.
+
+    !!! note
+
+        The policy is computed per node, so padding doesn't change the action
+        probabilities. The value head averages over the padded sequence, so
+        value estimates can differ slightly from a batch-of-one call.
+
+    # Arguments
+    model (AgentModel): The model to predict with
+    max_batch_size (int): The maximum number of windows in one forward pass
+    max_latency (float): The maximum seconds a request waits for others to
+        arrive before its batch is run
+    """
+
+    model: AgentModel
+    max_batch_size: int
+    max_latency: float
+
+    def __init__(
+        self, model: AgentModel, max_batch_size: int = 8, max_latency: float = 0.005
+    ):
+        assert max_batch_size > 0, "max_batch_size must be a positive integer"
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._requests: "queue.Queue[InferenceRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def start(self) -> "InferenceBatcher":
+        """Start the background thread that runs batches"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the background thread after the pending requests are run"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def predict(self, window: AnyWindowObservation) -> PredictionResult:
+        """Queue a window and block until its batch has been run.
+
+        # Returns
+        (Tuple[np.ndarray, float]): The action probabilities for the last
+            timestep in the window, and its value estimate.
+        """
+        assert self._thread is not None, "call start() before predict()"
+        request = InferenceRequest(window)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        assert request.result is not None
+        return request.result
+
+    def predict_batch(
+        self, windows: List[AnyWindowObservation]
+    ) -> List[PredictionResult]:
+        """Predict for a list of windows in the calling thread. This is useful
+        when one caller steps many episodes at once, e.g. `MathyVectorEnv`."""
+        results: List[PredictionResult] = []
+        for i in range(0, len(windows), self.max_batch_size):
+            chunk = windows[i : i + self.max_batch_size]
+            requests = [InferenceRequest(w) for w in chunk]
+            self._run_batch(requests)
+            results.extend([r.result for r in requests])  # type:ignore
+        return results
+
+    def reset_stats(self) -> None:
+        with self._stats_lock:
+            self._batches = 0
+            self._requests_run = 0
+            self._wait_total = 0.0
+            self._wait_max = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the batch fill ratio and queue wait time metrics.
+
+        - `fill_ratio` is the mean fraction of `max_batch_size` used per batch
+        - `queue_wait_ms` is the mean time requests waited before their batch ran
+        - `queue_wait_max_ms` is the longest time a request waited
+        """
+        with self._stats_lock:
+            batches = max(self._batches, 1)
+            requests = max(self._requests_run, 1)
+            return {
+                "batches": self._batches,
+                "requests": self._requests_run,
+                "mean_batch_size": self._requests_run / batches,
+                "fill_ratio": self._requests_run / (batches * self.max_batch_size),
+                "queue_wait_ms": self._wait_total / requests * 1000.0,
+                "queue_wait_max_ms": self._wait_max * 1000.0,
+            }
+
+    def write_summaries(self, step: Union[int, tf.Variable], prefix="inference"):
+        """Write the batcher metrics to the default tf.summary writer"""
+        for key, value in self.stats().items():
+            tf.summary.scalar(f"{prefix}/{key}", data=value, step=step)
+
+    def _run(self) -> None:
+        while not (self._stop.is_set() and self._requests.empty()):
+            try:
+                first = self._requests.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = first.enqueued + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0.0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(batch)
+            except BaseException as error:
+                for request in batch:
+                    request.error = error
+            for request in batch:
+                request.done.set()
+
+    def _run_batch(self, requests: List[InferenceRequest]) -> None:
+        start = time.perf_counter()
+        windows = [
+            [np.asarray(f) for f in r.window]  # nodes, mask, values, type, time
+            for r in requests
+        ]
+        max_length = max(w[0].shape[1] for w in windows)
+        predictions = self.model.predictions
+        nodes, masks, values, types, times, rows = [], [], [], [], [], []
+        for w_nodes, w_mask, w_values, w_type, w_time in windows:
+            pad = max_length - w_nodes.shape[1]
+            rows.append(w_nodes.shape[0])
+            nodes.append(np.pad(w_nodes, ((0, 0), (0, pad))))
+            # Only the last timestep's mask is used to pick an action
+            masks.append(w_mask[-1])
+            values.append(np.pad(w_values, ((0, 0), (0, pad))))
+            # Type/time are repeated for each node, so repeat them into padding
+            types.append(np.pad(w_type, ((0, 0), (0, pad), (0, 0)), mode="edge"))
+            times.append(np.pad(w_time, ((0, 0), (0, pad), (0, 0)), mode="edge"))
+        inputs = {
+            "nodes_in": tf.convert_to_tensor(np.concatenate(nodes), dtype=tf.int32),
+            "values_in": tf.convert_to_tensor(
+                np.concatenate(values), dtype=tf.float32
+            ),
+            "type_in": tf.convert_to_tensor(np.concatenate(types), dtype=tf.float32),
+            "time_in": tf.convert_to_tensor(np.concatenate(times), dtype=tf.float32),
+        }
+        logits, batch_values, _ = call_agent_model(self.model, inputs)
+        # Select the last timestep of each window
+        last_rows = np.cumsum(rows) - 1
+        last_logits = tf.reshape(tf.gather(logits, last_rows), [len(requests), -1])
+        probs = masked_softmax(last_logits, get_valid_action_pairs(masks)).numpy()
+        last_values = tf.reshape(tf.gather(batch_values, last_rows), [-1]).numpy()
+        for i, (request, window) in enumerate(zip(requests, windows)):
+            # Drop the padding so the distribution matches the unpadded window
+            num_actions = window[0].shape[1] * predictions
+            request.result = (probs[i][:num_actions], float(last_values[i]))
+        with self._stats_lock:
+            self._batches += 1
+            self._requests_run += len(requests)
+            for request in requests:
+                wait = start - request.enqueued
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
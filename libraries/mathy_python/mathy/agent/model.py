@@ -15,6 +15,7 @@ from wasabi import msg
 from mathy_core.expressions import MathTypeKeysMax
 from ..env import MathyEnv
 from ..envs import PolySimplify
+from ..spans import spans
 from ..state import (
     MathyInputsType,
     MathyObservation,
@@ -125,11 +126,147 @@ def build_agent_model(
     )
     out_model.opt = tf.keras.optimizers.Adam(learning_rate=lr_schedule)
     out_model.predictions = predictions
+    attach_length_buckets(out_model, config)
     return out_model
 
 
 AgentModel = tf.keras.Model
 
+MODEL_INPUT_NAMES = ["nodes_in", "values_in", "type_in", "time_in"]
+
+
+class LengthBucketedCall:
+    """Call an agent model through compiled graphs with fixed sequence lengths.
+
+    Calling the model eagerly with a different sequence length every step adds
+    python overhead to every call, and a `tf.function` with unknown lengths
+    would retrace for each new shape. Instead, inputs are padded up to the
+    nearest length bucket, and each bucket gets its own compiled function with
+    a fixed input signature. Sequences longer than the largest bucket fall
+    back to an eager call.
+
+    The compiled functions call the model's layers directly, so the value and
+    reward heads only average the sequence up to the input length. The padded
+    nodes don't change the outputs, and the policy logits are sliced back to
+    the input length, so callers get the same outputs as `model.call`.
+
+    # Arguments
+    model (AgentModel): The model to call
+    buckets (List[int]): The sequence lengths to compile graphs for
+    """
+
+    model: AgentModel
+    buckets: List[int]
+    bucket_hits: Dict[int, int]
+    overflow_hits: int
+
+    def __init__(self, model: AgentModel, buckets: List[int]):
+        assert len(buckets) > 0, "at least one length bucket is required"
+        self.model = model
+        self.buckets = sorted(buckets)
+        self.bucket_hits = {bucket: 0 for bucket in self.buckets}
+        self.overflow_hits = 0
+        self._functions: Dict[int, Callable] = {}
+        self._sequence_model = tf.keras.Model(
+            model.inputs, model.get_layer("siren").output
+        )
+        self._policy_head = model.get_layer("policy_head")
+        self._value_head = model.get_layer("value_head")
+        self._reward_head = model.get_layer("reward_head")
+
+    def get_bucket(self, length: int) -> Optional[int]:
+        """Return the smallest bucket that fits a sequence of the given length,
+        or None if it's longer than the largest bucket."""
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return None
+
+    def get_function(self, bucket: int) -> Callable:
+        """Return the compiled model call for a bucket, creating it if needed"""
+        if bucket not in self._functions:
+            signature = [
+                {
+                    "nodes_in": tf.TensorSpec([None, bucket], tf.int32),
+                    "values_in": tf.TensorSpec([None, bucket], tf.float32),
+                    "type_in": tf.TensorSpec([None, bucket, 2], tf.float32),
+                    "time_in": tf.TensorSpec([None, bucket, 1], tf.float32),
+                },
+                tf.TensorSpec([], tf.int32),
+            ]
+            self._functions[bucket] = tf.function(
+                self.call_padded, input_signature=signature
+            )
+        return self._functions[bucket]
+
+    def call_padded(
+        self, inputs: MathyInputsType, length: tf.Tensor
+    ) -> List[tf.Tensor]:
+        """Call the model with inputs that are padded past `length` nodes. The
+        padded nodes are left out of the sequence mean that the value and reward
+        heads are given, and the policy logits are sliced to `length`."""
+        sequence = self._sequence_model(inputs)
+        mask = tf.sequence_mask(length, tf.shape(sequence)[1], dtype=sequence.dtype)
+        sequence_sum = tf.reduce_sum(sequence * mask[None, :, None], axis=1)
+        sequence_mean = sequence_sum / tf.cast(length, sequence.dtype)
+        logits = self._policy_head(sequence)
+        values = self._value_head(sequence_mean)
+        rewards = self._reward_head(sequence_mean)
+        return [logits[:, :length], values, rewards]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of calls that used each bucket"""
+        result = {f"bucket_{b}": hits for b, hits in self.bucket_hits.items()}
+        result["overflow"] = self.overflow_hits
+        return result
+
+    def __call__(self, inputs: MathyInputsType) -> List[tf.Tensor]:
+        nodes = tf.convert_to_tensor(inputs["nodes_in"], dtype=tf.int32)
+        length = int(nodes.shape[1])
+        bucket = self.get_bucket(length)
+        if bucket is None:
+            self.overflow_hits += 1
+            return self.model.call({k: inputs[k] for k in MODEL_INPUT_NAMES})
+        self.bucket_hits[bucket] += 1
+        pad = bucket - length
+        values = tf.convert_to_tensor(inputs["values_in"], dtype=tf.float32)
+        type_in = tf.convert_to_tensor(inputs["type_in"], dtype=tf.float32)
+        time_in = tf.convert_to_tensor(inputs["time_in"], dtype=tf.float32)
+        padded = {
+            "nodes_in": tf.pad(nodes, [[0, 0], [0, pad]]),
+            "values_in": tf.pad(values, [[0, 0], [0, pad]]),
+            # Type/time are repeated for each node, so repeat them into padding
+            "type_in": tf.concat(
+                [type_in, tf.repeat(type_in[:, -1:], pad, axis=1)], axis=1
+            ),
+            "time_in": tf.concat(
+                [time_in, tf.repeat(time_in[:, -1:], pad, axis=1)], axis=1
+            ),
+        }
+        return self.get_function(bucket)(padded, tf.constant(length))
+
+
+def attach_length_buckets(model: AgentModel, config: AgentConfig) -> AgentModel:
+    """Set (or clear) the model's length bucketed call based on the config"""
+    model.bucketed_call = None
+    if config.use_length_buckets:
+        model.bucketed_call = LengthBucketedCall(model, config.length_buckets)
+    return model
+
+
+def call_agent_model(model: AgentModel, inputs: MathyInputsType) -> List[tf.Tensor]:
+    """Call the model with a dictionary of inputs, using its compiled length
+    buckets if they're enabled.
+
+    # Returns
+    (List[tf.Tensor]): The `[logits, values, reward_logits]` model outputs
+    """
+    bucketed_call: Optional[LengthBucketedCall] = getattr(model, "bucketed_call", None)
+    with spans.span("agent/model_forward"):
+        if bucketed_call is not None:
+            return bucketed_call(inputs)
+        return model.call(inputs)
+
 
 def _load_model(model_path: Path, predictions: int) -> AgentModel:
     model = tf.keras.models.load_model(str(model_path))
@@ -175,7 +312,7 @@ def get_or_create_agent_model(
             msg.info(f"wrote model config: {cfg}")
         srsly.write_json(cfg, config.dict(exclude_defaults=False))
 
-    return model
+    return attach_length_buckets(model, config)
 
 
 def load_agent_model(
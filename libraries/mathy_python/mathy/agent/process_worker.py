@@ -0,0 +1,276 @@
+import multiprocessing
+import os
+import queue
+from typing import Any, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from ..spans import spans
+from ..teacher import Teacher
+from .config import AgentConfig
+from .worker import A3CWorker
+
+WeightShapes = List[Tuple[int, ...]]
+
+
+def get_weight_shapes(weights: List[Any]) -> WeightShapes:
+    """Return the shape of each array in a list of model weights"""
+    return [tuple(w.shape) for w in weights]
+
+
+def flatten_weights(weights: List[Any], out: np.ndarray) -> None:
+    """Copy a list of weight (or gradient) arrays into one flat float32 buffer"""
+    offset = 0
+    for weight in weights:
+        value = np.asarray(weight, dtype=np.float32).ravel()
+        out[offset : offset + value.size] = value
+        offset += value.size
+
+
+def unflatten_weights(flat: np.ndarray, shapes: WeightShapes) -> List[np.ndarray]:
+    """Split a flat float32 buffer into a list of arrays with the given shapes.
+    The arrays are copies, so the buffer can be overwritten afterwards."""
+    out: List[np.ndarray] = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        out.append(flat[offset : offset + size].reshape(shape).copy())
+        offset += size
+    return out
+
+
+class SharedTrainingState:
+    """Shared memory used to connect rollout processes with the learner.
+
+    Each worker owns a gradient slot that it writes into before putting its
+    index on `gradients_ready`. The worker then waits for its `slot_free` event,
+    which the learner sets once it has copied the gradients out. The learner
+    broadcasts weights by writing them into `weights` and bumping
+    `weights_version`, which workers poll between updates.
+
+    # Arguments
+    context (Any): The multiprocessing context to create shared objects with
+    num_workers (int): The number of rollout processes
+    num_gradients (int): The number of trainable parameters in the model
+    num_weights (int): The number of parameters in the model's weights
+    """
+
+    def __init__(
+        self, context: Any, num_workers: int, num_gradients: int, num_weights: int
+    ):
+        self.gradients = [
+            context.Array("f", num_gradients, lock=False) for _ in range(num_workers)
+        ]
+        self.slot_free = [context.Event() for _ in range(num_workers)]
+        for event in self.slot_free:
+            event.set()
+        self.gradients_ready = context.Queue()
+        self.weights = context.Array("f", num_weights, lock=False)
+        self.weights_lock = context.Lock()
+        self.weights_version = context.Value("i", 0, lock=False)
+        self.updates = context.Value("i", 0, lock=False)
+        self.episodes = context.Value("i", 0)
+        self.quit = context.Event()
+
+    def gradient_buffer(self, worker_idx: int) -> np.ndarray:
+        return np.frombuffer(self.gradients[worker_idx], dtype=np.float32)
+
+    def weights_buffer(self) -> np.ndarray:
+        return np.frombuffer(self.weights, dtype=np.float32)
+
+    def write_weights(self, weights: List[Any]) -> None:
+        """Broadcast a new set of weights to the rollout processes"""
+        with self.weights_lock:
+            flatten_weights(weights, self.weights_buffer())
+            self.weights_version.value += 1
+
+    def release_workers(self) -> None:
+        """Signal shutdown and unblock any worker waiting on its gradient slot"""
+        self.quit.set()
+        for event in self.slot_free:
+            event.set()
+
+
+class A3CProcessWorker(A3CWorker):
+    """An A3C worker that runs in its own process with a local model copy.
+
+    Rather than applying gradients to a shared global model (which requires
+    all workers to share one Python interpreter and its GIL) the worker writes
+    its gradients into shared memory for the learner process to apply, and
+    copies new weights from the learner when they are broadcast."""
+
+    def __init__(self, shared: SharedTrainingState, **kwargs):
+        super(A3CProcessWorker, self).__init__(global_model=None, **kwargs)
+        self.shared = shared
+        # The local model selects actions in place of the global model
+        self.global_model = self.local_model
+        self.optimizer = self.local_model.optimizer
+        self.weight_shapes = get_weight_shapes(self.local_model.get_weights())
+        self.weights_version = -1
+        self.sync_weights()
+
+    def is_training(self) -> bool:
+        A3CWorker.global_episode = self.shared.episodes.value
+        return (
+            A3CWorker.global_episode < self.args.max_eps
+            and not self.shared.quit.is_set()
+        )
+
+    def wait_between_steps(self) -> None:
+        # Processes don't compete for the GIL, so there's no need to yield
+        pass
+
+    def sync_weights(self) -> None:
+        """Copy the latest broadcast weights into the local model"""
+        if self.shared.weights_version.value == self.weights_version:
+            return
+        with self.shared.weights_lock:
+            self.weights_version = self.shared.weights_version.value
+            weights = unflatten_weights(
+                self.shared.weights_buffer(), self.weight_shapes
+            )
+        with spans.span("agent/set_weights"):
+            self.local_model.set_weights(weights)
+        # Keep summary steps in line with the learner
+        self.optimizer.iterations.assign(self.shared.updates.value)
+
+    def apply_gradients(self, grads: List[tf.Tensor]) -> None:
+        slot_free = self.shared.slot_free[self.worker_idx]
+        with spans.span("agent/wait_for_learner"):
+            slot_free.wait()
+        if self.shared.quit.is_set():
+            return
+        slot_free.clear()
+        # Embedding gradients are IndexedSlices, so densify them before copying
+        dense = [tf.convert_to_tensor(g).numpy() for g in grads]
+        flatten_weights(dense, self.shared.gradient_buffer(self.worker_idx))
+        self.shared.gradients_ready.put(self.worker_idx)
+        self.sync_weights()
+
+    def finish_episode(self, *args, **kwargs):
+        super(A3CProcessWorker, self).finish_episode(*args, **kwargs)
+        with self.shared.episodes.get_lock():
+            self.shared.episodes.value += 1
+
+    def write_global_model(self, increment_episode=True):
+        # The learner process owns the global model and saves it
+        pass
+
+
+def run_process_worker(
+    args: AgentConfig,
+    env_extra: dict,
+    action_size: int,
+    greedy_epsilon: float,
+    worker_idx: int,
+    shared: SharedTrainingState,
+) -> None:
+    """Entry point for a rollout process"""
+    log_dir = os.path.join(args.model_dir, "tensorboard")
+    teacher = Teacher(
+        topic_names=args.topics,
+        num_students=args.num_workers,
+        difficulty=args.difficulty,
+        eval_window=args.teacher_evaluation_steps,
+        win_threshold=args.teacher_promote_wins,
+        lose_threshold=args.teacher_demote_wins,
+    )
+    worker = A3CProcessWorker(
+        shared=shared,
+        args=args,
+        env_extra=env_extra,
+        action_size=action_size,
+        greedy_epsilon=greedy_epsilon,
+        worker_idx=worker_idx,
+        optimizer=None,
+        writer=tf.summary.create_file_writer(log_dir),
+        teacher=teacher,
+    )
+    spans.enabled = args.profile_spans
+    try:
+        worker.run()
+        if args.profile_spans:
+            span_file = f"spans_worker_{worker_idx}.json"
+            spans.write_json(os.path.join(args.model_dir, span_file))
+    finally:
+        # Don't block process exit on gradient indices the learner won't read
+        shared.gradients_ready.cancel_join_thread()
+
+
+def start_process_workers(
+    args: AgentConfig,
+    env_extra: dict,
+    action_size: int,
+    greedy_epsilons: List[float],
+    global_model: tf.keras.Model,
+) -> Tuple[SharedTrainingState, List[multiprocessing.Process]]:
+    """Allocate the shared training state and start one rollout process for
+    each worker. The processes use the "spawn" start method because TensorFlow
+    can't be safely forked after it has been initialized."""
+    context = multiprocessing.get_context("spawn")
+    num_gradients = sum(int(np.prod(w.shape)) for w in global_model.trainable_weights)
+    num_weights = sum(int(np.prod(w.shape)) for w in global_model.get_weights())
+    shared = SharedTrainingState(
+        context, args.num_workers, num_gradients, num_weights
+    )
+    shared.write_weights(global_model.get_weights())
+    processes: List[multiprocessing.Process] = []
+    for i in range(args.num_workers):
+        process = context.Process(
+            target=run_process_worker,
+            name=f"mathy-worker-{i}",
+            args=(args, env_extra, action_size, float(greedy_epsilons[i]), i, shared),
+        )
+        process.start()
+        processes.append(process)
+    return shared, processes
+
+
+def run_learner(
+    args: AgentConfig,
+    global_model: tf.keras.Model,
+    shared: SharedTrainingState,
+    processes: List[multiprocessing.Process],
+    save_fn: Any = None,
+    save_every_n_episodes: int = 250,
+) -> int:
+    """Apply gradients from the rollout processes to the global model until the
+    episode budget is used or every process has exited.
+
+    # Returns
+    (int): The number of gradient updates applied
+    """
+    trainable = global_model.trainable_weights
+    shapes = get_weight_shapes(trainable)
+    optimizer = global_model.optimizer
+    updates = 0
+    last_save = 0
+    try:
+        while any(p.is_alive() for p in processes):
+            if shared.episodes.value >= args.max_eps:
+                break
+            try:
+                worker_idx = shared.gradients_ready.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            grads = unflatten_weights(shared.gradient_buffer(worker_idx), shapes)
+            shared.slot_free[worker_idx].set()
+            with spans.span("agent/apply_gradients"):
+                optimizer.apply_gradients(zip(grads, trainable))
+            updates += 1
+            shared.updates.value = updates
+            if updates % args.weight_broadcast_interval == 0:
+                shared.write_weights(global_model.get_weights())
+            episodes = shared.episodes.value
+            if save_fn is not None and episodes - last_save >= save_every_n_episodes:
+                last_save = episodes
+                save_fn()
+    finally:
+        shared.release_workers()
+        for process in processes:
+            process.join()
+    failed = [p.name for p in processes if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"worker processes exited with errors: {failed}")
+    return updates
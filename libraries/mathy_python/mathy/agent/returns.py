@@ -0,0 +1,151 @@
+"""Vectorized discounted returns, lambda-returns and advantages.
+
+The trfl ops evaluate returns with a `tf.scan` over the time dimension, which
+runs one small op per timestep. The segments the agent trains on are short, so
+these functions instead build the matrix of discount products for a segment
+and compute every timestep's return with one matrix product.
+
+Tensors are time major like the trfl ops: `[T, B]` for sequences and `[B]`
+for bootstrap values. The recurrences are:
+
+```python
+discounted[t] = rewards[t] + discounts[t] * discounted[t + 1]
+lambda[t] = rewards[t] + discounts[t] * (
+    (1 - lambda_) * values[t + 1] + lambda_ * lambda[t + 1]
+)
+```
+
+where the value after the last timestep is the bootstrap value. The returns
+are used as fixed targets, so they're computed with NumPy and don't carry
+gradients.
+"""
+from typing import NamedTuple, Tuple, Union
+
+import numpy as np
+
+ArrayLike = Union[np.ndarray, list, float]
+
+
+class SegmentReturns(NamedTuple):
+    """The returns for a batch of trajectory segments, each shaped `[T, B]`"""
+
+    # The discounted sum of rewards, bootstrapped from the final value
+    discounted: np.ndarray
+    # The TD(lambda) targets for the state values
+    lambda_returns: np.ndarray
+    # The lambda-returns minus the state values
+    advantages: np.ndarray
+
+
+def discount_products(discounts: ArrayLike) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the products of the discounts between each pair of timesteps.
+
+    Products are accumulated directly rather than dividing cumulative products,
+    so zero discounts (e.g. at episode ends) are exact.
+
+    # Arguments
+    discounts (ArrayLike): The discount at each timestep, shape `[T, B]`
+
+    # Returns
+    (Tuple[np.ndarray, np.ndarray]): A `[T, T, B]` array where `[t, k]` is the
+        product of the discounts from `t` up to (not including) `k`, and zero
+        for `k < t`. And a `[T, B]` array with the product of the discounts
+        from `t` through the last timestep, which scales the bootstrap value.
+    """
+    discounts = np.asarray(discounts, dtype=np.float32)
+    length = discounts.shape[0]
+    before = np.tril(np.ones((length, length), dtype=bool), k=-1)
+    # factors[t, j] is the discount at j for j >= t, and 1.0 before t
+    factors = np.where(before[..., None], np.float32(1.0), discounts[None])
+    products = np.cumprod(factors, axis=1)
+    matrix = np.zeros_like(products)
+    matrix[:, 1:] = products[:, :-1]
+    matrix[np.arange(length), np.arange(length)] = 1.0
+    matrix[before] = 0.0
+    return matrix, products[:, -1]
+
+
+def discounted_returns(
+    rewards: ArrayLike, discounts: ArrayLike, bootstrap_value: ArrayLike
+) -> np.ndarray:
+    """Return the discounted sum of future rewards at each timestep.
+
+    # Arguments
+    rewards (ArrayLike): The reward at each timestep, shape `[T, B]`
+    discounts (ArrayLike): The discount at each timestep, shape `[T, B]`
+    bootstrap_value (ArrayLike): The value after the last timestep, shape `[B]`
+
+    # Returns
+    (np.ndarray): The discounted returns, shape `[T, B]`
+    """
+    rewards = np.asarray(rewards, dtype=np.float32)
+    matrix, tail = discount_products(discounts)
+    bootstrap = np.asarray(bootstrap_value, dtype=np.float32)
+    return np.einsum("tkb,kb->tb", matrix, rewards) + tail * bootstrap
+
+
+def lambda_returns(
+    rewards: ArrayLike,
+    discounts: ArrayLike,
+    values: ArrayLike,
+    bootstrap_value: ArrayLike,
+    lambda_: float = 1.0,
+) -> np.ndarray:
+    """Return the TD(lambda) targets at each timestep. The results match
+    trfl's `generalized_lambda_returns`.
+
+    # Arguments
+    rewards (ArrayLike): The reward at each timestep, shape `[T, B]`
+    discounts (ArrayLike): The discount at each timestep, shape `[T, B]`
+    values (ArrayLike): The state value estimates, shape `[T, B]`
+    bootstrap_value (ArrayLike): The value after the last timestep, shape `[B]`
+    lambda_ (float): Mixes bootstrapped (0.0) and Monte-Carlo (1.0) returns
+
+    # Returns
+    (np.ndarray): The lambda-returns, shape `[T, B]`
+    """
+    return compute_returns(
+        rewards, discounts, values, bootstrap_value, lambda_
+    ).lambda_returns
+
+
+def compute_returns(
+    rewards: ArrayLike,
+    discounts: ArrayLike,
+    values: ArrayLike,
+    bootstrap_value: ArrayLike,
+    lambda_: float = 1.0,
+) -> SegmentReturns:
+    """Compute the discounted returns, lambda-returns and advantages for a batch
+    of trajectory segments at once.
+
+    # Arguments
+    rewards (ArrayLike): The reward at each timestep, shape `[T, B]`
+    discounts (ArrayLike): The discount at each timestep, shape `[T, B]`
+    values (ArrayLike): The state value estimates, shape `[T, B]`
+    bootstrap_value (ArrayLike): The value after the last timestep, shape `[B]`
+    lambda_ (float): Mixes bootstrapped (0.0) and Monte-Carlo (1.0) returns
+
+    # Returns
+    (SegmentReturns): The returns for each timestep of each segment
+    """
+    rewards = np.asarray(rewards, dtype=np.float32)
+    discounts = np.asarray(discounts, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    bootstrap = np.asarray(bootstrap_value, dtype=np.float32)
+    assert rewards.ndim == 2, f"expected [T, B] rewards, not {rewards.shape}"
+    assert rewards.shape == discounts.shape == values.shape
+    assert bootstrap.shape == rewards.shape[1:]
+    discounted = discounted_returns(rewards, discounts, bootstrap)
+    if lambda_ == 1.0:
+        returns = discounted
+    else:
+        # Rewrite the recurrence as a discounted sum of mixed rewards:
+        #   lambda[t] = mixed[t] + discounts[t] * lambda_ * lambda[t + 1]
+        # where the last timestep bootstraps from the final value.
+        next_values = np.concatenate([values[1:], bootstrap[None]], axis=0)
+        mixed = rewards + discounts * (1.0 - lambda_) * next_values
+        returns = discounted_returns(mixed, discounts * lambda_, bootstrap)
+    return SegmentReturns(
+        discounted=discounted, lambda_returns=returns, advantages=returns - values
+    )
@@ -1,7 +1,7 @@
 import datetime
 import multiprocessing
 from dataclasses import dataclass, field
-from typing import Dict, Union
+from typing import Any, Dict, Union
 
 from colr import color
 
@@ -30,6 +30,18 @@ class EpisodeLosses:
         return out
 
 
+def get_learning_rate(optimizer: Any, step: Any) -> Any:
+    """Return an optimizer's learning rate at the given step.
+
+    Depending on the TensorFlow version, `optimizer.lr` is either the learning
+    rate schedule (which is called with the step) or a variable that holds the
+    current learning rate."""
+    learning_rate = optimizer.lr
+    if callable(learning_rate):
+        return learning_rate(step)
+    return learning_rate
+
+
 def truncate(value: Union[str, int, float]):
     """Truncate a number to 3 decimal places"""
     return float("%.3f" % (float(value)))
@@ -4,21 +4,24 @@ import queue
 import threading
 import time
 from multiprocessing import Queue
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import List, Optional, Tuple, Union, cast
 
-import gym
 import numpy as np
 import tensorflow as tf
 from wasabi import msg
 
+from ..envs.gym import MathyGymEnvPool
+from ..spans import spans
 from ..state import MathyEnvState, MathyObservation, observations_to_window
 from ..teacher import Teacher
 from . import action_selectors
 from .episode_memory import EpisodeMemory
-from .model import AgentModel, get_or_create_agent_model
-from .trfl import discrete_policy_entropy_loss, td_lambda
+from .inference import InferenceBatcher
+from .model import AgentModel, call_agent_model, get_or_create_agent_model
+from .returns import compute_returns
+from .trfl import discrete_policy_entropy_loss
 from .config import AgentConfig
-from .util import EpisodeLosses, record, truncate
+from .util import EpisodeLosses, get_learning_rate, record, truncate
 
 
 class A3CWorker(threading.Thread):
@@ -33,7 +36,7 @@ class A3CWorker(threading.Thread):
     save_lock = threading.Lock()
     # </GLOBAL_VARS>
 
-    envs: Dict[str, Any]
+    envs: MathyGymEnvPool
 
     losses: EpisodeLosses
 
@@ -48,10 +51,14 @@ class A3CWorker(threading.Thread):
         writer: tf.summary.SummaryWriter,
         teacher: Teacher,
         env_extra: dict,
+        batcher: Optional[InferenceBatcher] = None,
     ):
         super(A3CWorker, self).__init__()
         self.args = args
+        self.batcher = batcher
         self.env_extra = env_extra
+        # The envs this worker has played, reused across its episodes
+        self.envs = MathyGymEnvPool(env_extra)
         self.greedy_epsilon = greedy_epsilon
         self.iteration = 0
         self.action_size = action_size
@@ -67,7 +74,7 @@ class A3CWorker(threading.Thread):
             self.local_model = get_or_create_agent_model(
                 config=args,
                 predictions=self.action_size,
-                env=gym.make(first_env, **self.env_extra).mathy,
+                env=self.envs.get(first_env).mathy,
             )
             self.last_model_write = -1
             self.last_histogram_write = -1
@@ -106,10 +113,7 @@ class A3CWorker(threading.Thread):
             pr.enable()
 
         episode_memory = EpisodeMemory()
-        while (
-            A3CWorker.global_episode < self.args.max_eps
-            and A3CWorker.request_quit is False
-        ):
+        while self.is_training():
             reward = self.run_episode(episode_memory)
             if (
                 A3CWorker.global_episode
@@ -126,8 +130,6 @@ class A3CWorker(threading.Thread):
                             )
 
             self.iteration += 1
-            # TODO: Make this a subprocess? Python threads won't scale up well to
-            #       many cores, I think.
 
         if self.args.profile:
             profile_name = f"worker_{self.worker_idx}.profile"
@@ -137,9 +139,28 @@ class A3CWorker(threading.Thread):
             if self.args.verbose:
                 print(f"PROFILER: saved {profile_path}")
 
+    def is_training(self) -> bool:
+        """Return True while the worker should keep running episodes"""
+        return (
+            A3CWorker.global_episode < self.args.max_eps
+            and A3CWorker.request_quit is False
+        )
+
+    def wait_between_steps(self) -> None:
+        """If there are multiple workers, apply a worker sleep to give the
+        system some breathing room."""
+        if self.args.num_workers > 1:
+            # The greedy worker sleeps for a shorter period of time
+            sleep = self.args.worker_wait
+            if self.worker_idx == 0:
+                sleep = max(sleep // 100, 0.005)
+            # Workers wait between each step so that it's possible
+            # to run more workers than there are CPUs available.
+            time.sleep(sleep)
+
     def run_episode(self, episode_memory: EpisodeMemory) -> float:
         env_name = self.teacher.get_env(self.worker_idx, self.iteration)
-        env = gym.make(env_name, **self.env_extra)
+        env = self.envs.get(env_name)
         episode_memory.clear()
         self.ep_loss = 0
         ep_reward = 0.0
@@ -156,14 +177,21 @@ class A3CWorker(threading.Thread):
             worker_id=self.worker_idx,
             epsilon=self.epsilon,
             episode=A3CWorker.global_episode,
+            batcher=self.batcher,
         )
 
         while not done and A3CWorker.request_quit is False:
             if self.args.print_training and self.worker_idx == 0:
                 env.render(last_action=last_action, last_reward=last_reward)
-            window = episode_memory.to_window_observation(
-                last_observation, window_size=self.args.prediction_window_size
-            )
+            window_size = self.args.prediction_window_size
+            if self.args.predict_newest_only:
+                window = episode_memory.to_prediction_window(
+                    last_observation, window_size=window_size
+                )
+            else:
+                window = episode_memory.to_window_observation(
+                    last_observation, window_size=window_size
+                )
             action, value = selector.select(
                 last_state=env.state,
                 last_window=window,
@@ -172,7 +200,8 @@ class A3CWorker(threading.Thread):
             )
 
             # Take an env step
-            observation, reward, done, last_obs_info = env.step(action)
+            with spans.span("env/step"):
+                observation, reward, done, last_obs_info = env.step(action)
             ep_reward += reward
             episode_memory.store(
                 observation=last_observation, action=action, reward=reward, value=value,
@@ -194,17 +223,7 @@ class A3CWorker(threading.Thread):
             last_observation = observation
             last_action = int(action)
             last_reward = reward
-
-            # If there are multiple workers, apply a worker sleep
-            # to give the system some breathing room.
-            if self.args.num_workers > 1:
-                # The greedy worker sleeps for a shorter period of time
-                sleep = self.args.worker_wait
-                if self.worker_idx == 0:
-                    sleep = max(sleep // 100, 0.005)
-                # Workers wait between each step so that it's possible
-                # to run more workers than there are CPUs available.
-                time.sleep(sleep)
+            self.wait_between_steps()
         return ep_reward
 
     def maybe_write_episode_summaries(
@@ -229,6 +248,13 @@ class A3CWorker(threading.Thread):
                 data=A3CWorker.global_moving_average_reward,
                 step=step,
             )
+            if self.batcher is not None:
+                self.batcher.write_summaries(step)
+            if spans.enabled:
+                spans.write_summaries(step)
+            if self.global_model.bucketed_call is not None:
+                for key, hits in self.global_model.bucketed_call.stats().items():
+                    tf.summary.scalar(f"length_buckets/{key}", data=hits, step=step)
 
     def maybe_write_histograms(self) -> None:
         if self.worker_idx != 0:
@@ -248,7 +274,7 @@ class A3CWorker(threading.Thread):
     ):
         # Calculate gradient wrt to local model. We do so by tracking the
         # variables involved in computing the loss by using tf.GradientTape
-        with tf.GradientTape() as tape:
+        with tf.GradientTape() as tape, spans.span("agent/loss"):
             loss_tuple = self.compute_loss(
                 done=done,
                 observation=observation,
@@ -273,9 +299,18 @@ class A3CWorker(threading.Thread):
             self.losses.increment(k, aux_losses[k].numpy())
 
         # Calculate local gradients
-        grads = tape.gradient(total_loss, self.local_model.trainable_weights)
-        # Push local gradients to global model
+        with spans.span("agent/gradients"):
+            grads = tape.gradient(total_loss, self.local_model.trainable_weights)
+        self.apply_gradients(grads)
 
+        if done:
+            episode_memory.clear()
+        else:
+            episode_memory.clear_except_window(self.args.prediction_window_size)
+
+    def apply_gradients(self, grads: List[tf.Tensor]) -> None:
+        """Push local gradients to the global model, and update the local
+        model with the new global weights."""
         zipped_gradients = zip(grads, self.global_model.trainable_weights)
         # Assert that we always have some gradient flow in each trainable var
 
@@ -289,14 +324,11 @@ class A3CWorker(threading.Thread):
         #         tf.print(grad_sum)
         #         raise ValueError(f"{var.name} has no gradient")
 
-        self.optimizer.apply_gradients(zipped_gradients)
+        with spans.span("agent/apply_gradients"):
+            self.optimizer.apply_gradients(zipped_gradients)
         # Update local model with new weights
-        self.local_model.set_weights(self.global_model.get_weights())
-
-        if done:
-            episode_memory.clear()
-        else:
-            episode_memory.clear_except_window(self.args.prediction_window_size)
+        with spans.span("agent/set_weights"):
+            self.local_model.set_weights(self.global_model.get_weights())
 
     def finish_episode(
         self,
@@ -352,31 +384,24 @@ class A3CWorker(threading.Thread):
         gamma=0.99,
     ):
         step = self.global_model.optimizer.iterations
+        batch_size = len(episode_memory.actions)
+        sequence_length = len(episode_memory.observations[0].nodes)
+        observations = episode_memory.observations
+        if not done:
+            # Predict the bootstrap value in the same forward pass as the episode
+            observations = observations + [observation]
+        inputs = observations_to_window(observations).to_inputs()
+        logits, values, reward_logits = call_agent_model(self.local_model, inputs)
         if done:
             bootstrap_value = 0.0  # terminal
         else:
-            # Predict the reward using the local network
-            _, values, _ = self.local_model.call(
-                observations_to_window([observation]).to_inputs()
-            )
-            # Select the last timestep
-            values = values[-1]
-            bootstrap_value = tf.squeeze(values).numpy()
-
-        discounted_rewards: List[float] = []
-        for reward in episode_memory.rewards[::-1]:
-            bootstrap_value = reward + gamma * bootstrap_value
-            discounted_rewards.append(bootstrap_value)
-        discounted_rewards.reverse()
-        discounted_rewards = tf.convert_to_tensor(
-            value=np.array(discounted_rewards)[:, None], dtype=tf.float32
-        )
-
-        batch_size = len(episode_memory.actions)
-        sequence_length = len(episode_memory.observations[0].nodes)
-        inputs = episode_memory.to_episode_window().to_inputs()
-        model_results = self.local_model.call(inputs)
-        logits, values, reward_logits = model_results
+            # The last row is the bootstrap observation. Its value is a fixed
+            # target, so it doesn't carry gradients.
+            bootstrap_value = tf.squeeze(values[-1]).numpy()
+            logits = logits[:batch_size]
+            values = values[:batch_size]
+            reward_logits = reward_logits[:batch_size]
+        model_results = [logits, values, reward_logits]
 
         logits = tf.reshape(logits, [batch_size, -1])
 
@@ -388,22 +413,22 @@ class A3CWorker(threading.Thread):
         entropy_loss = h_loss.loss * self.args.entropy_loss_scaling
         entropy_loss = tf.reduce_mean(entropy_loss)
 
-        rewards_tensor = tf.convert_to_tensor(episode_memory.rewards, dtype=tf.float32)
-        rewards_tensor = tf.expand_dims(rewards_tensor, 1)
-        rp_loss = tf.reduce_mean(tf.keras.losses.MSE(rewards_tensor, reward_logits))
-        pcontinues = tf.convert_to_tensor([[gamma]] * batch_size, dtype=tf.float32)
-        bootstrap_value = tf.convert_to_tensor([bootstrap_value], dtype=tf.float32)
-
-        lambda_loss = td_lambda(
-            state_values=values,
-            rewards=rewards_tensor,
-            pcontinues=pcontinues,
-            bootstrap_value=bootstrap_value,
+        # The episode is a single [T, 1] trajectory segment
+        rewards = np.asarray(episode_memory.rewards, dtype=np.float32)[:, None]
+        returns = compute_returns(
+            rewards=rewards,
+            discounts=np.full_like(rewards, gamma),
+            values=values.numpy(),
+            bootstrap_value=[bootstrap_value],
             lambda_=self.args.td_lambda,
         )
-        advantage = lambda_loss.extra.temporal_differences
+        discounted_rewards = tf.convert_to_tensor(returns.discounted)
+        rp_loss = tf.reduce_mean(tf.keras.losses.MSE(rewards, reward_logits))
+
+        # The returns are fixed targets, so gradients only flow through values
+        advantage = tf.convert_to_tensor(returns.lambda_returns) - values
         # Value loss
-        value_loss = tf.reduce_mean(lambda_loss.loss)
+        value_loss = tf.reduce_mean(0.5 * tf.reduce_sum(tf.square(advantage), axis=0))
 
         # Policy Loss
         policy_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
@@ -421,9 +446,8 @@ class A3CWorker(threading.Thread):
         tf.summary.scalar(f"losses/{prefix}/value_loss", data=value_loss, step=step)
         tf.summary.scalar(f"losses/{prefix}/entropy_loss", data=entropy_loss, step=step)
         tf.summary.scalar(f"losses/{prefix}/rp_loss", data=rp_loss, step=step)
-        tf.summary.scalar(
-            f"settings/learning_rate", data=self.optimizer.lr(step), step=step
-        )
+        learning_rate = get_learning_rate(self.optimizer, step)
+        tf.summary.scalar(f"settings/learning_rate", data=learning_rate, step=step)
         return (
             (
                 policy_loss,
@@ -1,21 +1,25 @@
 from dataclasses import dataclass
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 from .agent.config import AgentConfig
 from .agent.episode_memory import EpisodeMemory
-from .swarm import SwarmConfig, swarm_solve
-from .agent.model import AgentModel, load_agent_model
+
+if TYPE_CHECKING:
+    # Imported when used, because the model loads TensorFlow and the swarm
+    # loads fragile
+    from .agent.model import AgentModel
+    from .swarm import SwarmConfig
 
 
 @dataclass
 class MathyAPIModelState:
     config: AgentConfig
-    model: AgentModel
+    model: "AgentModel"
 
 
 @dataclass
 class MathyAPISwarmState:
-    config: SwarmConfig
+    config: "SwarmConfig"
 
 
 class Mathy:
@@ -27,20 +31,26 @@ class Mathy:
         self,
         *,
         model_path: str = None,
-        model: AgentModel = None,
-        config: Union[AgentConfig, SwarmConfig] = None,
+        model: "AgentModel" = None,
+        config: Union[AgentConfig, "SwarmConfig"] = None,
         silent: bool = False,
     ):
         if model_path is not None:
+            from .agent.model import load_agent_model
+
             model, config = load_agent_model(model_path, silent=silent)
             self.state = MathyAPIModelState(model=model, config=config)
         elif model is not None and config is not None:
+            from .agent.model import AgentModel
+
             if not isinstance(model, AgentModel):
                 raise ValueError("model must derive AgentModel for compatibility")
             if not isinstance(config, AgentConfig):
                 raise ValueError("config must be a AgentConfig instance")
             self.state = MathyAPIModelState(model=model, config=config)
         else:
+            from .swarm import SwarmConfig
+
             if config is None:
                 config = SwarmConfig()
             if not isinstance(config, SwarmConfig):
@@ -58,6 +68,8 @@ class Mathy:
         return self.simplify_model(model=model, problem=problem, max_steps=max_steps)
 
     def simplify_swarm(self, *, problem: str, max_steps: int) -> EpisodeMemory:
+        from .swarm import swarm_solve
+
         assert isinstance(self.state, MathyAPISwarmState), "not configured for swarm"
         return swarm_solve(problem, self.state.config)
 
@@ -101,9 +113,15 @@ class Mathy:
         done = False
         while not done:
             env.render(last_action=last_action, last_reward=last_reward)
-            window = episode_memory.to_window_observation(
-                last_observation, window_size=self.state.config.prediction_window_size
-            )
+            window_size = self.state.config.prediction_window_size
+            if self.state.config.predict_newest_only:
+                window = episode_memory.to_prediction_window(
+                    last_observation, window_size=window_size
+                )
+            else:
+                window = episode_memory.to_window_observation(
+                    last_observation, window_size=window_size
+                )
             action, value = selector.select(
                 last_state=env.state,
                 last_window=window,
@@ -0,0 +1,404 @@
+"""Measure the throughput of Mathy's hot paths so that changes can be
+compared between runs on the same machine.
+
+The benchmarks cover environment stepping for every builtin environment and
+difficulty, expression parsing and featurization, valid move masks, state
+serialization and (optionally) the agent model's forward pass."""
+import platform
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from pydantic import BaseModel
+
+from . import about
+from .env import MathyEnv
+from .envs import MATHY_BUILTIN_ENVS, PolySimplify
+from .spans import spans
+from .state import MathyEnvState, observations_to_window
+from .types import MathyEnvDifficulty, MathyEnvProblemArgs
+from .util import is_terminal_transition
+
+BenchmarkResults = Dict[str, Any]
+
+
+class BenchmarkConfig(BaseModel):
+    # The number of environment steps to take for each env/difficulty pair
+    steps: int = 500
+    # The number of times to repeat each latency measurement
+    repeat: int = 200
+    # The difficulties to step each environment at
+    difficulties: List[MathyEnvDifficulty] = [
+        MathyEnvDifficulty.easy,
+        MathyEnvDifficulty.normal,
+        MathyEnvDifficulty.hard,
+    ]
+    # Only benchmark environments whose class name contains one of these
+    # strings (case insensitive). All builtin environments are used if empty.
+    envs: List[str] = []
+    # Whether to measure the agent model and its losses (requires tensorflow)
+    model: bool = True
+    # The batch sizes (number of windows) to measure model forward passes with
+    model_batch_sizes: List[int] = [1, 8, 32]
+    # The window sizes (timesteps per window) to measure model forward passes with
+    model_window_sizes: List[int] = [1, 6]
+    # The trajectory segment lengths to measure return computations with
+    returns_lengths: List[int] = [8, 64]
+    # The number of trajectory segments to compute returns for at once
+    returns_batch_sizes: List[int] = [1, 16]
+    # Seed for problem generation and random actions
+    seed: int = 1337
+
+
+def time_calls(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Call a function `repeat` times and summarize the latency of each call in
+    milliseconds."""
+    assert repeat > 0, "repeat must be a positive integer"
+    times = np.empty((repeat,), dtype=np.float64)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    times *= 1000.0
+    return {
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "min_ms": float(times.min()),
+    }
+
+
+def get_benchmark_envs(config: BenchmarkConfig) -> List[Type[MathyEnv]]:
+    if len(config.envs) == 0:
+        return MATHY_BUILTIN_ENVS
+    names = [n.lower() for n in config.envs]
+
+    def included(env_class: Type[MathyEnv]) -> bool:
+        return any(name in env_class.__name__.lower() for name in names)
+
+    return [env_class for env_class in MATHY_BUILTIN_ENVS if included(env_class)]
+
+
+def sample_states(
+    env: MathyEnv, args: MathyEnvProblemArgs, count: int, rng: random.Random
+) -> List[MathyEnvState]:
+    """Generate states from random rollouts so the measurements include both
+    initial problems and partially solved ones."""
+    states: List[MathyEnvState] = []
+    state, _ = env.get_initial_state(args, print_problem=False)
+    while len(states) < count:
+        states.append(state)
+        state, done = random_step(env, state, rng)
+        if done:
+            state, _ = env.get_initial_state(args, print_problem=False)
+    return states
+
+
+def random_step(
+    env: MathyEnv, state: MathyEnvState, rng: random.Random
+) -> Tuple[MathyEnvState, bool]:
+    """Take a random valid action and return the next state and whether the
+    episode is over."""
+    actions = [i for i, m in enumerate(env.get_valid_moves(state)) if m == 1]
+    if len(actions) == 0:
+        return state, True
+    state, transition, _ = env.get_next_state(state, rng.choice(actions))
+    return state, is_terminal_transition(transition)
+
+
+def bench_env_steps(
+    env_class: Type[MathyEnv],
+    difficulty: MathyEnvDifficulty,
+    steps: int,
+    rng: random.Random,
+) -> Dict[str, float]:
+    """Measure how many random valid actions per second an environment takes,
+    including generating new problems when episodes end."""
+    env = env_class()
+    args = MathyEnvProblemArgs(difficulty=difficulty)
+    episodes = 0
+    start = time.perf_counter()
+    state, _ = env.get_initial_state(args, print_problem=False)
+    for _ in range(steps):
+        state, done = random_step(env, state, rng)
+        env.state_to_observation(state)
+        if done:
+            episodes += 1
+            env.finalize_state(state)
+            state, _ = env.get_initial_state(args, print_problem=False)
+    elapsed = time.perf_counter() - start
+    return {
+        "steps": steps,
+        "episodes": episodes,
+        "seconds": elapsed,
+        "steps_per_second": steps / elapsed,
+    }
+
+
+def bench_expressions(
+    env: MathyEnv, states: List[MathyEnvState], repeat: int
+) -> BenchmarkResults:
+    """Measure parsing, featurization and valid move latency for a set of
+    states. Parsing bypasses the env's expression cache to measure cold parses,
+    while featurization and valid moves are measured with a cold and a warm
+    cache."""
+    parser = env.parser
+    index = 0
+
+    def next_state() -> MathyEnvState:
+        nonlocal index
+        index = (index + 1) % len(states)
+        return states[index]
+
+    def parse():
+        parser.clear_cache()
+        parser.parse(next_state().agent.problem)
+
+    def featurize(clear_expressions: bool):
+        if clear_expressions:
+            env.expression_cache.clear()
+        state = next_state()
+        state.clear_cached_observation()
+        env.state_to_observation(state)
+
+    def valid_moves_cold():
+        env.expression_cache.clear()
+        env.get_valid_moves(next_state())
+
+    results: BenchmarkResults = {
+        "parse": time_calls(parse, repeat),
+        "featurize": time_calls(lambda: featurize(True), repeat),
+        "get_valid_moves": time_calls(valid_moves_cold, repeat),
+    }
+    # Warm the cache with every state, then measure cached lookups
+    for state in states:
+        env.state_to_observation(state)
+    results["featurize_cached"] = time_calls(lambda: featurize(False), repeat)
+    results["observation_cached"] = time_calls(
+        lambda: env.state_to_observation(next_state()), repeat
+    )
+    results["get_valid_moves_cached"] = time_calls(
+        lambda: env.get_valid_moves(next_state()), repeat
+    )
+    results["get_valid_actions_cached"] = time_calls(
+        lambda: env.get_valid_actions(next_state()), repeat
+    )
+    return results
+
+
+def bench_masks(
+    env_class: Type[MathyEnv],
+    difficulty: MathyEnvDifficulty,
+    steps: int,
+    rng: random.Random,
+) -> Dict[str, float]:
+    """Compare valid move masks that check every node against the rules with
+    incremental masks that only check the nodes a step changed. The same random
+    episodes are replayed in an env of each kind, and the masks are timed with
+    the "env/valid_moves" span, which covers the masks that `get_next_state`
+    computes for the next state's observation."""
+    episodes: List[Tuple[MathyEnvState, List[int]]] = []
+    env = env_class()
+    args = MathyEnvProblemArgs(difficulty=difficulty)
+    taken = 0
+    while taken < steps:
+        state, _ = env.get_initial_state(args, print_problem=False)
+        episode: List[int] = []
+        episodes.append((state, episode))
+        done = False
+        while not done and taken < steps:
+            valid = env.get_valid_actions(state)
+            if len(valid) == 0:
+                break
+            episode.append(rng.choice(valid))
+            state, transition, _ = env.get_next_state(state, episode[-1])
+            done = is_terminal_transition(transition)
+            taken += 1
+
+    def replay(replay_env: MathyEnv) -> Dict[str, float]:
+        was_enabled = spans.enabled
+        spans.enabled = True
+        spans.reset()
+        try:
+            for state, episode in episodes:
+                for action in episode:
+                    replay_env.get_valid_actions(state)
+                    state, _, _ = replay_env.get_next_state(state, action)
+            return spans.stats()["env/valid_moves"]
+        finally:
+            spans.reset()
+            spans.enabled = was_enabled
+
+    full = replay(env_class())
+    incremental_env = env_class(incremental_masks=True)
+    assert incremental_env.mask_cache is not None
+    incremental = replay(incremental_env)
+    stats = incremental_env.mask_cache.stats()
+    nodes = stats["node_checks"] + stats["node_hits"] + stats["node_skips"]
+    return {
+        "masks": incremental["count"],
+        "nodes_per_mask": nodes / incremental["count"],
+        "checked_nodes_per_mask": stats["node_checks"] / incremental["count"],
+        "full_ms": full["mean_ms"],
+        "incremental_ms": incremental["mean_ms"],
+        "speedup": full["mean_ms"] / max(incremental["mean_ms"], 1e-9),
+    }
+
+
+def bench_serialization(states: List[MathyEnvState], repeat: int) -> BenchmarkResults:
+    """Measure state serialization round trips in the string and binary formats"""
+    index = 0
+
+    def next_state() -> MathyEnvState:
+        nonlocal index
+        index = (index + 1) % len(states)
+        return states[index]
+
+    sizes = [s.get_serialized_size() for s in states]
+    return {
+        "string_round_trip": time_calls(
+            lambda: MathyEnvState.from_string(next_state().to_string()), repeat
+        ),
+        "numpy_round_trip": time_calls(
+            lambda: MathyEnvState.from_np(next_state().to_np()), repeat
+        ),
+        "mean_string_bytes": float(np.mean([len(s.to_string()) for s in states])),
+        "mean_binary_bytes": float(np.mean(sizes)),
+    }
+
+
+def bench_model_forward(
+    env: MathyEnv,
+    states: List[MathyEnvState],
+    batch_sizes: List[int],
+    window_sizes: List[int],
+    repeat: int,
+) -> BenchmarkResults:
+    """Measure the agent model's forward pass latency for windows of states"""
+    from .agent.config import AgentConfig
+    from .agent.model import build_agent_model, call_agent_model
+
+    model = build_agent_model(config=AgentConfig(), predictions=env.action_size)
+    results: BenchmarkResults = {}
+    for batch_size in batch_sizes:
+        for window_size in window_sizes:
+            count = batch_size * window_size
+            observations = [
+                env.state_to_observation(states[i % len(states)]) for i in range(count)
+            ]
+            inputs = observations_to_window(observations).to_inputs()
+            # Call once so any one-time graph building isn't measured
+            call_agent_model(model, inputs)
+            key = f"batch_{batch_size}_window_{window_size}"
+            results[key] = time_calls(lambda: call_agent_model(model, inputs), repeat)
+    return results
+
+
+def bench_returns(
+    lengths: List[int], batch_sizes: List[int], repeat: int, rng: random.Random
+) -> BenchmarkResults:
+    """Compare the scan-based trfl TD(lambda) targets with the vectorized
+    returns used by the agent's loss"""
+    import tensorflow as tf
+
+    from .agent.returns import compute_returns
+    from .agent.trfl import td_lambda
+
+    np_rng = np.random.RandomState(rng.randint(0, 2 ** 31 - 1))
+    results: BenchmarkResults = {}
+    for length in lengths:
+        for batch_size in batch_sizes:
+            shape = (length, batch_size)
+            rewards = np_rng.uniform(-1.0, 1.0, shape).astype(np.float32)
+            values = np_rng.uniform(-1.0, 1.0, shape).astype(np.float32)
+            discounts = np.full(shape, 0.99, dtype=np.float32)
+            bootstrap = np_rng.uniform(-1.0, 1.0, (batch_size,)).astype(np.float32)
+
+            def trfl_returns():
+                td_lambda(
+                    state_values=tf.convert_to_tensor(values),
+                    rewards=tf.convert_to_tensor(rewards),
+                    pcontinues=tf.convert_to_tensor(discounts),
+                    bootstrap_value=tf.convert_to_tensor(bootstrap),
+                    lambda_=0.5,
+                )
+
+            def vectorized_returns():
+                compute_returns(rewards, discounts, values, bootstrap, lambda_=0.5)
+
+            results[f"length_{length}_batch_{batch_size}"] = {
+                "trfl": time_calls(trfl_returns, repeat),
+                "vectorized": time_calls(vectorized_returns, repeat),
+            }
+    return results
+
+
+def run_benchmarks(
+    config: Optional[BenchmarkConfig] = None, log: Callable[[str], None] = None
+) -> BenchmarkResults:
+    """Run the benchmark suite and return the results as a JSON serializable
+    dictionary."""
+    if config is None:
+        config = BenchmarkConfig()
+    rng = random.Random(config.seed)
+    random.seed(config.seed)
+    np.random.seed(config.seed)
+
+    def report(text: str):
+        if log is not None:
+            log(text)
+
+    env_results: BenchmarkResults = {}
+    for env_class in get_benchmark_envs(config):
+        env_results[env_class.__name__] = {}
+        for difficulty in config.difficulties:
+            report(f"Stepping {env_class.__name__} ({difficulty.name})")
+            env_results[env_class.__name__][difficulty.name] = bench_env_steps(
+                env_class, difficulty, config.steps, rng
+            )
+
+    env = PolySimplify()
+    args = MathyEnvProblemArgs(difficulty=MathyEnvDifficulty.normal)
+    states = sample_states(env, args, 64, rng)
+    report("Measuring expressions")
+    expressions = bench_expressions(env, states, config.repeat)
+    report("Measuring incremental masks")
+    masks: BenchmarkResults = {}
+    for difficulty in config.difficulties:
+        masks[difficulty.name] = bench_masks(
+            PolySimplify, difficulty, config.steps, rng
+        )
+    report("Measuring serialization")
+    serialization = bench_serialization(states, config.repeat)
+    results: BenchmarkResults = {
+        "meta": {
+            "mathy_version": about.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {
+                **config.dict(),
+                "difficulties": [d.name for d in config.difficulties],
+            },
+        },
+        "env_steps": env_results,
+        "expressions": expressions,
+        "masks": masks,
+        "serialization": serialization,
+    }
+    if config.model:
+        report("Measuring model forward passes")
+        results["model_forward"] = bench_model_forward(
+            env,
+            states,
+            config.model_batch_sizes,
+            config.model_window_sizes,
+            config.repeat,
+        )
+        report("Measuring returns")
+        results["returns"] = bench_returns(
+            config.returns_lengths, config.returns_batch_sizes, config.repeat, rng
+        )
+    return results
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Type
+
+from mathy_core.expressions import MathExpression
+from mathy_core.parser import ExpressionParser
+
+from .masks import (
+    MaskUpdate,
+    NodeTypes,
+    get_candidate_indices,
+    index_nodes_by_type,
+)
+from .spans import spans
+
+
+class ExpressionCacheEntry:
+    """The parsed expression for a problem string and the values that are
+    derived from it while stepping an environment."""
+
+    __slots__ = (
+        "text",
+        "expression",
+        "_nodes",
+        "_inorder",
+        "_by_type",
+        "valid_actions",
+        "valid_rules",
+        "mask_update",
+    )
+
+    text: str
+    expression: MathExpression
+    valid_actions: Optional[Tuple[int, ...]]
+    valid_rules: Optional[List[int]]
+    # How the rule that built this expression changed the one before it,
+    # until the valid actions are computed from it
+    mask_update: Optional[MaskUpdate]
+
+    def __init__(self, text: str, expression: MathExpression):
+        self.text = text
+        self.expression = expression
+        self._nodes: Optional[List[MathExpression]] = None
+        self._inorder: Optional[List[MathExpression]] = None
+        self._by_type: Optional[Dict[Type[MathExpression], List[int]]] = None
+        self.valid_actions = None
+        self.valid_rules = None
+        self.mask_update = None
+
+    @property
+    def nodes(self) -> List[MathExpression]:
+        """The expression nodes in the order used for featurization (preorder)"""
+        if self._nodes is None:
+            self._build_index()
+        assert self._nodes is not None
+        return self._nodes
+
+    @property
+    def inorder(self) -> List[MathExpression]:
+        """The expression nodes in the order used for action indices (inorder)"""
+        if self._inorder is None:
+            self._build_index()
+        assert self._inorder is not None
+        return self._inorder
+
+    @property
+    def by_type(self) -> Dict[Type[MathExpression], List[int]]:
+        """The inorder indices of the expression nodes grouped by node class"""
+        if self._by_type is None:
+            self._by_type = index_nodes_by_type(self.inorder)
+        return self._by_type
+
+    def get_candidates(self, node_types: NodeTypes) -> List[int]:
+        """Return the inorder indices of the nodes that are instances of any of
+        the given types"""
+        return get_candidate_indices(self.by_type, node_types)
+
+    def token_at(self, index: int) -> Optional[MathExpression]:
+        """Return the node that is `index` from the left of the expression"""
+        if index < 0 or index >= len(self.inorder):
+            return None
+        return self.inorder[index]
+
+    def _build_index(self) -> None:
+        """Visit the tree once to build both node orderings, and mark each node
+        with its inorder index (`r_index`) the way `BaseRule.find_nodes` does."""
+        preorder: List[MathExpression] = []
+        inorder: List[MathExpression] = []
+
+        def visit(node: MathExpression) -> None:
+            preorder.append(node)
+            if node.left is not None:
+                visit(node.left)
+            node.r_index = len(inorder)
+            inorder.append(node)
+            if node.right is not None:
+                visit(node.right)
+
+        visit(self.expression)
+        self._nodes = preorder
+        self._inorder = inorder
+
+
+class ExpressionCache:
+    """A bounded LRU cache of parsed expressions keyed by problem text.
+
+    Environments parse the same problem text several times during a single
+    step (transition, observation, valid moves), and revisit the same texts
+    across steps and episodes. The cache keeps the parsed tree, its node list
+    and action masks together so that each distinct text is parsed once while
+    it stays in the cache.
+
+    # Arguments
+    parser (ExpressionParser): The parser to use for cache misses
+    capacity (int): The maximum number of expressions to keep
+    """
+
+    parser: ExpressionParser
+    capacity: int
+    hits: int
+    misses: int
+
+    def __init__(self, parser: ExpressionParser, capacity: int = 1024):
+        assert capacity > 0, "capacity must be a positive integer"
+        self.parser = parser
+        self.capacity = capacity
+        self._entries: "OrderedDict[str, ExpressionCacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._entries
+
+    def get(self, text: str) -> ExpressionCacheEntry:
+        """Return the cache entry for the given problem text, parsing it if
+        it isn't already in the cache."""
+        entry = self._entries.get(text, None)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(text)
+            return entry
+        self.misses += 1
+        with spans.span("env/parse"):
+            expression = self.parser.parse(text)
+        return self._insert(text, expression)
+
+    def put(self, text: str, expression: MathExpression) -> ExpressionCacheEntry:
+        """Add an already built expression for the given problem text, so that
+        getting the text doesn't parse it. If the text is already in the cache
+        the existing entry is kept.
+
+        The expression must have the same structure that parsing the text would
+        produce, and must not be changed after it's added."""
+        entry = self._entries.get(text, None)
+        if entry is not None:
+            self._entries.move_to_end(text)
+            return entry
+        return self._insert(text, expression)
+
+    def _insert(self, text: str, expression: MathExpression) -> ExpressionCacheEntry:
+        entry = ExpressionCacheEntry(text, expression)
+        self._entries[text] = entry
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            # The parser keeps its own unbounded cache of everything it has
+            # parsed. Flush it on eviction so it doesn't grow alongside this one.
+            self.parser.clear_cache()
+        return entry
+
+    def clear(self) -> None:
+        """Remove all entries and reset the hit/miss counters"""
+        self._entries.clear()
+        self.parser.clear_cache()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the cache size and hit/miss counters"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
@@ -55,22 +55,98 @@ def cli_contribute():
 @click.argument("problem", type=str)
 def cli_simplify(problem: str, model: str, max_steps: int, swarm: bool, parallel: bool):
     """Simplify an input polynomial expression."""
-    setup_tf_env()
-
     from .models import load_model
     from .api import Mathy
 
     if swarm is True:
         from .swarm import SwarmConfig
 
+        # The swarm solver doesn't need TensorFlow, so don't pay to load it
         mt = Mathy(config=SwarmConfig(use_mp=parallel))
     else:
+        setup_tf_env()
         mt = load_model(model)
 
     mt.simplify(problem=problem, max_steps=max_steps)
 
 
-@cli.command("problems")
+@cli.command("bench")
+@click.option(
+    "output",
+    "--output",
+    default="mathy_bench.json",
+    help="The JSON file to write benchmark results to",
+)
+@click.option(
+    "steps",
+    "--steps",
+    default=500,
+    type=int,
+    help="The number of steps to take in each environment and difficulty",
+)
+@click.option(
+    "repeat",
+    "--repeat",
+    default=200,
+    type=int,
+    help="The number of times to repeat each latency measurement",
+)
+@click.option(
+    "envs",
+    "--envs",
+    default="",
+    help="Comma separated environment names to step, e.g. 'poly,binomial'",
+)
+@click.option(
+    "no_model",
+    "--no-model",
+    default=False,
+    is_flag=True,
+    help="Skip the model forward pass measurements",
+)
+def cli_bench(output: str, steps: int, repeat: int, envs: str, no_model: bool):
+    """Measure environment, featurization, serialization and model
+    throughput, and write the results as JSON.
+
+    Results are only comparable between runs on the same machine."""
+    import srsly
+    from .bench import BenchmarkConfig, run_benchmarks
+
+    if not no_model:
+        setup_tf_env()
+    config = BenchmarkConfig(
+        steps=steps,
+        repeat=repeat,
+        envs=[e for e in envs.split(",") if e != ""],
+        model=not no_model,
+    )
+    results = run_benchmarks(config, log=msg.text)
+    srsly.write_json(output, results)
+    header = ("Environment", "Difficulty", "Steps/sec")
+    data = []
+    for env_name, difficulties in results["env_steps"].items():
+        for difficulty, result in difficulties.items():
+            data.append((env_name, difficulty, f"{result['steps_per_second']:.1f}"))
+    msg.table(data, header=header, divider=True)
+    msg.good(f"Wrote benchmark results: {output}")
+
+
+class ProblemsGroup(click.Group):
+    """Run `mathy problems <environment>` as `mathy problems print <environment>`
+    so that the command works the same as before it had subcommands."""
+
+    def parse_args(self, ctx, args):
+        if args and args[0] and args[0] not in self.commands and args[0][0] != "-":
+            args = ["print"] + args
+        return super(ProblemsGroup, self).parse_args(ctx, args)
+
+
+@cli.group("problems", cls=ProblemsGroup)
+def cli_problems():
+    """Print generated problems, or build banks of them to train with."""
+
+
+@cli_problems.command("print")
 @click.argument("environment", type=str)
 @click.option(
     "difficulty",
@@ -110,7 +186,79 @@ def cli_print_problems(environment: str, difficulty: str, number: int):
             data.append((problem.complexity, "✔" if valid else "✘", text,))
     msg.good(f"\nGenerated {number} problems!")
 
-    print(msg.table(data, header=header, divider=True, widths=widths, aligns=aligns))
+    msg.table(data, header=header, divider=True, widths=widths, aligns=aligns)
+
+
+@cli_problems.command("build")
+@click.argument("environments", type=str)
+@click.argument("folder", type=str)
+@click.option(
+    "difficulties",
+    "--difficulties",
+    default="easy,normal,hard",
+    help="A comma separated list of difficulties to build banks for",
+)
+@click.option(
+    "number",
+    "--number",
+    default=1000000,
+    type=int,
+    help="The number of unique problems to generate for each bank",
+)
+@click.option(
+    "workers",
+    "--workers",
+    default=cpu_count(),
+    type=int,
+    help="The number of processes to generate problems with",
+)
+@click.option("seed", "--seed", default=1337, type=int, help="The random seed")
+def cli_build_problems(
+    environments: str,
+    folder: str,
+    difficulties: str,
+    number: int,
+    workers: int,
+    seed: int,
+):
+    """Generate banks of unique problems for training.
+
+    Arguments:
+
+    "environments" is a comma separated list of environment names, e.g. "poly,complex"
+
+    "folder" is where the bank files are written. Pass it to "mathy train
+    --problem-bank" to sample problems from the banks instead of generating them.
+    """
+    import os
+    import gym
+    from mathy.envs.gym import MathyGymEnv
+    from .problem_bank import build_problem_bank, get_problem_bank_path
+
+    os.makedirs(folder, exist_ok=True)
+    header = ("Environment", "Difficulty", "Problems", "File")
+    data = []
+    for environment in environments.split(","):
+        for difficulty in difficulties.split(","):
+            env_name = f"mathy-{environment}-{difficulty}-v0"
+            env: MathyGymEnv = gym.make(env_name)
+            args = env.env_problem_args
+            assert args is not None, f"env has no problem arguments: {env_name}"
+            file_path = get_problem_bank_path(
+                folder, env.mathy.get_env_namespace(), args.difficulty
+            )
+            with msg.loading(f"Generating {number} problems for {env_name}..."):
+                count = build_problem_bank(
+                    file_path,
+                    env_class=type(env.mathy),
+                    difficulty=args.difficulty,
+                    number=number,
+                    seed=seed,
+                    workers=workers,
+                )
+            data.append((environment, difficulty, count, file_path))
+    msg.table(data, header=header, divider=True)
+    msg.good(f"Wrote problem banks to: {folder}")
 
 
 @cli.command("train")
@@ -129,6 +277,13 @@ def cli_print_problems(environment: str, difficulty: str, number: int):
     type=int,
     help="Number of worker threads to use. More increases diversity of exp",
 )
+@click.option(
+    "worker_mode",
+    "--worker-mode",
+    default="thread",
+    type=click.Choice(["thread", "process"]),
+    help="Run workers as threads, or as processes that each have a model copy",
+)
 @click.option(
     "units",
     "--units",
@@ -164,6 +319,20 @@ def cli_print_problems(environment: str, difficulty: str, number: int):
     is_flag=True,
     help="Set to gather profiler outputs for workers",
 )
+@click.option(
+    "profile_spans",
+    "--profile-spans",
+    default=False,
+    is_flag=True,
+    help="Time the env/agent hot paths and save span percentiles as JSON",
+)
+@click.option(
+    "problem_bank",
+    "--problem-bank",
+    default=None,
+    type=str,
+    help="A folder of problem banks (see 'mathy problems build') to sample from",
+)
 @click.option(
     "verbose",
     "--verbose",
@@ -176,11 +345,14 @@ def cli_train(
     folder: str,
     difficulty: str,
     workers: int,
+    worker_mode: str,
     units: int,
     embeddings: int,
     profile: bool,
+    profile_spans: bool,
     episodes: int,
     show: bool,
+    problem_bank: str,
     verbose: bool,
 ):
     """Train an agent to solve math problems and save the model.
@@ -207,12 +379,17 @@ def cli_train(
         embedding_units=embeddings,
         model_dir=folder,
         num_workers=workers,
+        worker_mode=worker_mode,
         profile=profile,
+        profile_spans=profile_spans,
         print_training=show,
     )
     if episodes is not None:
         args.max_eps = episodes
-    instance = A3CAgent(args)
+    env_extra = {}
+    if problem_bank is not None:
+        env_extra["problem_bank"] = problem_bank
+    instance = A3CAgent(args, env_extra=env_extra)
     instance.train()
 
 
@@ -1,5 +1,4 @@
 import random
-from itertools import groupby
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 import numpy as np
@@ -22,9 +21,25 @@ from mathy_core.util import (
 from .util import is_terminal_transition
 
 from . import time_step
+from .cache import ExpressionCache, ExpressionCacheEntry
+from .masks import (
+    RuleMaskCache,
+    SparseActionMask,
+    get_candidate_indices,
+    get_rule_node_types,
+    index_nodes_by_type,
+    is_local_mask_rule,
+    rule_applies_to_class,
+    to_action_mask,
+    to_valid_actions,
+)
+from .spans import spans
 from .state import MathyEnvState, MathyEnvStateStep, MathyObservation
 from .types import EnvRewards, MathyEnvProblem, MathyEnvProblemArgs
 
+# The shared core rule instances, keyed by their "preferred_term_commute" option
+_CORE_RULES: Dict[bool, Tuple[BaseRule, ...]] = {}
+
 
 class MathyEnv:
     """Implement a math solving game where a player wins by executing the
@@ -36,8 +51,9 @@ class MathyEnv:
     verbose: bool
     reward_discount: float
     parser: ExpressionParser
-    valid_actions_mask_cache: Dict[str, List[int]]
-    valid_rules_cache: Dict[str, List[int]]
+    expression_cache: ExpressionCache
+    mask_cache: Optional[RuleMaskCache]
+    reuse_trees: bool
 
     def __init__(
         self,
@@ -46,30 +62,44 @@ class MathyEnv:
         verbose: bool = False,
         error_invalid: bool = False,
         reward_discount: float = 0.99,
+        expression_cache_size: int = 1024,
+        incremental_masks: bool = False,
+        reuse_trees: bool = True,
     ):
         self.discount = reward_discount
         self.verbose = verbose
         self.max_moves = max_moves
         self.error_invalid = error_invalid
+        self.reuse_trees = reuse_trees
         self.parser = ExpressionParser()
+        self.expression_cache = ExpressionCache(
+            self.parser, capacity=expression_cache_size
+        )
         if rules is None:
             self.rules = MathyEnv.core_rules()
         else:
             self.rules = rules
-        self.valid_actions_mask_cache = dict()
-        self.valid_rules_cache = dict()
+        self.mask_cache = RuleMaskCache(self.rules) if incremental_masks else None
+        self._scan_rules: Dict[type, List[Tuple[int, BaseRule]]] = {}
 
     @classmethod
     def core_rules(cls, preferred_term_commute: bool = False) -> List[BaseRule]:
-        """Return the mathy core agent actions"""
-        return [
-            ConstantsSimplifyRule(),
-            CommutativeSwapRule(preferred=preferred_term_commute),
-            DistributiveMultiplyRule(),
-            DistributiveFactorOutRule(),
-            AssociativeSwapRule(),
-            VariableMultiplyRule(),
-        ]
+        """Return the mathy core agent actions.
+
+        The rules only hold their constructor options, so the same instances
+        are shared by every environment. The returned list is a new one each
+        call."""
+        rules = _CORE_RULES.get(preferred_term_commute, None)
+        if rules is None:
+            rules = _CORE_RULES[preferred_term_commute] = (
+                ConstantsSimplifyRule(),
+                CommutativeSwapRule(preferred=preferred_term_commute),
+                DistributiveMultiplyRule(),
+                DistributiveFactorOutRule(),
+                AssociativeSwapRule(),
+                VariableMultiplyRule(),
+            )
+        return list(rules)
 
     @property
     def action_size(self) -> int:
@@ -136,10 +166,22 @@ class MathyEnv:
 
     def state_to_observation(self, state: MathyEnvState,) -> MathyObservation:
         """Convert an environment state into an observation that can be used
-        by a training agent."""
-
-        action_mask = self.get_valid_moves(state)
-        observation = state.to_observation(move_mask=action_mask, parser=self.parser)
+        by a training agent.
+
+        The observation is cached on the state, so the transition, the gym
+        wrappers and the agent all share a single featurization of each state.
+        Treat it as read-only."""
+        observation = state.get_cached_observation(self)
+        if observation is not None:
+            return observation
+        entry = self.get_cached_expression(state.agent.problem)
+        # The mask stays sparse until the observation is batched into inputs
+        action_mask = SparseActionMask(
+            self.get_valid_actions(state), len(entry.inorder) * len(self.rules)
+        )
+        with spans.span("env/featurize"):
+            observation = state.to_observation(move_mask=action_mask, nodes=entry.nodes)
+        state.set_cached_observation(self, observation)
         return observation
 
     def get_win_signal(self, env_state: MathyEnvState) -> float:
@@ -172,10 +214,9 @@ class MathyEnv:
             transition: the current state value transition
         """
         agent = env_state.agent
-        expression = self.parser.parse(agent.problem)
-        features = env_state.to_observation(
-            self.get_valid_moves(env_state), parser=self.parser
-        )
+        entry = self.get_cached_expression(agent.problem)
+        expression = entry.expression
+        features = self.state_to_observation(env_state)
         root = expression.get_root()
 
         # Subclass specific win conditions happen here. Custom win-conditions
@@ -190,17 +231,12 @@ class MathyEnv:
             return time_step.termination(features, self.get_lose_signal(env_state))
 
         # The agent is penalized for returning to a previous state.
-        for key, group in groupby(
-            sorted([f"{h.raw}" for h in env_state.agent.history])
-        ):
-            list_count = len(list(group))
-            if list_count <= 1 or key != expression.raw:
-                continue
-
+        visits = agent.get_visits(expression.raw)
+        if visits > 1:
             # NOTE: the reward is scaled by how many times this state has been visited
             return time_step.transition(
                 features,
-                reward=EnvRewards.PREVIOUS_LOCATION * list_count,
+                reward=EnvRewards.PREVIOUS_LOCATION * visits,
                 discount=self.discount,
             )
 
@@ -248,9 +284,10 @@ class MathyEnv:
         change: the change descriptor describing the change that happened
         """
         agent = env_state.agent
-        expression = self.parser.parse(agent.problem)
+        entry = self.get_cached_expression(agent.problem)
+        expression = entry.expression
         action_index, token_index = self.get_action_indices(action)
-        token = self.get_token_at_index(expression, token_index)
+        token = entry.token_at(token_index)
         operation = self.rules[action_index]
 
         op_not_rule = not isinstance(operation, BaseRule)
@@ -264,21 +301,35 @@ class MathyEnv:
                 raise_with_history("Invalid Action", msg, agent.history)
                 raise ValueError(f"Invalid Action: {msg}")
             else:
-                valid_mask = self.get_valid_moves(env_state)
                 # Non-masked searches ignore invalid moves entirely
                 out_env = MathyEnvState.copy(env_state)
                 out_env.action = -1
-                obs = out_env.to_observation(
-                    self.get_valid_moves(out_env), parser=self.parser
-                )
+                obs = self.state_to_observation(out_env)
                 transition = time_step.transition(obs, EnvRewards.INVALID_MOVE)
                 return out_env, transition, ExpressionChangeRule(BaseRule())
 
-        change = operation.apply_to(token.clone_from_root())
+        with spans.span("env/apply_rule"):
+            change = operation.apply_to(token.clone_from_root())
         assert change.result is not None
         root = change.result.get_root()
         change_name = operation.name
         out_problem = str(root)
+        if self.reuse_trees:
+            # The rule built the next state's tree from a clone, so cache it
+            # rather than parsing the text again when the next state is used
+            out_entry = self.expression_cache.put(out_problem, root)
+            if (
+                self.mask_cache is not None
+                and out_entry.expression is root
+                and out_entry.valid_actions is None
+                and entry.valid_actions is not None
+                and is_local_mask_rule(operation)
+            ):
+                # The rule only rewrote the subtree at its result, so the next
+                # mask can reuse the rows of this one for the other nodes
+                out_entry.mask_update = self.mask_cache.get_update(
+                    entry.valid_actions, expression, change.result
+                )
         out_env = env_state.get_out_state(
             problem=out_problem,
             focus=token_index,
@@ -375,8 +426,7 @@ class MathyEnv:
         token = "{}".format(token_index).zfill(3)
         moves_left = str(env_state.agent.moves_remaining).zfill(2)
         valid_rules = self.get_valid_rules(env_state)
-        valid_moves = self.get_valid_moves(env_state)
-        num_moves = "{}".format(len(np.nonzero(valid_moves)[0])).zfill(3)
+        num_moves = "{}".format(len(self.get_valid_actions(env_state))).zfill(3)
         move_codes = [get_move_shortname(i, m) for i, m in enumerate(valid_rules)]
         moves = " ".join(move_codes)
         reward = f"{change_reward:.2}"
@@ -414,14 +464,23 @@ class MathyEnv:
         return action
 
     def get_initial_state(
-        self, params: Optional[MathyEnvProblemArgs] = None, print_problem: bool = True
+        self,
+        params: Optional[MathyEnvProblemArgs] = None,
+        print_problem: bool = True,
+        problem: Optional[MathyEnvProblem] = None,
     ) -> Tuple[MathyEnvState, MathyEnvProblem]:
-        """Generate an initial MathyEnvState for an episode"""
+        """Generate an initial MathyEnvState for an episode.
+
+        # Arguments
+        params (MathyEnvProblemArgs): The arguments to generate a problem with
+        print_problem (bool): Print the initial state when the env is verbose
+        problem (MathyEnvProblem): Start from this problem (e.g. one sampled from
+            a `ProblemBank`) rather than generating a new one
+        """
         config = params if params is not None else MathyEnvProblemArgs()
-        prob: MathyEnvProblem = self.problem_fn(config)
-        self.valid_actions_mask_cache = dict()
-        self.valid_rules_cache = dict()
-        self.parser.clear_cache()
+        prob: MathyEnvProblem = problem if problem is not None else self.problem_fn(
+            config
+        )
         self.max_moves = self.max_moves_fn(prob, config)
 
         # Build and return the initial state
@@ -437,13 +496,20 @@ class MathyEnv:
 
     def get_agent_actions_count(self, env_state: MathyEnvState) -> int:
         """Return number of all possible actions"""
-        node_count = len(self.parser.parse(env_state.agent.problem).to_list())
+        node_count = len(self.get_cached_expression(env_state.agent.problem).inorder)
         return self.action_size * node_count
 
     def get_token_at_index(
         self, expression: MathExpression, index: int
     ) -> Optional[MathExpression]:
-        """Get the token that is `index` from the left of the expression"""
+        """Get the token that is `index` from the left of the expression.
+
+        !!! note
+
+            This visits the tree to find the token. Expressions from the env's
+            cache (see `get_cached_expression`) have an inorder node index, so
+            prefer `ExpressionCacheEntry.token_at` for O(1) lookups.
+        """
         count = 0
         result = None
 
@@ -462,9 +528,25 @@ class MathyEnv:
          with 1/0 indicating whether the action at that index is valid
          for the current state.
         """
-        agent = env_state.agent
-        expression = self.parser.parse(agent.problem)
-        return self.get_actions_for_node(expression)
+        entry = self.get_cached_expression(env_state.agent.problem)
+        return to_action_mask(
+            self.get_valid_actions(env_state), len(entry.inorder) * len(self.rules)
+        )
+
+    def get_valid_actions(self, env_state: MathyEnvState) -> Tuple[int, ...]:
+        """Get the sorted indices of the valid actions for the current state.
+
+        This is the sparse form of `get_valid_moves`. Usually only a few of the
+        `nodes * rules` actions are valid, so it's smaller and cheaper to pass
+        around than the full mask. The tuple is shared with the expression
+        cache, which is why it is immutable."""
+        entry = self.get_cached_expression(env_state.agent.problem)
+        if entry.valid_actions is None:
+            with spans.span("env/valid_moves"):
+                actions = self.get_actions_for_entry(entry)
+                entry.valid_actions = to_valid_actions(actions)
+                entry.mask_update = None
+        return entry.valid_actions
 
     def get_valid_rules(self, env_state: MathyEnvState) -> List[int]:
         """Get a vector the length of the number of valid rules that is
@@ -476,16 +558,15 @@ class MathyEnv:
             If you want to get a list of which nodes each rule can be
             applied to, prefer to use the `get_valid_moves` method.
         """
-        key = self.to_hash_key(env_state)
-        if key in self.valid_rules_cache:
-            return self.valid_rules_cache[key]
-        expression = self.parser.parse(env_state.agent.problem)
-        actions = [0] * len(self.rules)
-        for rule_index, rule in enumerate(self.rules):
-            nodes = rule.find_nodes(expression)
-            actions[rule_index] = 0 if len(nodes) == 0 else 1
-        self.valid_rules_cache[key] = actions[:]
-        return actions
+        entry = self.get_cached_expression(env_state.agent.problem)
+        if entry.valid_rules is None:
+            # Fold the valid actions down to one value per rule
+            rule_count = len(self.rules)
+            actions = [0] * rule_count
+            for action in self.get_valid_actions(env_state):
+                actions[action % rule_count] = 1
+            entry.valid_rules = actions
+        return entry.valid_rules[:]
 
     def get_action_indices(self, action: int) -> Tuple[int, int]:
         """Get the normalized action/node_index values from a
@@ -510,23 +591,81 @@ class MathyEnv:
         Action masks are 1d lists of length (nodes * num_rules) where a 0 indicates
         the action is not valid in the current state, and a 1 indicates that it is
         a valid action to take."""
-        key = str(expression)
-        if rule_list is None and key in self.valid_actions_mask_cache:
-            return self.valid_actions_mask_cache[key][:]
-        node_count = len(expression.to_list())
+        nodes: List[MathExpression] = expression.to_list("inorder")
         rule_count = len(self.rules)
-        actions = [0] * rule_count * node_count
+        actions = [0] * rule_count * len(nodes)
+        by_type = None
         for rule_index, rule in enumerate(self.rules):
             if rule_list is not None and not isinstance(rule, tuple(rule_list)):
                 continue
-            nodes = rule.find_nodes(expression)
-            for node in nodes:
-                action_index = (node.r_index * rule_count) + rule_index
-                actions[action_index] = 1
-        if rule_list is None:
-            self.valid_actions_mask_cache[key] = actions[:]
+            node_types = get_rule_node_types(rule)
+            if node_types is None or type(rule).find_nodes is not BaseRule.find_nodes:
+                for node in rule.find_nodes(expression):
+                    actions[(node.r_index * rule_count) + rule_index] = 1
+                continue
+            # Only check the nodes whose type the rule can apply to
+            if by_type is None:
+                for node_index, node in enumerate(nodes):
+                    node.r_index = node_index
+                by_type = index_nodes_by_type(nodes)
+            for node_index in get_candidate_indices(by_type, node_types):
+                if rule.can_apply_to(nodes[node_index]):
+                    actions[(node_index * rule_count) + rule_index] = 1
         return actions
 
+    def get_actions_for_entry(self, entry: ExpressionCacheEntry) -> List[int]:
+        """Return a valid actions mask for a cached expression.
+
+        This produces the same mask as `get_actions_for_node`, but walks the
+        entry's inorder node index once instead of visiting the tree for
+        every rule. When the env has a `mask_cache` and the entry was built by
+        a rule from an earlier one, the core rules are only checked against the
+        nodes whose context the rule changed (see `mathy.masks.RuleMaskCache`)."""
+        nodes = entry.inorder
+        rule_count = len(self.rules)
+        actions = [0] * rule_count * len(nodes)
+        if self.mask_cache is not None:
+            self.mask_cache.fill_actions(nodes, actions, entry.mask_update)
+        # Rules with custom node searches keep using them
+        for rule_index, rule in enumerate(self.rules):
+            if type(rule).find_nodes is not BaseRule.find_nodes:
+                for node in rule.find_nodes(entry.expression):
+                    actions[(node.r_index * rule_count) + rule_index] = 1
+        # Only check each node against the rules that can apply to its type
+        for node_class, indices in entry.by_type.items():
+            class_rules = self._scan_rules.get(node_class, None)
+            if class_rules is None:
+                class_rules = self.get_scan_rules(node_class)
+            if len(class_rules) == 0:
+                continue
+            for node_index in indices:
+                node = nodes[node_index]
+                offset = node_index * rule_count
+                for rule_index, rule in class_rules:
+                    if rule.can_apply_to(node):
+                        actions[offset + rule_index] = 1
+        return actions
+
+    def get_scan_rules(self, node_class: type) -> List[Tuple[int, BaseRule]]:
+        """Return the (index, rule) pairs that `get_actions_for_entry` checks
+        against each node of a given class. Rules with custom node searches and
+        rules whose masks come from the `mask_cache` are left out."""
+        cached_rules = self.mask_cache.local_rules if self.mask_cache else []
+        scan_rules = [
+            (rule_index, rule)
+            for rule_index, rule in enumerate(self.rules)
+            if rule_index not in cached_rules
+            and type(rule).find_nodes is BaseRule.find_nodes
+            and rule_applies_to_class(rule, node_class)
+        ]
+        self._scan_rules[node_class] = scan_rules
+        return scan_rules
+
+    def get_cached_expression(self, problem: str) -> ExpressionCacheEntry:
+        """Return the parsed expression (and derived values) for the given problem
+        text from the environment's LRU expression cache."""
+        return self.expression_cache.get(problem)
+
     def to_hash_key(self, env_state: MathyEnvState) -> str:
         """Convert env_state to a string for MCTS cache"""
         return env_state.agent.problem
@@ -1,10 +1,84 @@
+"""Gym environments for each of the builtin Mathy environments.
+
+The environments are registered with gym when this package is imported, but
+the modules that define them are only imported when an environment is made
+(or one of their classes is accessed)."""
+from typing import Dict, List, Tuple
+
+from ...util import install_lazy_attributes
+from .env_pool import *  # noqa
 from .mathy_gym_env import *  # noqa
 from .masked_discrete import *  # noqa
-from .gym_binomial_distribute import *  # noqa
-from .gym_complex_simplify import *  # noqa
-from .gym_poly_blockers import *  # noqa
-from .gym_poly_grouping import *  # noqa
-from .gym_poly_haystack_like_terms import *  # noqa
-from .gym_poly_simplify import *  # noqa
-from .gym_poly_combine_in_place import *  # noqa
-from .gym_poly_commute_like_terms import *  # noqa
+from .mathy_vector_env import *  # noqa
+from .mathy_gym_env import safe_register
+
+# Each module that defines gym environments, with the base class it defines,
+# and the prefixes of its environment ids and class names. Every module has an
+# easy, normal and hard environment, e.g. "mathy-poly-easy-v0" makes the
+# "PolynomialsEasy" class.
+_GYM_ENV_MODULES: List[Tuple[str, str, str, str]] = [
+    (
+        ".gym_binomial_distribute",
+        "GymBinomialDistribution",
+        "mathy-binomial",
+        "Binomials",
+    ),
+    (".gym_complex_simplify", "GymComplexTerms", "mathy-complex", "ComplexTerms"),
+    (
+        ".gym_poly_blockers",
+        "GymPolynomialBlockers",
+        "mathy-poly-blockers",
+        "PolynomialBlockers",
+    ),
+    (
+        ".gym_poly_combine_in_place",
+        "GymPolynomialCombineInPlace",
+        "mathy-poly-combine",
+        "PolynomialCombineInPlace",
+    ),
+    (
+        ".gym_poly_commute_like_terms",
+        "GymPolynomialCommuteLikeTerms",
+        "mathy-poly-commute",
+        "PolynomialCommuteLikeTerms",
+    ),
+    (
+        ".gym_poly_grouping",
+        "GymPolynomialGrouping",
+        "mathy-poly-grouping",
+        "PolynomialGrouping",
+    ),
+    (
+        ".gym_poly_haystack_like_terms",
+        "GymPolynomialLikeTermsHaystack",
+        "mathy-poly-like-terms-haystack",
+        "PolynomialLikeTermsHaystack",
+    ),
+    (".gym_poly_simplify", "GymPolynomialSimplification", "mathy-poly", "Polynomials"),
+]
+_DIFFICULTIES = ["easy", "normal", "hard"]
+
+# The gym environment ids and the class names they make
+MATHY_GYM_ENVS: List[Tuple[str, str]] = []
+_LAZY_CLASSES: Dict[str, str] = {}
+for _module, _base_class, _id_prefix, _class_prefix in _GYM_ENV_MODULES:
+    _LAZY_CLASSES[_base_class] = _module
+    for _difficulty in _DIFFICULTIES:
+        _class_name = f"{_class_prefix}{_difficulty.capitalize()}"
+        MATHY_GYM_ENVS.append((f"{_id_prefix}-{_difficulty}-v0", _class_name))
+        _LAZY_CLASSES[_class_name] = _module
+
+for _env_id, _class_name in MATHY_GYM_ENVS:
+    safe_register(id=_env_id, entry_point=f"mathy.envs.gym:{_class_name}")
+
+install_lazy_attributes(globals(), _LAZY_CLASSES)
+__all__ = [
+    "MATHY_GYM_ENVS",
+    "MaskedDiscrete",
+    "MathyGymEnvPool",
+    "MathyGymEnv",
+    "MathyNumpyObservation",
+    "MathyVectorEnv",
+    "ObservationCapacityError",
+    "safe_register",
+] + list(_LAZY_CLASSES.keys())
@@ -0,0 +1,46 @@
+from typing import Any, Dict, Optional
+
+import gym
+
+from .mathy_gym_env import MathyGymEnv
+
+
+class MathyGymEnvPool:
+    """Make each gym environment once and reuse it for every later episode.
+
+    Making a Mathy gym env builds a new `MathyEnv` with its own parser, rules
+    and expression caches. Workers that play many short episodes can get the
+    env for each episode from a pool instead, so those are built once per env
+    id and the caches stay warm between episodes. `reset` starts a new episode
+    in a reused env.
+
+    A pool isn't thread-safe, so each worker should use its own.
+
+    # Arguments
+    env_kwargs (dict): The keyword arguments to pass to `gym.make`
+    """
+
+    env_kwargs: Dict[str, Any]
+
+    def __init__(self, env_kwargs: Optional[Dict[str, Any]] = None):
+        self.env_kwargs = dict(env_kwargs or {})
+        self._envs: Dict[str, MathyGymEnv] = {}
+
+    def __len__(self) -> int:
+        return len(self._envs)
+
+    def __contains__(self, env_id: str) -> bool:
+        return env_id in self._envs
+
+    def get(self, env_id: str) -> MathyGymEnv:
+        """Return the pool's env for the given gym id, making it if needed"""
+        env = self._envs.get(env_id, None)
+        if env is None:
+            env = self._envs[env_id] = gym.make(env_id, **self.env_kwargs)
+        return env
+
+    def clear(self) -> None:
+        """Close and remove all of the pool's envs"""
+        for env in self._envs.values():
+            env.close()
+        self._envs.clear()
@@ -2,7 +2,7 @@ from gym.envs.registration import register
 
 from ..binomial_distribute import BinomialDistribute
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 
 class GymBinomialDistribution(MathyGymEnv):
@@ -33,8 +33,3 @@ class BinomialsHard(GymBinomialDistribution):
         super(BinomialsHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(id="mathy-binomial-easy-v0", entry_point="mathy.envs.gym:BinomialsEasy")
-safe_register(id="mathy-binomial-normal-v0", entry_point="mathy.envs.gym:BinomialsNormal")
-safe_register(id="mathy-binomial-hard-v0", entry_point="mathy.envs.gym:BinomialsHard")
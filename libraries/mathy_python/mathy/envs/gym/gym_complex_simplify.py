@@ -1,6 +1,6 @@
 from ..complex_simplify import ComplexSimplify
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 
 class GymComplexTerms(MathyGymEnv):
@@ -31,9 +31,3 @@ class ComplexTermsHard(GymComplexTerms):
         super(ComplexTermsHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(id="mathy-complex-easy-v0", entry_point="mathy.envs.gym:ComplexTermsEasy")
-safe_register(id="mathy-complex-normal-v0", entry_point="mathy.envs.gym:ComplexTermsNormal")
-safe_register(id="mathy-complex-hard-v0", entry_point="mathy.envs.gym:ComplexTermsHard")
-
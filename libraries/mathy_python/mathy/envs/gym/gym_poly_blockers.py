@@ -1,6 +1,6 @@
 from ..poly_simplify_blockers import PolySimplifyBlockers
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 #
 # Commute + simplify with blockers
@@ -35,17 +35,3 @@ class PolynomialBlockersHard(GymPolynomialBlockers):
         super(PolynomialBlockersHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(
-    id="mathy-poly-blockers-easy-v0",
-    entry_point="mathy.envs.gym:PolynomialBlockersEasy",
-)
-safe_register(
-    id="mathy-poly-blockers-normal-v0",
-    entry_point="mathy.envs.gym:PolynomialBlockersNormal",
-)
-safe_register(
-    id="mathy-poly-blockers-hard-v0",
-    entry_point="mathy.envs.gym:PolynomialBlockersHard",
-)
@@ -1,6 +1,6 @@
 from ..poly_combine_in_place import PolyCombineInPlace
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 #
 # Combine like terms without commuting
@@ -35,17 +35,3 @@ class PolynomialCombineInPlaceHard(GymPolynomialCombineInPlace):
         super(PolynomialCombineInPlaceHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(
-    id="mathy-poly-combine-easy-v0",
-    entry_point="mathy.envs.gym:PolynomialCombineInPlaceEasy",
-)
-safe_register(
-    id="mathy-poly-combine-normal-v0",
-    entry_point="mathy.envs.gym:PolynomialCombineInPlaceNormal",
-)
-safe_register(
-    id="mathy-poly-combine-hard-v0",
-    entry_point="mathy.envs.gym:PolynomialCombineInPlaceHard",
-)
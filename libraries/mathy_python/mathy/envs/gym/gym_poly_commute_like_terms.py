@@ -1,6 +1,6 @@
 from ..poly_commute_like_terms import PolyCommuteLikeTerms
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 #
 # Combine like terms without commuting
@@ -35,17 +35,3 @@ class PolynomialCommuteLikeTermsHard(GymPolynomialCommuteLikeTerms):
         super(PolynomialCommuteLikeTermsHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(
-    id="mathy-poly-commute-easy-v0",
-    entry_point="mathy.envs.gym:PolynomialCommuteLikeTermsEasy",
-)
-safe_register(
-    id="mathy-poly-commute-normal-v0",
-    entry_point="mathy.envs.gym:PolynomialCommuteLikeTermsNormal",
-)
-safe_register(
-    id="mathy-poly-commute-hard-v0",
-    entry_point="mathy.envs.gym:PolynomialCommuteLikeTermsHard",
-)
@@ -1,6 +1,6 @@
 from ..poly_grouping import PolyGroupLikeTerms
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 #
 # Group like terms
@@ -35,17 +35,3 @@ class PolynomialGroupingHard(GymPolynomialGrouping):
         super(PolynomialGroupingHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(
-    id="mathy-poly-grouping-easy-v0",
-    entry_point="mathy.envs.gym:PolynomialGroupingEasy",
-)
-safe_register(
-    id="mathy-poly-grouping-normal-v0",
-    entry_point="mathy.envs.gym:PolynomialGroupingNormal",
-)
-safe_register(
-    id="mathy-poly-grouping-hard-v0",
-    entry_point="mathy.envs.gym:PolynomialGroupingHard",
-)
@@ -1,6 +1,6 @@
 from ..poly_haystack_like_terms import PolyHaystackLikeTerms
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 #
 # Identify like terms in a haystack
@@ -35,17 +35,3 @@ class PolynomialLikeTermsHaystackHard(GymPolynomialLikeTermsHaystack):
         super(PolynomialLikeTermsHaystackHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(
-    id="mathy-poly-like-terms-haystack-easy-v0",
-    entry_point="mathy.envs.gym:PolynomialLikeTermsHaystackEasy",
-)
-safe_register(
-    id="mathy-poly-like-terms-haystack-normal-v0",
-    entry_point="mathy.envs.gym:PolynomialLikeTermsHaystackNormal",
-)
-safe_register(
-    id="mathy-poly-like-terms-haystack-hard-v0",
-    entry_point="mathy.envs.gym:PolynomialLikeTermsHaystackHard",
-)
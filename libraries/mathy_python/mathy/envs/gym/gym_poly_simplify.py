@@ -1,6 +1,6 @@
 from ..poly_simplify import PolySimplify
 from ...types import MathyEnvDifficulty, MathyEnvProblemArgs
-from .mathy_gym_env import MathyGymEnv, safe_register
+from .mathy_gym_env import MathyGymEnv
 
 
 class GymPolynomialSimplification(MathyGymEnv):
@@ -31,8 +31,3 @@ class PolynomialsHard(GymPolynomialSimplification):
         super(PolynomialsHard, self).__init__(
             difficulty=MathyEnvDifficulty.hard, **kwargs
         )
-
-
-safe_register(id="mathy-poly-easy-v0", entry_point="mathy.envs.gym:PolynomialsEasy")
-safe_register(id="mathy-poly-normal-v0", entry_point="mathy.envs.gym:PolynomialsNormal")
-safe_register(id="mathy-poly-hard-v0", entry_point="mathy.envs.gym:PolynomialsHard")
@@ -1,3 +1,5 @@
+from typing import Sequence
+
 from gym import spaces
 import numpy as np
 
@@ -6,15 +8,38 @@ class MaskedDiscrete(spaces.Discrete):
     r"""A masked discrete space in :math:`\{ 0, 1, \\dots, n-1 \}`.
     Example::
         >>> MaskedDiscrete(3, mask=(1,1,0))
+
+    The space stores the sorted indices of its valid actions, because usually
+    only a few of the `n` actions are valid. The dense `mask` is built when it
+    is read.
     """
-    mask: np.array
+    valid_actions: np.ndarray
 
     def __init__(self, n, mask):
         assert isinstance(mask, (tuple, list))
         assert len(mask) == n
-        self.mask = np.array(mask)
         super(MaskedDiscrete, self).__init__(n)
+        self.mask = mask
+
+    @property
+    def mask(self) -> np.ndarray:
+        """0/1 mask where 0 indicates an invalid action shape=[n,]"""
+        mask = np.zeros((self.n,), dtype=np.int64)
+        mask[self.valid_actions] = 1
+        return mask
+
+    @mask.setter
+    def mask(self, mask: Sequence[int]) -> None:
+        self.valid_actions = np.flatnonzero(np.asarray(mask))
+
+    def set_valid_actions(self, n: int, actions: Sequence[int]) -> None:
+        """Resize the space to `n` actions, where only the given sorted action
+        indices are valid"""
+        self.n = n
+        self.valid_actions = np.asarray(actions, dtype=np.int64)
 
     def sample(self):
-        probability = self.mask / np.sum(self.mask)
-        return self.np_random.choice(self.n, p=probability)
+        if len(self.valid_actions) == 0:
+            raise ValueError("there are no valid actions to sample from")
+        index = self.np_random.randint(len(self.valid_actions))
+        return int(self.valid_actions[index])
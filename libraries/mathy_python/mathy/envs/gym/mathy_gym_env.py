@@ -1,21 +1,45 @@
 import math
-from typing import List, Optional, Type, Union
+from typing import Any, List, Optional, Tuple, Type, Union
 
 import gym
 import numpy as np
+from gym import spaces
 from gym.envs.registration import register
+from mathy_core.expressions import MathTypeKeysMax
 from mathy_core.rule import ExpressionChangeRule
 
 from ...env import MathyEnv
 from ...state import MathyEnvState, MathyObservation
 from ...types import MathyEnvProblemArgs
-from ...util import is_terminal_transition, pad_array
+from ...util import is_terminal_transition
 from .masked_discrete import MaskedDiscrete
 
+# The (nodes, mask) arrays returned when the env is made with np_observation=True
+MathyNumpyObservation = Tuple[np.ndarray, np.ndarray]
+
+
+class ObservationCapacityError(ValueError):
+    """Raised when a state has more nodes than the fixed-size NumPy observation
+    buffers of a MathyGymEnv can hold"""
+
 
 class MathyGymEnv(gym.Env):
     """A small wrapper around Mathy envs to allow them to work with OpenAI Gym. The
-    agents currently use this env wrapper, but it could be dropped in the future. """
+    agents currently use this env wrapper, but it could be dropped in the future.
+
+    With `np_observation=True` observations are a tuple of two NumPy arrays
+    instead of `MathyObservation`s:
+
+    - `nodes` (int16) with shape `[np_capacity]` holds the tree node types
+    - `mask` with shape `[np_capacity * num_rules]` holds the valid actions.
+      A float mask holds each valid action's probability of being picked at
+      random (1 / number of valid actions). An integer mask holds 1 for each
+      valid action.
+
+    The arrays are allocated once per env and overwritten by every step or
+    reset, so copy them if you need to keep them. States with more than
+    `np_capacity` nodes raise an `ObservationCapacityError`.
+    """
 
     mathy: MathyEnv
     state: Optional[MathyEnvState]
@@ -30,21 +54,52 @@ class MathyGymEnv(gym.Env):
         env_problem: Optional[str] = None,
         env_max_moves: int = 64,
         np_observation: bool = False,
+        np_capacity: int = 512,
+        np_mask_dtype: Union[str, type] = "float32",
         repeat_problem: bool = False,
+        problem_bank: Optional[Any] = None,
+        problem_bank_seed: Optional[int] = None,
         **env_kwargs,
     ):
         self.state = None
         self.repeat_problem = repeat_problem
         self.np_observation = np_observation
+        self.np_capacity = np_capacity
         self.mathy = env_class(**env_kwargs)
+        if np_observation:
+            num_rules = self.mathy.action_size
+            mask_dtype = np.dtype(np_mask_dtype)
+            nodes_shape = (np_capacity,)
+            mask_shape = (np_capacity * num_rules,)
+            self.observation_space = spaces.Tuple(
+                (
+                    spaces.Box(0, MathTypeKeysMax, shape=nodes_shape, dtype=np.int16),
+                    spaces.Box(0, 1, shape=mask_shape, dtype=mask_dtype),
+                )
+            )
+            self._np_nodes = np.zeros(nodes_shape, dtype=np.int16)
+            self._np_mask = np.zeros(mask_shape, dtype=mask_dtype)
+            # The parts of the buffers the last observation wrote to
+            self._np_length = 0
+            self._np_actions: Tuple[int, ...] = ()
         self.env_class = env_class
         self.env_problem_args = env_problem_args
+        self.problem_bank = None
+        if problem_bank is not None:
+            from ...problem_bank import load_problem_bank
+
+            args = env_problem_args or MathyEnvProblemArgs()
+            self.problem_bank = load_problem_bank(
+                problem_bank, self.mathy, args.difficulty
+            )
+            self._bank_rng = np.random.RandomState(problem_bank_seed)
+        # The problem that is repeated when `repeat_problem` is set. A random
+        # one is only generated by the first reset that needs it.
+        self._challenge = None
         if env_problem is not None:
             self._challenge = MathyEnvState(
                 problem=env_problem, max_moves=env_max_moves
             )
-        else:
-            self._challenge, _ = self.mathy.get_initial_state(env_problem_args)
         self.action_space = MaskedDiscrete(self.action_size, [1] * self.action_size)
 
     @property
@@ -66,31 +121,59 @@ class MathyGymEnv(gym.Env):
             info["win"] = transition.reward > 0.0
         return self._observe(self.state), transition.reward, done, info
 
-    def _observe(self, state: MathyEnvState) -> Union[MathyObservation, np.ndarray]:
+    def _observe(
+        self, state: MathyEnvState
+    ) -> Union[MathyObservation, MathyNumpyObservation]:
         """Observe the environment at the given state, updating the observation
         space and action space for the given state. """
-        action_mask = self.mathy.get_valid_moves(state)
+        valid_actions = self.mathy.get_valid_actions(state)
         observation = self.mathy.state_to_observation(state)
-        self.action_space.n = self.mathy.get_agent_actions_count(state)
-        self.action_space.mask = action_mask
+        self.action_space.set_valid_actions(
+            self.mathy.get_agent_actions_count(state), valid_actions
+        )
         if self.np_observation:
-            # convert mask to probabilities
-            nodes = np.array(pad_array(observation.nodes, 512, 0))
-            mask = np.array(pad_array(observation.mask, 512, 0))
-            mask_sum = np.sum(mask)
-            if mask_sum > 0.0:
-                mask = mask / mask_sum
-            return np.vstack((nodes, mask))
+            return self._write_np_observation(observation, valid_actions)
         return observation
 
+    def _write_np_observation(
+        self, observation: MathyObservation, valid_actions: Tuple[int, ...]
+    ) -> MathyNumpyObservation:
+        """Write an observation into the env's NumPy buffers, only clearing the
+        values the previous observation wrote."""
+        length = len(observation.nodes)
+        if length > self.np_capacity:
+            raise ObservationCapacityError(
+                f"state has {length} nodes, but the observation buffers can only "
+                f"hold {self.np_capacity}. Pass a larger 'np_capacity' to the env."
+            )
+        nodes, mask = self._np_nodes, self._np_mask
+        nodes[length : self._np_length] = 0
+        nodes[:length] = observation.nodes
+        mask[list(self._np_actions)] = 0
+        if len(valid_actions) > 0:
+            if np.issubdtype(mask.dtype, np.floating):
+                mask[list(valid_actions)] = 1.0 / len(valid_actions)
+            else:
+                mask[list(valid_actions)] = 1
+        self._np_length = length
+        self._np_actions = valid_actions
+        return nodes, mask
+
     def reset(self):
         if self.state is not None:
             self.mathy.finalize_state(self.state)
         if self.repeat_problem:
+            if self._challenge is None:
+                self._challenge, _ = self.mathy.get_initial_state(
+                    self.env_problem_args
+                )
             self.state = MathyEnvState.copy(self._challenge)
         else:
+            problem = None
+            if self.problem_bank is not None:
+                problem = self.problem_bank.sample(self._bank_rng)
             self.state, self.problem = self.mathy.get_initial_state(
-                self.env_problem_args
+                self.env_problem_args, problem=problem
             )
         return self._observe(self.state)
 
@@ -0,0 +1,190 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from ...env import MathyEnv
+from ...state import (
+    MathyArrayWindowObservation,
+    MathyEnvState,
+    MathyObservation,
+    ObservationWindowBuffer,
+)
+from ...types import MathyEnvProblemArgs
+from ...util import is_terminal_transition
+
+
+class MathyVectorEnv:
+    """Step a batch of Mathy episodes together so that a single model forward
+    pass can select actions for every live episode.
+
+    All episodes share one `MathyEnv` instance (and its parser/caches) and the
+    observations for the batch are written directly into stacked NumPy arrays,
+    rather than being padded one Python list at a time.
+
+    # Arguments
+    env_class (Type[MathyEnv]): The mathy environment type to step. It must
+        generate problems (implement `problem_fn`) so episodes can be reset.
+    num_envs (int): The number of episodes to run in parallel
+    env_problem_args (MathyEnvProblemArgs): Problem generation arguments
+    auto_reset (bool): When true, episodes that finish are immediately reset
+        and the new episode's first observation is returned in their slot.
+    mathy (MathyEnv): An existing env to step instead of making one from
+        `env_class`, so that it shares its caches with other users
+    """
+
+    mathy: MathyEnv
+    num_envs: int
+    states: List[MathyEnvState]
+    env_problem_args: Optional[MathyEnvProblemArgs]
+
+    def __init__(
+        self,
+        env_class: Optional[Type[MathyEnv]] = None,
+        num_envs: int = 8,
+        env_problem_args: Optional[MathyEnvProblemArgs] = None,
+        auto_reset: bool = True,
+        mathy: Optional[MathyEnv] = None,
+        **env_kwargs,
+    ):
+        assert num_envs > 0, "num_envs must be a positive integer"
+        if mathy is None:
+            if env_class is None:
+                raise ValueError("pass the env_class to step, e.g. PolySimplify")
+            mathy = env_class(**env_kwargs)
+        if type(mathy).problem_fn is MathyEnv.problem_fn:
+            raise ValueError(
+                f"{type(mathy).__name__} doesn't implement problem_fn, so it can't "
+                "start episodes. Use an env subclass such as PolySimplify."
+            )
+        self.mathy = mathy
+        self.num_envs = num_envs
+        self.env_problem_args = env_problem_args
+        self.auto_reset = auto_reset
+        self.states = []
+        self.window_buffer = ObservationWindowBuffer(window_size=num_envs)
+
+    @property
+    def action_size(self) -> int:
+        return self.mathy.action_size
+
+    def reset_batch(self) -> Tuple[MathyArrayWindowObservation, np.ndarray]:
+        """Start a new episode in every slot of the batch.
+
+        # Returns
+        (Tuple[MathyArrayWindowObservation, np.ndarray]): The stacked observations
+            for the batch and their padded action masks.
+        """
+        self.states = [self._initial_state() for _ in range(self.num_envs)]
+        observations = [self.mathy.state_to_observation(s) for s in self.states]
+        return self.stack_observations(observations)
+
+    def step_batch(
+        self, actions: np.ndarray
+    ) -> Tuple[
+        MathyArrayWindowObservation,
+        np.ndarray,
+        np.ndarray,
+        np.ndarray,
+        List[Dict[str, Any]],
+    ]:
+        """Take one action in every episode of the batch.
+
+        # Arguments
+        actions (np.ndarray): An int array of shape `[num_envs]` with one action
+            for each episode.
+
+        # Returns
+        (Tuple): `(observations, rewards, dones, masks, infos)` where rewards is a
+            float32 array of shape `[num_envs]`, dones is a bool array of shape
+            `[num_envs]`, masks is an int32 array of shape `[num_envs, actions]`
+            and infos is a list of dictionaries, one per episode.
+        """
+        assert len(self.states) == self.num_envs, "call reset_batch() first"
+        states, window, rewards, dones, masks, infos = self._step(
+            self.states, actions, self.auto_reset
+        )
+        self.states = states
+        return window, rewards, dones, masks, infos
+
+    def step_states(
+        self, states: Sequence[MathyEnvState], actions: np.ndarray
+    ) -> Tuple[
+        List[MathyEnvState],
+        MathyArrayWindowObservation,
+        np.ndarray,
+        np.ndarray,
+        np.ndarray,
+        List[Dict[str, Any]],
+    ]:
+        """Take one action from each of the given states, e.g. the walkers of a
+        swarm search. The batch's own episodes aren't changed, and finished
+        states aren't reset.
+
+        # Arguments
+        states (Sequence[MathyEnvState]): The states to step from
+        actions (np.ndarray): An int array with one action for each state
+
+        # Returns
+        (Tuple): `(next_states, observations, rewards, dones, masks, infos)`
+            with the same shapes as `step_batch` for `len(states)` episodes
+        """
+        return self._step(states, actions, False)
+
+    def _step(
+        self, states: Sequence[MathyEnvState], actions: np.ndarray, auto_reset: bool
+    ) -> Tuple[
+        List[MathyEnvState],
+        MathyArrayWindowObservation,
+        np.ndarray,
+        np.ndarray,
+        np.ndarray,
+        List[Dict[str, Any]],
+    ]:
+        assert len(actions) == len(states), "expected one action per episode"
+        rewards = np.zeros((len(states),), dtype=np.float32)
+        dones = np.zeros((len(states),), dtype=np.bool_)
+        infos: List[Dict[str, Any]] = []
+        observations: List[MathyObservation] = []
+        next_states: List[MathyEnvState] = []
+        for i, (state, action) in enumerate(zip(states, actions)):
+            next_state, transition, change = self.mathy.get_next_state(
+                state, int(action)
+            )
+            done = is_terminal_transition(transition)
+            info: Dict[str, Any] = {
+                "transition": transition,
+                "done": done,
+                "valid": change.result is not None,
+            }
+            rewards[i] = transition.reward
+            dones[i] = done
+            observation = transition.observation
+            if done:
+                info["win"] = transition.reward > 0.0
+                info["terminal_state"] = next_state
+                if auto_reset:
+                    self.mathy.finalize_state(next_state)
+                    next_state = self._initial_state()
+                    observation = self.mathy.state_to_observation(next_state)
+            next_states.append(next_state)
+            observations.append(observation)
+            infos.append(info)
+        window, masks = self.stack_observations(observations)
+        return next_states, window, rewards, dones, masks, infos
+
+    def stack_observations(
+        self, observations: List[MathyObservation]
+    ) -> Tuple[MathyArrayWindowObservation, np.ndarray]:
+        """Stack a list of observations into a batch of NumPy arrays padded
+        to the longest sequence in the batch.
+
+        The arrays are views into a reusable buffer that is overwritten by the
+        next call to `reset_batch` or `step_batch`."""
+        window = self.window_buffer.build(observations)
+        return window, window.mask
+
+    def _initial_state(self) -> MathyEnvState:
+        state, _ = self.mathy.get_initial_state(
+            self.env_problem_args, print_problem=False
+        )
+        return state
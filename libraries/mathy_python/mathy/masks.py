@@ -0,0 +1,391 @@
+"""Incremental valid-action masks.
+
+A rule application rewrites one subtree of an expression, so most of the
+nodes in the next state have the same rule applicability they had before.
+The core rules decide whether they apply to a node by looking only at the
+node's subtree and at the types of its parent and sibling. When the env
+builds the next state's tree from the rule's result (see `MathyEnv.reuse_trees`)
+it records a `MaskUpdate` with the valid actions before the step and the
+position of the rewritten subtree. `RuleMaskCache` then only checks the nodes
+whose context changed (the rewritten subtree, its ancestors and its sibling)
+against the rules. The rows for every other node are copied from the previous
+mask at their new (shifted) inorder positions, without visiting the nodes.
+
+Environments opt in with `MathyEnv(incremental_masks=True)`. A rewrite deep in
+a long chain of terms still changes every ancestor up to the root, so on the
+built-in environments the nodes that are skipped only about pay for the
+bookkeeping (see the "masks" section of `mathy bench`).
+
+Most rules can only apply to a few types of nodes (e.g. the distributive
+rules only to add or multiply nodes). Rules declare those candidate types
+with a `node_types` attribute (or in `RULE_NODE_TYPES` for the core rules),
+and are only asked about nodes of those types.
+
+Environments cache masks in their sparse form, the sorted indices of the
+valid actions (see `to_valid_actions` and `to_action_mask`), and observations
+carry them as a `SparseActionMask`.
+"""
+from bisect import bisect_left
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from mathy_core.expressions import (
+    AddExpression,
+    BinaryExpression,
+    MathExpression,
+    MultiplyExpression,
+)
+from mathy_core.rule import BaseRule
+from mathy_core.rules import (
+    AssociativeSwapRule,
+    CommutativeSwapRule,
+    ConstantsSimplifyRule,
+    DistributiveFactorOutRule,
+    DistributiveMultiplyRule,
+    VariableMultiplyRule,
+)
+
+# Rules that only look at a node's subtree and its parent/sibling types when
+# deciding if they apply. Other rules are checked against every node.
+LOCAL_MASK_RULES: Tuple[Type[BaseRule], ...] = (
+    AssociativeSwapRule,
+    CommutativeSwapRule,
+    ConstantsSimplifyRule,
+    DistributiveFactorOutRule,
+    DistributiveMultiplyRule,
+    VariableMultiplyRule,
+)
+
+NodeTypes = Tuple[Type[MathExpression], ...]
+
+# The types of nodes that each core rule can apply to. Custom rules can
+# declare theirs by setting a `node_types` attribute on the rule.
+RULE_NODE_TYPES: Dict[Type[BaseRule], NodeTypes] = {
+    AssociativeSwapRule: (AddExpression, MultiplyExpression),
+    CommutativeSwapRule: (AddExpression, MultiplyExpression),
+    ConstantsSimplifyRule: (BinaryExpression,),
+    DistributiveFactorOutRule: (AddExpression,),
+    DistributiveMultiplyRule: (MultiplyExpression,),
+    VariableMultiplyRule: (MultiplyExpression,),
+}
+
+
+def get_rule_node_types(rule: BaseRule) -> Optional[NodeTypes]:
+    """Return the types of nodes a rule can apply to, or None if the rule
+    could apply to any node.
+
+    Rules opt in by setting a `node_types` tuple of expression classes. The
+    core rules are looked up in `RULE_NODE_TYPES` by their exact type, so that
+    subclasses that change `can_apply_to` aren't filtered by accident."""
+    node_types = getattr(rule, "node_types", None)
+    if node_types is not None:
+        return tuple(node_types)
+    return RULE_NODE_TYPES.get(type(rule), None)
+
+
+def rule_applies_to_class(rule: BaseRule, node_class: type) -> bool:
+    """Return True if a rule could apply to nodes of the given class"""
+    node_types = get_rule_node_types(rule)
+    return node_types is None or issubclass(node_class, node_types)
+
+
+def index_nodes_by_type(
+    nodes: Sequence[MathExpression],
+) -> Dict[Type[MathExpression], List[int]]:
+    """Map each node class in a list of nodes to the indices of its nodes"""
+    index: Dict[Type[MathExpression], List[int]] = {}
+    for i, node in enumerate(nodes):
+        node_class = type(node)
+        indices = index.get(node_class, None)
+        if indices is None:
+            indices = index[node_class] = []
+        indices.append(i)
+    return index
+
+
+def get_candidate_indices(
+    index: Dict[Type[MathExpression], List[int]], node_types: NodeTypes,
+) -> List[int]:
+    """Return the sorted node indices from a type index whose nodes are
+    instances of any of the given types"""
+    matches = [
+        indices
+        for node_class, indices in index.items()
+        if issubclass(node_class, node_types)
+    ]
+    if len(matches) == 1:
+        return matches[0]
+    return sorted(i for indices in matches for i in indices)
+
+
+def to_valid_actions(mask: Sequence[int]) -> Tuple[int, ...]:
+    """Convert a 0/1 action mask to the sorted indices of its valid actions"""
+    return tuple(i for i, value in enumerate(mask) if value == 1)
+
+
+def to_action_mask(actions: Sequence[int], size: int) -> List[int]:
+    """Convert valid action indices to a 0/1 action mask of the given size"""
+    mask = [0] * size
+    for action in actions:
+        mask[action] = 1
+    return mask
+
+
+class SparseActionMask(Sequence):
+    """A read-only 0/1 action mask stored as the sorted indices of its valid
+    actions.
+
+    It reads like the dense mask (length, indexing, iteration, equality and
+    `np.asarray`), but the dense values are only built when something uses
+    them, e.g. when observations are combined into a window of model inputs.
+
+    # Arguments
+    actions (Sequence[int]): The sorted indices of the valid actions
+    size (int): The number of actions, i.e. `nodes * rules`
+    """
+
+    __slots__ = ("actions", "size")
+
+    actions: Tuple[int, ...]
+    size: int
+
+    def __init__(self, actions: Sequence[int], size: int):
+        self.actions = tuple(actions)
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("action mask index out of range")
+        position = bisect_left(self.actions, index)
+        found = position < len(self.actions) and self.actions[position] == index
+        return 1 if found else 0
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, SparseActionMask):
+            return self.size == other.size and self.actions == other.actions
+        if isinstance(other, (list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((self.actions, self.size))
+
+    def __repr__(self) -> str:
+        return f"SparseActionMask(actions={self.actions!r}, size={self.size})"
+
+    def __array__(self, dtype: Any = None) -> np.ndarray:
+        mask = np.zeros((self.size,), dtype=np.int32 if dtype is None else dtype)
+        mask[list(self.actions)] = 1
+        return mask
+
+    def to_list(self) -> List[int]:
+        """Return the dense 0/1 mask as a list"""
+        return to_action_mask(self.actions, self.size)
+
+
+def is_local_mask_rule(rule: BaseRule) -> bool:
+    """Return True if a rule's applicability to a node can be cached by the
+    node's context fingerprint"""
+    if type(rule).find_nodes is not BaseRule.find_nodes:
+        return False
+    return type(rule) in LOCAL_MASK_RULES
+
+
+class MaskUpdate(NamedTuple):
+    """The valid actions of an expression before a rule rewrote one of its
+    subtrees, and where that subtree is in the expression before and after."""
+
+    # The sorted valid actions before the rule was applied
+    actions: Tuple[int, ...]
+    # The inorder index of the first node of the rewritten subtree before the
+    # rule was applied, and the index just past its last node
+    start: int
+    stop: int
+    # The root of the rewritten subtree in the new expression
+    result: MathExpression
+
+
+def get_subtree_bounds(node: MathExpression) -> Tuple[int, int]:
+    """Return the inorder index of the first node of a subtree and the index
+    just past its last node. The nodes must have their `r_index` set."""
+    first = node
+    while first.left is not None:
+        first = first.left
+    last = node
+    while last.right is not None:
+        last = last.right
+    return first.r_index, last.r_index + 1
+
+
+class RuleMaskCache:
+    """Update the masks of the rules whose applicability only depends on a
+    node's local context, by reusing the rows of the nodes that a rule
+    application didn't change.
+
+    # Arguments
+    rules (List[BaseRule]): The rules in the order of the action space
+    """
+
+    rules: List[BaseRule]
+    node_checks: int
+    node_hits: int
+    node_skips: int
+
+    def __init__(self, rules: Sequence[BaseRule]):
+        self.rules = list(rules)
+        self._local = [i for i, r in enumerate(self.rules) if is_local_mask_rule(r)]
+        self._local_set = frozenset(self._local)
+        self._class_rules: Dict[type, Tuple[int, ...]] = {}
+        self.node_checks = 0
+        self.node_hits = 0
+        self.node_skips = 0
+
+    @property
+    def local_rules(self) -> List[int]:
+        """The indices of the rules whose masks are updated incrementally"""
+        return self._local
+
+    def reset_stats(self) -> None:
+        self.node_checks = 0
+        self.node_hits = 0
+        self.node_skips = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Return the number of nodes that were checked against the rules, the
+        number whose rows were reused from the previous mask, and the number
+        that were skipped because no rule can apply to their type"""
+        total = self.node_checks + self.node_hits
+        return {
+            "node_checks": self.node_checks,
+            "node_hits": self.node_hits,
+            "node_skips": self.node_skips,
+            "hit_ratio": self.node_hits / total if total > 0 else 0.0,
+        }
+
+    def get_class_rules(self, node_class: type) -> Tuple[int, ...]:
+        """Return the indices of the local rules that can apply to nodes of
+        the given class"""
+        class_rules = self._class_rules.get(node_class, None)
+        if class_rules is None:
+            rules = self.rules
+            class_rules = self._class_rules[node_class] = tuple(
+                i for i in self._local if rule_applies_to_class(rules[i], node_class)
+            )
+        return class_rules
+
+    def get_update(
+        self,
+        actions: Tuple[int, ...],
+        before: MathExpression,
+        result: MathExpression,
+    ) -> Optional[MaskUpdate]:
+        """Describe a rule application for updating the next expression's mask.
+
+        # Arguments
+        actions (Tuple[int, ...]): The valid actions of the expression before
+            the rule was applied
+        before (MathExpression): The root of the expression before the rule was
+            applied, with the inorder `r_index` of its nodes set
+        result (MathExpression): The rule's result node in the new expression
+
+        # Returns
+        (Optional[MaskUpdate]): The update, or None if the result's position
+            doesn't exist in the expression before the rule was applied
+        """
+        sides: List[bool] = []
+        node = result
+        while node.parent is not None:
+            sides.append(node.parent.left is node)
+            node = node.parent
+        replaced: Optional[MathExpression] = before
+        for is_left in reversed(sides):
+            assert replaced is not None
+            replaced = replaced.left if is_left else replaced.right
+            if replaced is None:
+                return None
+        assert replaced is not None
+        start, stop = get_subtree_bounds(replaced)
+        return MaskUpdate(actions, start, stop, result)
+
+    def fill_actions(
+        self,
+        inorder: List[MathExpression],
+        actions: List[int],
+        update: Optional[MaskUpdate] = None,
+    ) -> None:
+        """Set the mask values for the local rules in an actions list of length
+        `len(inorder) * len(rules)`. Values for the other rules are untouched.
+
+        Without an update every node is checked against the rules. With one,
+        only the nodes whose context the rule application changed are."""
+        rule_count = len(self.rules)
+        dirty: Sequence[int] = range(len(inorder))
+        if update is not None:
+            start, stop = get_subtree_bounds(update.result)
+            if start == update.start:
+                dirty = self._reuse_rows(update, start, stop, actions)
+        rules = self.rules
+        class_rules = self._class_rules
+        checks = 0
+        skipped = 0
+        for node_index in dirty:
+            node = inorder[node_index]
+            candidates = class_rules.get(type(node), None)
+            if candidates is None:
+                candidates = self.get_class_rules(type(node))
+            if len(candidates) == 0:
+                skipped += 1
+                continue
+            checks += 1
+            offset = node_index * rule_count
+            for rule_index in candidates:
+                if rules[rule_index].can_apply_to(node):
+                    actions[offset + rule_index] = 1
+        self.node_checks += checks
+        self.node_hits += len(inorder) - len(dirty)
+        self.node_skips += skipped
+
+    def _reuse_rows(
+        self, update: MaskUpdate, start: int, stop: int, actions: List[int]
+    ) -> List[int]:
+        """Copy the local rule actions of the nodes outside the rewritten
+        subtree from the previous mask, and return the indices of the nodes
+        that still need to be checked against the rules"""
+        rule_count = len(self.rules)
+        local = self._local_set
+        shift = stop - update.stop
+        for action in update.actions:
+            node_index, rule_index = divmod(action, rule_count)
+            if rule_index not in local or start <= node_index < update.stop:
+                continue
+            if node_index >= update.stop:
+                node_index += shift
+            actions[node_index * rule_count + rule_index] = 1
+        # The ancestors have new subtrees, and the result's sibling has a new
+        # sibling type, so their reused rows are cleared and checked again
+        changed: List[int] = []
+        node = update.result
+        parent = node.parent
+        if parent is not None:
+            sibling = parent.right if parent.left is node else parent.left
+            if sibling is not None:
+                changed.append(sibling.r_index)
+        while parent is not None:
+            changed.append(parent.r_index)
+            parent = parent.parent
+        for node_index in changed:
+            offset = node_index * rule_count
+            for rule_index in self._local:
+                actions[offset + rule_index] = 0
+        return list(range(start, stop)) + changed
@@ -0,0 +1,257 @@
+"""Pre-generated banks of environment problems.
+
+Generating a problem at the start of every episode runs the environment's
+problem generator, which is slow for large problems and makes training runs
+hard to reproduce. A problem bank is built once (see `mathy problems build`)
+by generating problems in parallel and removing duplicates. It is stored in a
+single file that is memory-mapped when loaded, so sampling a problem is O(1)
+and doesn't read the whole bank into memory.
+
+The file starts with a fixed header and a JSON metadata block, followed by
+`count + 1` uint64 text offsets, `count` int32 complexities, and the utf8
+problem texts.
+"""
+import json
+import multiprocessing
+import os
+import random
+import struct
+import warnings
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, Union
+
+import numpy as np
+
+from .env import MathyEnv
+from .types import MathyEnvDifficulty, MathyEnvProblem, MathyEnvProblemArgs
+
+PROBLEM_BANK_MAGIC = b"MYPB"
+PROBLEM_BANK_VERSION = 1
+PROBLEM_BANK_EXTENSION = ".bank"
+_BANK_HEADER = struct.Struct("<4sBxxxQQI")
+
+BankProblem = Tuple[str, int]
+
+
+def get_problem_bank_path(
+    folder: str, env_namespace: str, difficulty: MathyEnvDifficulty
+) -> str:
+    """Return the path of the bank file for an environment and difficulty
+    inside a folder of problem banks."""
+    file_name = f"{env_namespace}.{difficulty.name}{PROBLEM_BANK_EXTENSION}"
+    return os.path.join(folder, file_name)
+
+
+def write_problem_bank(
+    file_path: str, problems: List[BankProblem], meta: Dict[str, Any] = None
+) -> None:
+    """Write a list of (text, complexity) problems to a bank file"""
+    meta_bytes = json.dumps(meta if meta is not None else {}).encode("utf8")
+    texts = [text.encode("utf8") for text, _ in problems]
+    offsets = np.zeros((len(texts) + 1,), dtype="<u8")
+    np.cumsum([len(t) for t in texts], out=offsets[1:])
+    complexities = np.array([c for _, c in problems], dtype="<i4")
+    header = _BANK_HEADER.pack(
+        PROBLEM_BANK_MAGIC,
+        PROBLEM_BANK_VERSION,
+        len(texts),
+        int(offsets[-1]),
+        len(meta_bytes),
+    )
+    with open(file_path, "wb") as f:
+        f.write(header)
+        f.write(meta_bytes)
+        f.write(offsets.tobytes())
+        f.write(complexities.tobytes())
+        f.write(b"".join(texts))
+
+
+class ProblemBank:
+    """A memory-mapped bank of problems written by `write_problem_bank`.
+
+    # Arguments
+    file_path (str): The bank file to open
+    """
+
+    file_path: str
+    meta: Dict[str, Any]
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        data = np.memmap(file_path, dtype=np.uint8, mode="r")
+        if len(data) < _BANK_HEADER.size:
+            raise ValueError(f"file is not a problem bank: {file_path}")
+        magic, version, count, text_size, meta_size = _BANK_HEADER.unpack(
+            data[: _BANK_HEADER.size].tobytes()
+        )
+        if magic != PROBLEM_BANK_MAGIC:
+            raise ValueError(f"file is not a problem bank: {file_path}")
+        if version != PROBLEM_BANK_VERSION:
+            raise ValueError(f"unsupported problem bank version: {version}")
+        offset = _BANK_HEADER.size
+        end = offset + meta_size
+        self.meta = json.loads(data[offset:end].tobytes())
+        offset = end
+        self._offsets = np.frombuffer(data, "<u8", count + 1, offset)
+        offset += self._offsets.nbytes
+        self._complexities = np.frombuffer(data, "<i4", count, offset)
+        offset += self._complexities.nbytes
+        end = offset + text_size
+        self._texts = data[offset:end]
+        self._type = self.meta.get("env_namespace", "mathy.unknown")
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> MathyEnvProblem:
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("problem bank index out of range")
+        start, end = self._offsets[index], self._offsets[index + 1]
+        text = self._texts[start:end].tobytes().decode("utf8")
+        return MathyEnvProblem(text, int(self._complexities[index]), self._type)
+
+    def sample(self, rng: Optional[np.random.RandomState] = None) -> MathyEnvProblem:
+        """Return a random problem from the bank"""
+        rng = rng if rng is not None else np.random
+        return self[int(rng.randint(0, self._count))]
+
+
+def generate_problems(
+    env_class: Type[MathyEnv],
+    args: MathyEnvProblemArgs,
+    number: int,
+    seed: int,
+    env_kwargs: Dict[str, Any] = None,
+) -> List[BankProblem]:
+    """Generate problems from an environment with seeded random generators.
+    Problems that fail to parse are left out."""
+    random.seed(seed)
+    np.random.seed(seed)
+    env = env_class(**(env_kwargs or {}))
+    problems: List[BankProblem] = []
+    for _ in range(number):
+        problem: MathyEnvProblem = env.problem_fn(args)
+        try:
+            env.parser.parse(problem.text)
+        except Exception:
+            # The parser raises ParserException subclasses, but the tokenizer
+            # raises a bare Exception for invalid characters
+            continue
+        problems.append((problem.text, problem.complexity))
+    return problems
+
+
+def _generate_chunk(params: Tuple[Any, ...]) -> List[BankProblem]:
+    return generate_problems(*params)
+
+
+def build_problem_bank(
+    file_path: str,
+    env_class: Type[MathyEnv],
+    difficulty: MathyEnvDifficulty,
+    number: int,
+    seed: int = 1337,
+    workers: int = 1,
+    chunk_size: int = 10000,
+    max_rounds: int = 10,
+    env_kwargs: Dict[str, Any] = None,
+) -> int:
+    """Generate up to `number` unique problems in parallel and write them to a
+    bank file.
+
+    Problems are generated in chunks that each have their own seed, so the
+    bank is the same for a given seed no matter how many workers are used.
+    Generation stops early if a round of chunks finds no new problems, which
+    happens when an environment can't produce `number` unique problems.
+
+    # Returns
+    (int): The number of problems in the bank
+    """
+    args = MathyEnvProblemArgs(difficulty=difficulty)
+    env = env_class(**(env_kwargs or {}))
+    unique: Dict[str, int] = {}
+    next_chunk = 0
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for _ in range(max_rounds):
+            remaining = number - len(unique)
+            if remaining <= 0:
+                break
+            num_chunks = max(1, int(np.ceil(remaining / chunk_size)))
+            params = [
+                (env_class, args, chunk_size, seed + next_chunk + i, env_kwargs)
+                for i in range(num_chunks)
+            ]
+            next_chunk += num_chunks
+            chunks: Iterable[List[BankProblem]]
+            if pool is not None:
+                chunks = pool.map(_generate_chunk, params)
+            else:
+                chunks = map(_generate_chunk, params)
+            before = len(unique)
+            for chunk in chunks:
+                for text, complexity in chunk:
+                    if text not in unique and len(unique) < number:
+                        unique[text] = complexity
+            if len(unique) == before:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    meta = {
+        "env_namespace": env.get_env_namespace(),
+        "difficulty": difficulty.name,
+        "seed": seed,
+        "chunk_size": chunk_size,
+    }
+    write_problem_bank(file_path, list(unique.items()), meta)
+    return len(unique)
+
+
+def load_problem_bank(
+    bank: Union[str, ProblemBank], env: MathyEnv, difficulty: MathyEnvDifficulty
+) -> Optional[ProblemBank]:
+    """Load the problem bank for an environment and difficulty. The bank can
+    be an open bank, a bank file, or a folder of banks built by `mathy
+    problems build`.
+
+    If `bank` is a folder without a bank for the environment and difficulty
+    a warning is shown, so the environment can fall back to generating its
+    problems.
+
+    # Raises
+    ValueError: If the bank was built for a different environment or
+        difficulty
+
+    # Returns
+    (Optional[ProblemBank]): The bank, or None if `bank` is a folder that
+        doesn't have a bank for the environment and difficulty
+    """
+    namespace = env.get_env_namespace()
+    if not isinstance(bank, ProblemBank):
+        if os.path.isdir(bank):
+            file_path = get_problem_bank_path(bank, namespace, difficulty)
+            if not os.path.exists(file_path):
+                warnings.warn(
+                    f"no problem bank for {namespace} ({difficulty.name}) in "
+                    f"{bank}, problems will be generated instead"
+                )
+                return None
+            bank = file_path
+        bank = ProblemBank(bank)
+    bank_namespace = bank.meta.get("env_namespace", None)
+    if bank_namespace is not None and bank_namespace != namespace:
+        raise ValueError(
+            f"problem bank {bank.file_path} has problems for {bank_namespace}, "
+            f"not {namespace}"
+        )
+    bank_difficulty = bank.meta.get("difficulty", None)
+    if bank_difficulty is not None and bank_difficulty != difficulty.name:
+        raise ValueError(
+            f"problem bank {bank.file_path} has {bank_difficulty} problems, "
+            f"not {difficulty.name}"
+        )
+    return bank
@@ -0,0 +1,143 @@
+"""Lightweight timing spans for the environment and agent hot paths.
+
+Spans are disabled by default, in which case entering one costs about as
+much as a function call. When enabled, each span records its wall time so
+that percentiles can be reported for every span name.
+
+```python
+from mathy.spans import spans
+
+spans.enabled = True
+with spans.span("env/parse"):
+    ...
+print(spans.stats())
+```
+"""
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict
+
+import numpy as np
+import srsly
+
+SpanStats = Dict[str, Dict[str, float]]
+
+
+class NullSpan:
+    """A span that does nothing, used when timing is disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Time a block of code and record it with a `SpanTimer` when it exits"""
+
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer: "SpanTimer", name: str):
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.timer.record(self.name, time.perf_counter() - self.start)
+
+
+class SpanTimer:
+    """Collect wall times for named spans of code.
+
+    The most recent `max_samples` times for each span are kept for percentile
+    calculations, while the count and total time cover every call.
+
+    # Arguments
+    enabled (bool): Whether spans record their times
+    max_samples (int): The number of recent samples to keep for each span
+    """
+
+    enabled: bool
+    max_samples: int
+
+    def __init__(self, enabled: bool = False, max_samples: int = 10000):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._totals: Dict[str, float] = {}
+
+    def span(self, name: str) -> Any:
+        """Return a context manager that times the code inside it"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        """Record a time (in seconds) for the given span name"""
+        with self._lock:
+            samples = self._samples.get(name, None)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.max_samples)
+                self._counts[name] = 0
+                self._totals[name] = 0.0
+            samples.append(seconds)
+            self._counts[name] += 1
+            self._totals[name] += seconds
+
+    def reset(self) -> None:
+        """Remove all recorded times"""
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._totals.clear()
+
+    def stats(self) -> SpanStats:
+        """Return the count, total and p50/p95/p99 times (in milliseconds) for
+        each span that has been recorded."""
+        with self._lock:
+            names = sorted(self._samples.keys())
+            samples = {n: np.array(self._samples[n], dtype=np.float64) for n in names}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+        result: SpanStats = {}
+        for name in names:
+            times = samples[name] * 1000.0
+            p50, p95, p99 = np.percentile(times, [50, 95, 99])
+            result[name] = {
+                "count": counts[name],
+                "total_ms": totals[name] * 1000.0,
+                "mean_ms": float(times.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+            }
+        return result
+
+    def write_json(self, file_path: str) -> None:
+        """Write the span stats to a JSON file"""
+        srsly.write_json(file_path, self.stats())
+
+    def write_summaries(self, step: Any, prefix: str = "spans") -> None:
+        """Write the span percentiles to the default tf.summary writer"""
+        import tensorflow as tf
+
+        for name, stats in self.stats().items():
+            for key in ["p50_ms", "p95_ms", "p99_ms"]:
+                tf.summary.scalar(f"{prefix}/{name}/{key}", data=stats[key], step=step)
+
+
+# The spans shared by the environments and agents in this process
+spans = SpanTimer()
@@ -1,14 +1,56 @@
+import hashlib
+import struct
+from collections.abc import Mapping
 from enum import IntEnum
-from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import srsly
 
 from mathy_core.expressions import ConstantExpression, MathExpression, MathTypeKeys
 from mathy_core.parser import ExpressionParser
-from .util import pad_array
+from .masks import SparseActionMask
+from .util import pad_array, siphash24
 
 PROBLEM_TYPE_HASH_BUCKETS = 128
+# The keys for the two hashes of a problem type (see `get_problem_type_hash`)
+PROBLEM_TYPE_HASH_KEYS = ([1337, 61059873], [7, -242315])
+# Precomputed hashes for the builtin environment namespaces
+BUILTIN_PROBLEM_TYPE_HASHES: Dict[str, Tuple[int, int]] = {
+    "mathy.binomials.mulptiply": (87, 44),
+    "mathy.monomials.complex_simplify": (48, 42),
+    "mathy.polynomials.combine.in.place": (81, 113),
+    "mathy.polynomials.commute.like.terms": (81, 4),
+    "mathy.polynomials.commute_then_simplify": (91, 82),
+    "mathy.polynomials.group_like_terms": (89, 22),
+    "mathy.polynomials.haystack.like.terms": (124, 28),
+    "mathy.polynomials.simplify": (106, 28),
+    "mathy.unknown": (21, 83),
+}
+
+# Binary state format: a fixed header, the history steps as packed records,
+# then a table of the distinct strings (problem texts and type) in the state.
+STATE_FORMAT_MAGIC = b"MY"
+STATE_FORMAT_VERSION = 1
+_STATE_HEADER = struct.Struct("<2sBxIiiidIIII")
+_STATE_STEP_DTYPE = np.dtype([("raw", "<u4"), ("focus", "<i4"), ("action", "<i4")])
+
+
+class StateCapacityError(ValueError):
+    """Raised when an encoded state is larger than the fixed number of bytes it
+    is being padded to"""
+
 
 NodeIntList = List[int]
 NodeValuesFloatList = List[float]
@@ -22,6 +64,7 @@ WindowNodeMaskIntList = List[NodeMaskIntList]
 WindowNodeValuesFloatList = List[NodeValuesFloatList]
 WindowProblemTypeIntList = List[ProblemTypeIntList]
 WindowTimeFloatList = List[TimeFloatList]
+ObservationMask = Union[NodeMaskIntList, SparseActionMask]
 
 
 # Input type for mathy models
@@ -40,7 +83,7 @@ class MathyObservation(NamedTuple):
     """A featurized observation from an environment state."""
 
     nodes: NodeIntList
-    mask: NodeMaskIntList
+    mask: ObservationMask
     values: NodeValuesFloatList
     type: ProblemTypeIntList
     time: TimeFloatList
@@ -48,7 +91,7 @@ class MathyObservation(NamedTuple):
 
 # fmt: off
 MathyObservation.nodes.__doc__ = "tree node types in the current environment state shape=[n,]" # noqa
-MathyObservation.mask.__doc__ = "0/1 mask where 0 indicates an invalid action shape=[n,]" # noqa
+MathyObservation.mask.__doc__ = "0/1 mask where 0 indicates an invalid action, usually a SparseActionMask shape=[n,]" # noqa
 MathyObservation.values.__doc__ = "tree node value sequences, with non number indices set to 0.0 shape=[n,]" # noqa
 MathyObservation.type.__doc__ = "two column hash of problem environment type shape=[2,]" # noqa
 MathyObservation.time.__doc__ = "float value between 0.0 and 1.0 indicating the time elapsed shape=[1,]" # noqa
@@ -119,7 +162,239 @@ MathyEnvStateStep.action.__doc__ = "the action taken" # noqa
 # fmt: on
 
 
-_problem_hash_cache: Optional[Dict[str, List[int]]] = None
+class _VisitEntry:
+    __slots__ = ("key", "key_hash", "count")
+
+    def __init__(self, key: str, key_hash: int, count: int):
+        self.key = key
+        self.key_hash = key_hash
+        self.count = count
+
+
+# VisitCounts trie nodes have 32 slots, indexed by 5 bits of the key hash
+_VISIT_BITS = 5
+_VISIT_MASK = (1 << _VISIT_BITS) - 1
+_VISIT_HASH_BITS = 64
+_VISIT_EMPTY_NODE: Tuple[Any, ...] = (None,) * (1 << _VISIT_BITS)
+
+
+def _visit_hash(key: str) -> int:
+    # The builtin str hash is salted per process, which would scatter the keys
+    # of a VisitCounts that is pickled and loaded in another process (e.g. a
+    # swarm or A3C worker), so use a stable hash instead.
+    digest = hashlib.blake2b(key.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _put_visit_entry(node: Any, shift: int, entry: _VisitEntry) -> Any:
+    """Return a copy of a trie node with the entry added (or replacing the
+    entry with the same key). Only the nodes on the entry's path are copied."""
+    if shift >= _VISIT_HASH_BITS:
+        # Every hash bit is used, so keys that collide share a bucket
+        bucket = node or ()
+        return tuple(e for e in bucket if e.key != entry.key) + (entry,)
+    if node is None:
+        node = _VISIT_EMPTY_NODE
+    index = (entry.key_hash >> shift) & _VISIT_MASK
+    slot = node[index]
+    if slot is None or (isinstance(slot, _VisitEntry) and slot.key == entry.key):
+        new_slot: Any = entry
+    elif isinstance(slot, _VisitEntry):
+        # Two keys share this slot, so push both down into a new node
+        child = _put_visit_entry(None, shift + _VISIT_BITS, slot)
+        new_slot = _put_visit_entry(child, shift + _VISIT_BITS, entry)
+    else:
+        new_slot = _put_visit_entry(slot, shift + _VISIT_BITS, entry)
+    after = index + 1
+    return node[:index] + (new_slot,) + node[after:]
+
+
+def _iter_visit_entries(node: Any, shift: int) -> Iterator[_VisitEntry]:
+    if node is None:
+        return
+    if shift >= _VISIT_HASH_BITS:
+        yield from node
+        return
+    for slot in node:
+        if isinstance(slot, _VisitEntry):
+            yield slot
+        elif slot is not None:
+            yield from _iter_visit_entries(slot, shift + _VISIT_BITS)
+
+
+class VisitCounts(Mapping):
+    """An immutable map from problem text to the number of times it has been
+    visited, stored as a hash array mapped trie.
+
+    Counting a visit returns a new map that shares all but the few small nodes
+    on the key's path with this one, so every state of an episode (and every
+    branch a search takes from it) can keep its own counts without copying
+    the counts of earlier steps.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self):
+        self._root: Any = None
+        self._size = 0
+
+    def increment(self, key: str) -> "VisitCounts":
+        """Return a new map with one more visit counted for the given key"""
+        count = self.get(key, 0)
+        out = VisitCounts.__new__(VisitCounts)
+        entry = _VisitEntry(key, _visit_hash(key), count + 1)
+        out._root = _put_visit_entry(self._root, 0, entry)
+        out._size = self._size + (1 if count == 0 else 0)
+        return out
+
+    def __getitem__(self, key: str) -> int:
+        if not isinstance(key, str):
+            raise KeyError(key)
+        key_hash = _visit_hash(key)
+        node = self._root
+        shift = 0
+        while node is not None:
+            if shift >= _VISIT_HASH_BITS:
+                for entry in node:
+                    if entry.key == key:
+                        return entry.count
+                break
+            slot = node[(key_hash >> shift) & _VISIT_MASK]
+            if isinstance(slot, _VisitEntry):
+                if slot.key == key:
+                    return slot.count
+                break
+            node = slot
+            shift += _VISIT_BITS
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return (entry.key for entry in _iter_visit_entries(self._root, 0))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __repr__(self) -> str:
+        return f"VisitCounts({dict(self)!r})"
+
+
+class MathyHistory:
+    """An immutable history of environment steps, stored as a linked list
+    from the newest step back to the first one.
+
+    Appending returns a new history that shares every existing step with
+    this one, so states can be copied in constant time no matter how long
+    their episodes are. The length and first step are cached, and reading
+    recent steps (e.g. `history[-1]` or `history[-2]`) only walks as far
+    back as the index requires. Each history also holds the `VisitCounts` of
+    the problem texts in its steps.
+
+    # Arguments
+    steps (Iterable[MathyEnvStateStep]): The initial steps, oldest first
+    """
+
+    __slots__ = ("step", "parent", "first", "length", "visits")
+
+    step: Optional[MathyEnvStateStep]
+    parent: Optional["MathyHistory"]
+    first: Optional[MathyEnvStateStep]
+    length: int
+    visits: VisitCounts
+
+    def __init__(self, steps: Iterable[MathyEnvStateStep] = ()):
+        self.step = None
+        self.parent = None
+        self.first = None
+        self.length = 0
+        self.visits = VisitCounts()
+        node = self
+        for step in steps:
+            node = node.append(step)
+        if node is not self:
+            self.step = node.step
+            self.parent = node.parent
+            self.first = node.first
+            self.length = node.length
+            self.visits = node.visits
+
+    def append(self, step: MathyEnvStateStep) -> "MathyHistory":
+        """Return a new history with the given step added to the end. This
+        history is not modified."""
+        node = MathyHistory.__new__(MathyHistory)
+        node.step = step
+        node.parent = self if self.length > 0 else None
+        node.first = step if self.first is None else self.first
+        node.length = self.length + 1
+        node.visits = self.visits.increment(step.raw)
+        return node
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[MathyEnvStateStep]:
+        return iter(self.to_list())
+
+    def __reversed__(self) -> Iterator[MathyEnvStateStep]:
+        node: Optional[MathyHistory] = self
+        while node is not None and node.step is not None:
+            yield node.step
+            node = node.parent
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("history index out of range")
+        if index == 0:
+            return self.first
+        node: MathyHistory = self
+        for _ in range(self.length - 1 - index):
+            node = node.parent  # type:ignore
+        return node.step
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (MathyHistory, list, tuple)):
+            return len(self) == len(other) and self.to_list() == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"MathyHistory({self.to_list()!r})"
+
+    def to_list(self) -> List[MathyEnvStateStep]:
+        """Return the steps in a list, oldest first"""
+        out = list(reversed(self))
+        out.reverse()
+        return out
+
+
+_problem_hash_cache: Dict[str, List[int]] = {
+    key: list(value) for key, value in BUILTIN_PROBLEM_TYPE_HASHES.items()
+}
+
+
+def get_problem_type_hash(problem_type: str) -> ProblemTypeIntList:
+    """Return a two element list of hash buckets for an environment namespace.
+
+    The buckets match the values that `tf.strings.to_hash_bucket_strong`
+    returns for `PROBLEM_TYPE_HASH_KEYS`, but are computed without loading
+    TensorFlow, and builtin environments are looked up from a table.
+
+    # Example
+
+    - `mycorp.envs.solve_impossible_problems` -> `[88, 108]`
+
+    """
+    hashes = _problem_hash_cache.get(problem_type, None)
+    if hashes is None:
+        data = problem_type.encode("utf8")
+        hashes = [
+            siphash24(key, data) % PROBLEM_TYPE_HASH_BUCKETS
+            for key in PROBLEM_TYPE_HASH_KEYS
+        ]
+        _problem_hash_cache[problem_type] = hashes
+    return hashes
 
 
 def observations_to_window(
@@ -139,15 +414,222 @@ def observations_to_window(
         max_length = total_length
 
     for obs in observations:
-        output.nodes.append(pad_array(obs.nodes, max_length, MathTypeKeys["empty"]))
-        output.mask.append(pad_array(obs.mask, max_mask_length, 0))
-        output.values.append(pad_array(obs.values, max_length, 0.0))
+        # Pad copies, because observations can be shared with the env's cache
+        empty = MathTypeKeys["empty"]
+        output.nodes.append(pad_array(list(obs.nodes), max_length, empty))
+        mask = obs.mask
+        mask = mask.to_list() if isinstance(mask, SparseActionMask) else list(mask)
+        output.mask.append(pad_array(mask, max_mask_length, 0))
+        output.values.append(pad_array(list(obs.values), max_length, 0.0))
         # repeat type/time values so they can be combined with nodes/values
         output.type.append(pad_array([], max_length, obs.type))
         output.time.append(pad_array([], max_length, obs.time))
     return output
 
 
+class MathyArrayObservation(NamedTuple):
+    """A featurized observation stored in preallocated NumPy arrays.
+
+    The node arrays may be longer than the observation, in which case only
+    the first `length` elements (and the first `length * num_rules` mask
+    elements) are meaningful."""
+
+    nodes: np.ndarray
+    mask: np.ndarray
+    values: np.ndarray
+    type: np.ndarray
+    time: np.ndarray
+    length: int
+
+    @classmethod
+    def from_observation(
+        cls, observation: MathyObservation, capacity: Optional[int] = None
+    ) -> "MathyArrayObservation":
+        """Copy a list-based observation into compact int32/float32 arrays that
+        can hold at least `capacity` nodes."""
+        length = len(observation.nodes)
+        capacity = max(length, capacity or 0)
+        rules = len(observation.mask) // max(length, 1)
+        nodes = np.full((capacity,), MathTypeKeys["empty"], dtype=np.int32)
+        nodes[:length] = observation.nodes
+        values = np.zeros((capacity,), dtype=np.float32)
+        values[:length] = observation.values
+        mask = np.zeros((capacity * rules,), dtype=np.int32)
+        if isinstance(observation.mask, SparseActionMask):
+            mask[list(observation.mask.actions)] = 1
+        else:
+            mask[: len(observation.mask)] = observation.mask
+        return cls(
+            nodes=nodes,
+            mask=mask,
+            values=values,
+            type=np.asarray(observation.type, dtype=np.float32),
+            time=np.asarray(observation.time, dtype=np.float32),
+            length=length,
+        )
+
+
+# fmt: off
+MathyArrayObservation.nodes.__doc__ = "int32 tree node types `shape=[capacity,]`" # noqa
+MathyArrayObservation.mask.__doc__ = "int32 0/1 action mask `shape=[capacity * num_rules,]`" # noqa
+MathyArrayObservation.values.__doc__ = "float32 node values, with non number indices set to 0.0 `shape=[capacity,]`" # noqa
+MathyArrayObservation.type.__doc__ = "float32 two column hash of problem environment type `shape=[2,]`" # noqa
+MathyArrayObservation.time.__doc__ = "float32 episode time value `shape=[1,]`" # noqa
+MathyArrayObservation.length.__doc__ = "the number of valid nodes in the arrays" # noqa
+# fmt: on
+
+AnyObservation = Union[MathyObservation, MathyArrayObservation]
+
+
+class MathyArrayWindowObservation(NamedTuple):
+    """A featurized observation window made of contiguous NumPy arrays."""
+
+    nodes: np.ndarray
+    mask: np.ndarray
+    values: np.ndarray
+    type: np.ndarray
+    time: np.ndarray
+
+    def to_inputs(
+        self, as_tf_tensor: bool = False, pad_length: Optional[int] = None
+    ) -> MathyInputsType:
+        """Return the model inputs.
+
+        # Arguments
+        as_tf_tensor (bool): Convert the arrays to tensors, which Keras models
+            need to be called directly. The arrays already have the dtypes the
+            model expects, so no per-element conversion is needed.
+        pad_length (Optional[int]): Pad the node sequences to this length
+
+        # Returns
+        (MathyInputsType): The inputs, which are views of the window's arrays
+            unless they're converted to tensors or padded
+        """
+        window = self if pad_length is None else self.pad(pad_length)
+        inputs = {
+            "nodes_in": window.nodes,
+            "mask_in": window.mask,
+            "values_in": window.values,
+            "type_in": window.type,
+            "time_in": window.time,
+        }
+        if as_tf_tensor:
+            import tensorflow as tf
+
+            inputs = {k: tf.convert_to_tensor(v) for k, v in inputs.items()}
+        return inputs
+
+    def pad(self, length: int) -> "MathyArrayWindowObservation":
+        """Return a window with its node sequences padded to the given length,
+        the way `observations_to_window` pads to its `total_length`. The arrays
+        are copied if they need padding."""
+        extra = length - self.nodes.shape[1]
+        if extra < 0:
+            raise ValueError(
+                f"can't pad a window of length {self.nodes.shape[1]} to {length}"
+            )
+        if extra == 0:
+            return self
+        rows = ((0, 0), (0, extra))
+        features = ((0, 0), (0, extra), (0, 0))
+        return MathyArrayWindowObservation(
+            nodes=np.pad(self.nodes, rows, constant_values=MathTypeKeys["empty"]),
+            mask=self.mask,
+            values=np.pad(self.values, rows),
+            # type/time values are repeated for every node
+            type=np.pad(self.type, features, mode="edge"),
+            time=np.pad(self.time, features, mode="edge"),
+        )
+
+    def to_input_shapes(self) -> List[Any]:
+        return [
+            self.nodes.shape,
+            self.mask.shape,
+            self.values.shape,
+            self.type.shape,
+            self.time.shape,
+        ]
+
+
+class ObservationWindowBuffer:
+    """Build observation windows by writing into reusable NumPy buffers.
+
+    The buffers grow when a larger window is requested, but are otherwise
+    reused, so windowing an episode step by step doesn't allocate new lists
+    for every feature.
+
+    !!! warning "Windows are views"
+
+        The arrays of a returned window are views into this buffer, and are
+        overwritten by the next call to `build`. Copy them if you need to keep
+        them around.
+    """
+
+    def __init__(self, window_size: int = 6, max_length: int = 64):
+        size = window_size * max_length
+        self._nodes = np.zeros((size,), dtype=np.int32)
+        self._values = np.zeros((size,), dtype=np.float32)
+        self._type = np.zeros((size * 2,), dtype=np.float32)
+        self._time = np.zeros((size,), dtype=np.float32)
+        self._mask = np.zeros((0,), dtype=np.int32)
+
+    def _reserve(self, size: int, mask_size: int):
+        """Grow the buffers (with headroom) if they can't hold a window"""
+        if size > len(self._nodes):
+            self._nodes = np.zeros((size * 2,), dtype=np.int32)
+            self._values = np.zeros((size * 2,), dtype=np.float32)
+            self._type = np.zeros((size * 4,), dtype=np.float32)
+            self._time = np.zeros((size * 2,), dtype=np.float32)
+        if mask_size > len(self._mask):
+            self._mask = np.zeros((mask_size * 2,), dtype=np.int32)
+
+    def build(
+        self, observations: Sequence[AnyObservation], total_length: int = None
+    ) -> MathyArrayWindowObservation:
+        """Combine a sequence of observations into an observation window"""
+        window = len(observations)
+        lengths = [_observation_length(o) for o in observations]
+        mask_length = max([_observation_mask_length(o) for o in observations])
+        length = max(lengths) if total_length is None else total_length
+        size = window * length
+        self._reserve(size, window * mask_length)
+        nodes = self._nodes[:size].reshape((window, length))
+        values = self._values[:size].reshape((window, length))
+        types = self._type[: size * 2].reshape((window, length, 2))
+        time = self._time[:size].reshape((window, length, 1))
+        mask = self._mask[: window * mask_length].reshape((window, mask_length))
+        nodes.fill(MathTypeKeys["empty"])
+        values.fill(0.0)
+        mask.fill(0)
+        for i, (obs, obs_length) in enumerate(zip(observations, lengths)):
+            obs_mask = _observation_mask_length(obs)
+            nodes[i, :obs_length] = obs.nodes[:obs_length]
+            values[i, :obs_length] = obs.values[:obs_length]
+            if isinstance(obs.mask, SparseActionMask):
+                mask[i][list(obs.mask.actions)] = 1
+            else:
+                mask[i, :obs_mask] = obs.mask[:obs_mask]
+            # repeat type/time values so they can be combined with nodes/values
+            types[i, :] = obs.type
+            time[i, :] = obs.time
+        return MathyArrayWindowObservation(
+            nodes=nodes, mask=mask, values=values, type=types, time=time
+        )
+
+
+def _observation_length(observation: AnyObservation) -> int:
+    if isinstance(observation, MathyArrayObservation):
+        return observation.length
+    return len(observation.nodes)
+
+
+def _observation_mask_length(observation: AnyObservation) -> int:
+    if isinstance(observation, MathyArrayObservation):
+        rules = len(observation.mask) // max(len(observation.nodes), 1)
+        return observation.length * rules
+    return len(observation.mask)
+
+
 class MathyEnvState(object):
     """Class for holding environment state and extracting features
     to be passed to the policy/value neural network.
@@ -174,12 +656,14 @@ class MathyEnvState(object):
     ):
         self.max_moves = max_moves
         self.num_rules = num_rules
+        self._observation: Optional[Tuple[Any, tuple, MathyObservation]] = None
         if problem is not None:
             self.agent = MathyAgentState(max_moves, problem, problem_type)
         elif state is not None:
             self.num_rules = state.num_rules
             self.max_moves = state.max_moves
             self.agent = MathyAgentState.copy(state.agent)
+            self._observation = state._observation
 
     @classmethod
     def copy(cls, from_state):
@@ -195,49 +679,62 @@ class MathyEnvState(object):
         history and agent information based on an action being taken."""
         out_state = MathyEnvState.copy(self)
         agent = out_state.agent
-        agent.history.append(MathyEnvStateStep(problem, focus, action))
+        agent.add_step(MathyEnvStateStep(problem, focus, action))
         agent.problem = problem
         agent.action = action
         agent.moves_remaining = moves_remaining
         return out_state
 
+    def get_observation_key(self) -> tuple:
+        """Return the values that an observation of this state is made from"""
+        agent = self.agent
+        return (
+            agent.problem,
+            agent.problem_type,
+            agent.moves_remaining,
+            self.max_moves,
+        )
+
+    def get_cached_observation(self, owner: Any) -> Optional[MathyObservation]:
+        """Return the observation that `owner` cached for this state, if the
+        state hasn't changed since it was cached."""
+        cached = self._observation
+        if cached is None or cached[0] is not owner:
+            return None
+        if cached[1] != self.get_observation_key():
+            return None
+        return cached[2]
+
+    def set_cached_observation(self, owner: Any, observation: MathyObservation):
+        """Cache the observation that `owner` (usually an environment) made of
+        this state, so the next request for it doesn't featurize it again.
+
+        The observation is shared by everyone that asks for it, so it must not be
+        modified."""
+        self._observation = (owner, self.get_observation_key(), observation)
+
+    def clear_cached_observation(self) -> None:
+        self._observation = None
+
     def get_problem_hash(self) -> ProblemTypeIntList:
         """Return a two element array with hashed values for the current environment
         namespace string.
 
         # Example
 
-        - `mycorp.envs.solve_impossible_problems` -> `[12375561, -2838517]`
+        - `mycorp.envs.solve_impossible_problems` -> `[88, 108]`
 
         """
-        # NOTE: import delayed to enable MP
-        import tensorflow as tf
-
-        global _problem_hash_cache
-        if _problem_hash_cache is None:
-            _problem_hash_cache = {}
-        if self.agent.problem_type not in _problem_hash_cache:
-            problem_hash_one = tf.strings.to_hash_bucket_strong(
-                self.agent.problem_type, PROBLEM_TYPE_HASH_BUCKETS, [1337, 61059873]
-            )
-            problem_hash_two = tf.strings.to_hash_bucket_strong(
-                self.agent.problem_type, PROBLEM_TYPE_HASH_BUCKETS, [7, -242315]
-            )
-            _problem_hash_cache[self.agent.problem_type] = [
-                int(problem_hash_one.numpy()),
-                int(problem_hash_two.numpy()),
-            ]
-        return _problem_hash_cache[self.agent.problem_type]
+        return get_problem_type_hash(self.agent.problem_type)
 
     def to_start_observation(self) -> MathyObservation:
         """Generate an episode start MathyObservation"""
         num_actions = 1 * self.num_rules
         hash = self.get_problem_hash()
-        mask = [0] * num_actions
         values = [0.0]
         return MathyObservation(
             nodes=[MathTypeKeys["empty"]],
-            mask=mask,
+            mask=SparseActionMask((), num_actions),
             values=values,
             type=[0],
             time=[0.0],
@@ -245,17 +742,19 @@ class MathyEnvState(object):
 
     def to_observation(
         self,
-        move_mask: Optional[NodeMaskIntList] = None,
+        move_mask: Optional[ObservationMask] = None,
         hash_type: Optional[ProblemTypeIntList] = None,
         parser: Optional[ExpressionParser] = None,
+        nodes: Optional[List[MathExpression]] = None,
     ) -> MathyObservation:
-        """Convert a state into an observation"""
-        if parser is None:
-            parser = ExpressionParser()
+        """Convert a state into an observation. If the expression `nodes` for the
+        current problem are given, they are used instead of parsing the text."""
         if hash_type is None:
             hash_type = self.get_problem_hash()
-        expression = parser.parse(self.agent.problem)
-        nodes: List[MathExpression] = expression.to_list()
+        if nodes is None:
+            if parser is None:
+                parser = ExpressionParser()
+            nodes = parser.parse(self.agent.problem).to_list()
         vectors: NodeIntList = []
         values: NodeValuesFloatList = []
         if move_mask is None:
@@ -297,7 +796,7 @@ class MathyEnvState(object):
         history = inputs[6:]
         for step in history:
             raw, focus, action = step.split(history_sep)
-            state.agent.history.append(MathyEnvStateStep(raw, int(focus), int(action)))
+            state.agent.add_step(MathyEnvStateStep(raw, int(focus), int(action)))
         return state
 
     def to_string(self) -> str:
@@ -317,25 +816,201 @@ class MathyEnvState(object):
         return sep.join(out)
 
     @classmethod
-    def from_np(cls, input_bytes: np.ndarray) -> "MathyEnvState":
-        """Convert a numpy object into a state object"""
-        input_string = "".join([chr(o) for o in input_bytes.tolist()])
-        state = cls.from_string(input_string)
+    def from_bytes(cls, input_bytes: bytes) -> "MathyEnvState":
+        """Convert the binary representation from `to_bytes` into a state object"""
+        (
+            magic,
+            version,
+            size,
+            max_moves,
+            num_rules,
+            moves_remaining,
+            reward,
+            problem_index,
+            problem_type_index,
+            num_strings,
+            num_steps,
+        ) = _STATE_HEADER.unpack_from(input_bytes, 0)
+        if magic != STATE_FORMAT_MAGIC:
+            raise ValueError("input is not a binary mathy state")
+        if version != STATE_FORMAT_VERSION:
+            raise ValueError(f"unsupported binary state version: {version}")
+        offset = _STATE_HEADER.size
+        steps = np.frombuffer(
+            input_bytes, dtype=_STATE_STEP_DTYPE, count=num_steps, offset=offset
+        )
+        offset += steps.nbytes
+        lengths = np.frombuffer(
+            input_bytes, dtype="<u4", count=num_strings, offset=offset
+        ).tolist()
+        offset += num_strings * 4
+        strings: List[str] = []
+        for length in lengths:
+            end = offset + length
+            strings.append(bytes(input_bytes[offset:end]).decode("utf8"))
+            offset = end
+        assert offset == size, "binary state size mismatch"
+        state = MathyEnvState()
+        state.max_moves = max_moves
+        state.num_rules = num_rules
+        state.agent = MathyAgentState(
+            moves_remaining=moves_remaining,
+            problem=strings[problem_index],
+            problem_type=strings[problem_type_index],
+            reward=reward,
+            history=[
+                MathyEnvStateStep(strings[raw], focus, action)
+                for raw, focus, action in steps.tolist()
+            ],
+        )
         return state
 
-    def to_np(self) -> np.ndarray:
-        """Convert a state object into a numpy representation"""
-        return np.array([ord(c) for c in self.to_string()])
+    def to_bytes(self) -> bytes:
+        """Convert a state object into a compact binary representation.
+
+        Each distinct string in the state is stored once, so the size grows with
+        the number of unique expressions in the history rather than with the
+        length of the string representation."""
+        assert self.agent is not None, "invalid state"
+        string_ids: Dict[str, int] = {}
+
+        def intern(value: str) -> int:
+            index = string_ids.get(value, None)
+            if index is None:
+                index = string_ids[value] = len(string_ids)
+            return index
+
+        problem_index = intern(self.agent.problem)
+        problem_type_index = intern(self.agent.problem_type)
+        history = self.agent.history
+        steps = np.empty((len(history),), dtype=_STATE_STEP_DTYPE)
+        steps[:] = [(intern(s.raw), s.focus, s.action) for s in history]
+        encoded = [value.encode("utf8") for value in string_ids]
+        lengths = np.array([len(e) for e in encoded], dtype="<u4")
+        size = _STATE_HEADER.size + steps.nbytes + lengths.nbytes + int(lengths.sum())
+        header = _STATE_HEADER.pack(
+            STATE_FORMAT_MAGIC,
+            STATE_FORMAT_VERSION,
+            size,
+            self.max_moves,
+            self.num_rules,
+            self.agent.moves_remaining,
+            self.agent.reward,
+            problem_index,
+            problem_type_index,
+            len(encoded),
+            len(steps),
+        )
+        return b"".join([header, steps.tobytes(), lengths.tobytes()] + encoded)
+
+    def get_serialized_size(self) -> int:
+        """Return the number of bytes used by the binary representation of this
+        state, before any padding is applied by `to_np`."""
+        return len(self.to_bytes())
+
+    @classmethod
+    def from_np(cls, input_bytes: np.ndarray) -> "MathyEnvState":
+        """Convert a numpy object into a state object.
+
+        Accepts the uint8 arrays from `to_np` (with or without trailing padding)
+        and the character code arrays produced by older versions of mathy. The
+        array may have been cast to another numeric dtype (e.g. by a swarm that
+        stores all walker states in one array)."""
+        magic = list(STATE_FORMAT_MAGIC)
+        if input_bytes[: len(magic)].tolist() != magic:
+            input_string = "".join([chr(o) for o in input_bytes.tolist()])
+            return cls.from_string(input_string)
+        return cls.from_bytes(input_bytes.astype(np.uint8, copy=False).tobytes())
+
+    def to_np(self, pad_to: Optional[int] = None) -> np.ndarray:
+        """Convert a state object into a numpy uint8 representation.
+
+        # Arguments
+        pad_to (Optional[int]): Pad the output with zeros to this many bytes so
+            that states with different history lengths have the same shape.
+
+        # Raises
+        StateCapacityError: If the encoded state is larger than `pad_to` bytes
+        """
+        data = self.to_bytes()
+        if pad_to is None:
+            return np.frombuffer(data, dtype=np.uint8).copy()
+        if len(data) > pad_to:
+            raise StateCapacityError(
+                f"encoded state is {len(data)} bytes, which does not fit in {pad_to}"
+            )
+        out = np.zeros((pad_to,), dtype=np.uint8)
+        out[: len(data)] = np.frombuffer(data, dtype=np.uint8)
+        return out
+
+
+def states_to_np(
+    states: Sequence[MathyEnvState], pad_to: Optional[int] = None
+) -> np.ndarray:
+    """Encode a batch of states into one `[len(states), width]` uint8 array.
+
+    # Arguments
+    states (Sequence[MathyEnvState]): The states to encode
+    pad_to (Optional[int]): The row width in bytes. When not given, rows are
+        padded to the size of the largest encoded state.
+
+    # Raises
+    StateCapacityError: If a state does not fit in `pad_to` bytes
+    """
+    encoded = [state.to_bytes() for state in states]
+    sizes = np.array([len(e) for e in encoded], dtype=np.int64)
+    largest = int(sizes.max()) if len(encoded) > 0 else 0
+    width = largest if pad_to is None else pad_to
+    if largest > width:
+        raise StateCapacityError(
+            f"encoded state is {largest} bytes, which does not fit in {width}"
+        )
+    # Write every state into one flat buffer, then view it as rows
+    out = np.zeros((len(encoded), width), dtype=np.uint8)
+    flat = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(encoded)), sizes)
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    out[rows, np.arange(len(flat)) - starts] = flat
+    return out
+
+
+def get_state_size_bound(max_moves: int, max_text_bytes: int) -> int:
+    """Return the largest number of bytes `MathyEnvState.to_bytes` can produce
+    for a state that has taken at most `max_moves` steps, when none of its
+    expressions (or its problem type) encode to more than `max_text_bytes`.
+
+    Use it to pick a `pad_to` width that every state of an episode fits in.
+    """
+    # The initial step, then one per move
+    steps = max_moves + 1
+    # Each step's expression, the problem and the problem type may all differ
+    strings = steps + 2
+    return (
+        _STATE_HEADER.size
+        + steps * _STATE_STEP_DTYPE.itemsize
+        + strings * (np.dtype("<u4").itemsize + max_text_bytes)
+    )
+
+
+def states_from_np(input_bytes: np.ndarray) -> List[MathyEnvState]:
+    """Decode a `[batch, width]` uint8 array from `states_to_np` into states"""
+    assert input_bytes.ndim == 2, "expected a [batch, width] array of states"
+    data = np.ascontiguousarray(input_bytes, dtype=np.uint8)
+    return [MathyEnvState.from_bytes(row.data) for row in data]
 
 
 class MathyAgentState:
-    """The state related to an agent for a given environment state"""
+    """The state related to an agent for a given environment state.
+
+    The history is a persistent `MathyHistory` that also holds the visit
+    counts, so copying an agent state or adding a step to it takes constant
+    time no matter how long the episode is."""
 
     moves_remaining: int
     problem: str
     problem_type: str
     reward: float
-    history: List[MathyEnvStateStep]
+    history: MathyHistory
 
     def __init__(
         self, moves_remaining, problem, problem_type, reward=0.0, history=None,
@@ -344,9 +1019,25 @@ class MathyAgentState:
         self.problem = problem
         self.reward = reward
         self.problem_type = problem_type
-        self.history = (
-            history[:] if history is not None else [MathyEnvStateStep(problem, -1, -1)]
-        )
+        if history is None:
+            history = MathyHistory([MathyEnvStateStep(problem, -1, -1)])
+        elif not isinstance(history, MathyHistory):
+            history = MathyHistory(history)
+        self.history = history
+
+    @property
+    def visits(self) -> VisitCounts:
+        """The number of times each problem text appears in the history"""
+        return self.history.visits
+
+    def add_step(self, step: MathyEnvStateStep) -> None:
+        """Append a step to the history and count a visit to its problem"""
+        self.history = self.history.append(step)
+
+    def get_visits(self, problem: str) -> int:
+        """Return the number of times the given problem text appears in the
+        history."""
+        return self.history.visits.get(problem, 0)
 
     @classmethod
     def copy(cls, from_state: "MathyAgentState"):
@@ -1,6 +1,6 @@
 """Use Fractal Monte Carlo search in order to solve mathy problems without a
 trained neural network."""
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from mathy_core import MathTypeKeysMax
@@ -15,6 +15,8 @@ from fragile.core.tree import HistoryTree
 from fragile.distributed.env import ParallelEnv
 
 from .. import EnvRewards, MathyEnv, MathyEnvState
+from ..envs.gym.mathy_gym_env import ObservationCapacityError
+from ..state import StateCapacityError, get_state_size_bound
 
 
 class SwarmConfig(BaseModel):
@@ -27,11 +29,20 @@ class SwarmConfig(BaseModel):
     max_iters: int = 100
 
 
+# The number of nodes the swarm's observations can hold. The flat observation
+# is the node ids followed by the action mask, so the mask starts here.
+SWARM_OBSERVATION_CAPACITY = 512
+
+
 def mathy_dist(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     return np.linalg.norm(x - y, axis=1)
 
 
 class DiscreteMasked(DiscreteModel):
+    def __init__(self, mask_start: int = SWARM_OBSERVATION_CAPACITY, **kwargs):
+        super(DiscreteMasked, self).__init__(**kwargs)
+        self.mask_start = mask_start
+
     def sample(
         self,
         batch_size: int,
@@ -48,10 +59,9 @@ class DiscreteMasked(DiscreteModel):
             return (a.cumsum(axis=axis) > r).argmax(axis=axis)
 
         if env_states is not None:
-            # Each state is a vstack([node_ids, mask]) and we only want the mask.
-            #
-            # Swap columns and slice the last element to get it.
-            masks = np.transpose(env_states.observs, [0, 2, 1])[:, :, -1]
+            # Each observation is the node ids followed by the action mask
+            mask_start = self.mask_start
+            masks = env_states.observs[:, mask_start:]
             actions = random_choice_prob_index(masks)
         else:
             actions = self.random_state.randint(0, self.n_actions, size=batch_size)
@@ -126,30 +136,47 @@ class FragileEnvironment:
         difficulty: str = "normal",
         problem: str = None,
         max_steps: int = 64,
+        max_expression_length: int = 256,
+        state_size: Optional[int] = None,
         **kwargs,
     ):
         import gym
         from gym import spaces
-        from ..envs.gym import MathyGymEnv
+        from ..envs.gym import MathyGymEnv, MathyVectorEnv
 
         self._env: MathyGymEnv = gym.make(
             f"mathy-{environment}-{difficulty}-v0",
             np_observation=True,
+            np_capacity=SWARM_OBSERVATION_CAPACITY,
             error_invalid=False,
             env_problem=problem,
+            env_max_moves=max_steps,
             **kwargs,
         )
+        # The swarm stores observations as float32 arrays, so the env's node and
+        # mask buffers are concatenated into one flat array per step
+        size = sum(space.shape[0] for space in self._env.observation_space.spaces)
         self.observation_space = spaces.Box(
-            low=0, high=MathTypeKeysMax, shape=(256, 256, 1), dtype=np.uint8,
+            low=0, high=MathTypeKeysMax, shape=(size,), dtype=np.float32,
         )
         self.action_space = spaces.Discrete(self._env.action_size)
         self.problem = problem
         self.max_steps = max_steps
+        # States are padded to a fixed number of bytes so walkers with different
+        # history lengths can be stored in the same array. The swarm allocates
+        # its state arrays once, so the width must fit a whole episode.
+        if state_size is None:
+            state_size = get_state_size_bound(max_steps, max_expression_length)
+        self.state_size = state_size
+        # Batches of walkers are stepped together through the gym env's MathyEnv
+        self._vector = MathyVectorEnv(mathy=self._env.mathy, auto_reset=False)
+        self._batch_observs = np.zeros((0, size), dtype=np.float32)
+        self._flat_obs = np.zeros((size,), dtype=np.float32)
         self._env.reset()
 
     def get_state(self) -> np.ndarray:
         assert self._env.state is not None, "env required to get_state"
-        return self._env.state.to_np()
+        return self._env.state.to_np(pad_to=self.state_size)
 
     def set_state(self, state: np.ndarray):
         assert self._env is not None, "env required to set_state"
@@ -157,32 +184,80 @@ class FragileEnvironment:
         return state
 
     def step(self, action: int, state: np.ndarray = None) -> tuple:
+        """Step a single walker's state. The observation is written into one
+        reused array, which is overwritten by the next call."""
         assert self._env is not None, "env required to step"
         assert state is not None, "only works with state stepping"
         self.set_state(state)
         obs, reward, _, info = self._env.step(action)
+        obs = self.flatten_observation(obs)
         oob = not info.get("valid", False)
-        new_state = self.get_state()
+        try:
+            new_state = self.get_state()
+        except StateCapacityError:
+            # The expression grew past the state width, so end this walker
+            # rather than the whole search
+            return state, obs, reward, True, info
         return new_state, obs, reward, oob, info
 
     def step_batch(
         self, actions, states=None, n_repeat_action: Union[int, np.ndarray] = None
     ) -> tuple:
-        data = [self.step(action, state) for action, state in zip(actions, states)]
-        new_states, observs, rewards, terminals, infos = [], [], [], [], []
-        for d in data:
-            new_state, obs, _reward, end, info = d
-            new_states.append(new_state)
-            observs.append(obs)
-            rewards.append(_reward)
+        """Step every walker's state at once. The observations are written into
+        one reused array, which is overwritten by the next call."""
+        assert states is not None, "only works with state stepping"
+        env_states = [MathyEnvState.from_np(state) for state in states]
+        next_states, window, _, _, masks, infos = self._vector.step_states(
+            env_states, actions
+        )
+        observs = self.write_observations(window.nodes, masks)
+        new_states, rewards, terminals = [], [], []
+        for state, next_state, info in zip(states, next_states, infos):
+            rewards.append(info["transition"].reward)
+            end = not info.get("valid", False)
+            try:
+                new_states.append(next_state.to_np(pad_to=self.state_size))
+            except StateCapacityError:
+                # The expression grew past the state width, so end this walker
+                # rather than the whole search
+                new_states.append(state)
+                end = True
             terminals.append(end)
-            infos.append(info)
         return new_states, observs, rewards, terminals, infos
 
+    def write_observations(self, nodes: np.ndarray, masks: np.ndarray) -> np.ndarray:
+        """Write a batch of padded node and mask rows into the flat observation
+        layout of the gym env, where each mask holds the probability of picking
+        each valid action at random."""
+        batch, length = nodes.shape
+        capacity = self._env.np_capacity
+        if length > capacity:
+            raise ObservationCapacityError(
+                f"state has {length} nodes, but the observations can only "
+                f"hold {capacity}. Pass a larger 'np_capacity' to the env."
+            )
+        if len(self._batch_observs) < batch:
+            self._batch_observs = np.zeros(
+                (batch, self._batch_observs.shape[1]), dtype=np.float32
+            )
+        observs = self._batch_observs[:batch]
+        observs.fill(0.0)
+        observs[:, :length] = nodes
+        counts = np.maximum(masks.sum(axis=1, keepdims=True), 1)
+        mask_end = capacity + masks.shape[1]
+        observs[:, capacity:mask_end] = masks / counts
+        return observs
+
     def reset(self, batch_size: int = 1):
         assert self._env is not None, "env required to reset"
         obs = self._env.reset()
-        return self.get_state(), obs
+        return self.get_state(), self.flatten_observation(obs)
+
+    def flatten_observation(self, observation: Tuple[np.ndarray, ...]) -> np.ndarray:
+        """Copy the env's observation buffers into one reused flat array, which
+        is overwritten by the next call. Fragile copies the observations that
+        `reset` and `make_transitions` return into its own arrays."""
+        return np.concatenate(observation, out=self._flat_obs)
 
 
 def mathy_swarm(config: SwarmConfig, env_callable=None) -> Swarm:
@@ -1,5 +1,7 @@
+import importlib
+import sys
 from importlib.util import find_spec
-from typing import Any, List, Union
+from typing import Any, Dict, List, Union
 
 import numpy as np
 
@@ -22,6 +24,40 @@ MISSING_LIBRARIES_ALERT = (
 MODULE_JOIN = "\n\t"
 
 
+def install_lazy_attributes(module_globals: Dict[str, Any], lazy: Dict[str, str]):
+    """Make a module import some of its attributes from submodules the first
+    time that they're accessed, rather than when the module is imported.
+
+    This keeps heavy dependencies (e.g. TensorFlow) from loading until they're
+    needed. Python 3.6 doesn't support module level `__getattr__`, so there
+    the attributes are imported immediately.
+
+    # Arguments
+    module_globals (Dict[str, Any]): The `globals()` of the module
+    lazy (Dict[str, str]): A map of attribute names to the (relative) name
+        of the module they are imported from
+    """
+    package = module_globals["__name__"]
+
+    def load(name: str) -> Any:
+        module = importlib.import_module(lazy[name], package)
+        value = getattr(module, name)
+        module_globals[name] = value
+        return value
+
+    if sys.version_info < (3, 7):  # pragma: no cover
+        for name in lazy.keys():
+            load(name)
+        return
+
+    def __getattr__(name: str) -> Any:
+        if name not in lazy:
+            raise AttributeError(f"module '{package}' has no attribute '{name}'")
+        return load(name)
+
+    module_globals["__getattr__"] = __getattr__
+
+
 def assert_fragile_installed():
     requires = ["fragile", "gym"]
     extra_name = "swarm"
@@ -48,3 +84,61 @@ def pad_array(in_list: List[Any], max_length: int, value: Any = 0) -> List[Any]:
     while len(in_list) < max_length:
         in_list.append(value)
     return in_list
+
+
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def _siphash_round(v0: int, v1: int, v2: int, v3: int):
+    def rotl(x: int, b: int) -> int:
+        return ((x << b) | (x >> (64 - b))) & _UINT64_MASK
+
+    v0 = (v0 + v1) & _UINT64_MASK
+    v1 = rotl(v1, 13) ^ v0
+    v0 = rotl(v0, 32)
+    v2 = (v2 + v3) & _UINT64_MASK
+    v3 = rotl(v3, 16) ^ v2
+    v0 = (v0 + v3) & _UINT64_MASK
+    v3 = rotl(v3, 21) ^ v0
+    v2 = (v2 + v1) & _UINT64_MASK
+    v1 = rotl(v1, 17) ^ v2
+    v2 = rotl(v2, 32)
+    return v0, v1, v2, v3
+
+
+def siphash24(key: List[int], data: bytes) -> int:
+    """Return the SipHash-2-4 of some bytes as an unsigned 64-bit integer.
+
+    This is the keyed hash that `tf.strings.to_hash_bucket_strong` uses, so
+    `siphash24(key, text.encode("utf8")) % buckets` produces the same bucket
+    without loading TensorFlow.
+
+    # Arguments
+    key (List[int]): Two integers that are used (as uint64) for the hash key
+    data (bytes): The bytes to hash
+    """
+    assert len(key) == 2, "key must contain two integers"
+    k0 = key[0] & _UINT64_MASK
+    k1 = key[1] & _UINT64_MASK
+    v0 = k0 ^ 0x736F6D6570736575
+    v1 = k1 ^ 0x646F72616E646F6D
+    v2 = k0 ^ 0x6C7967656E657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    end = length - length % 8
+    for i in range(0, end, 8):
+        m = int.from_bytes(data[i : i + 8], "little")
+        v3 ^= m
+        v0, v1, v2, v3 = _siphash_round(v0, v1, v2, v3)
+        v0, v1, v2, v3 = _siphash_round(v0, v1, v2, v3)
+        v0 ^= m
+    # The last block holds the remaining bytes and the length in its top byte
+    m = ((length & 0xFF) << 56) | int.from_bytes(data[end:], "little")
+    v3 ^= m
+    v0, v1, v2, v3 = _siphash_round(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _siphash_round(v0, v1, v2, v3)
+    v0 ^= m
+    v2 ^= 0xFF
+    for _ in range(4):
+        v0, v1, v2, v3 = _siphash_round(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
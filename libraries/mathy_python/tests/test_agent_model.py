@@ -0,0 +1,58 @@
+import numpy as np
+
+from mathy.agent import AgentConfig
+from mathy.agent.model import build_agent_model, call_agent_model
+from mathy.envs import PolySimplify
+from mathy.state import MathyEnvState, observations_to_window
+
+
+def test_agent_model_length_buckets():
+    env = PolySimplify()
+    config = AgentConfig(
+        units=16, embedding_units=16, use_length_buckets=True, length_buckets=[8, 32]
+    )
+    model = build_agent_model(config=config, predictions=env.action_size)
+    assert model.bucketed_call is not None
+    state = MathyEnvState(problem="4x + 2x", num_rules=len(env.rules))
+    observation = env.state_to_observation(state)
+    inputs = observations_to_window([observation]).to_inputs()
+    assert len(observation.nodes) <= 8
+    logits, values, rewards = call_agent_model(model, inputs)
+    expected_logits, expected_values, expected_rewards = model.call(inputs)
+    # The policy logits are sliced back to the input length
+    assert logits.shape == expected_logits.shape
+    np.testing.assert_allclose(logits.numpy(), expected_logits.numpy(), atol=1e-5)
+    # The padded nodes aren't averaged into the value and reward inputs
+    np.testing.assert_allclose(values.numpy(), expected_values.numpy(), atol=1e-5)
+    np.testing.assert_allclose(rewards.numpy(), expected_rewards.numpy(), atol=1e-5)
+    assert values.shape == (1, 1) and rewards.shape == (1, 1)
+    stats = model.bucketed_call.stats()
+    assert stats["bucket_8"] == 1 and stats["bucket_32"] == 0
+    # Calls with the same bucket reuse the compiled graph
+    call_agent_model(model, inputs)
+    assert model.bucketed_call.stats()["bucket_8"] == 2
+    assert len(model.bucketed_call._functions) == 1
+
+    # Sequences longer than the largest bucket are called eagerly
+    long_inputs = observations_to_window([observation], total_length=40).to_inputs()
+    logits, _, _ = call_agent_model(model, long_inputs)
+    assert logits.shape[1] == 40
+    assert model.bucketed_call.stats()["overflow"] == 1
+
+
+def test_agent_model_length_buckets_disabled():
+    config = AgentConfig(units=16, embedding_units=16)
+    model = build_agent_model(config=config, predictions=6)
+    assert model.bucketed_call is None
+
+
+def test_agent_model_learning_rate_summary_value():
+    from types import SimpleNamespace
+
+    from mathy.agent.util import get_learning_rate
+
+    model = build_agent_model(config=AgentConfig(lr_initial=0.01))
+    # The optimizer's "lr" is a schedule or a variable depending on TF version
+    assert float(get_learning_rate(model.opt, model.opt.iterations)) > 0.0
+    schedule = SimpleNamespace(lr=lambda step: step * 0.5)
+    assert get_learning_rate(schedule, 4) == 2.0
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from mathy.agent.returns import compute_returns, discounted_returns, lambda_returns
+from mathy.agent.trfl import scan_discounted_sum, td_lambda
+
+
+def get_segments(length: int, batch_size: int, seed: int = 1337):
+    rng = np.random.RandomState(seed)
+    shape = (length, batch_size)
+    rewards = rng.uniform(-1.0, 1.0, shape).astype(np.float32)
+    values = rng.uniform(-1.0, 1.0, shape).astype(np.float32)
+    discounts = rng.uniform(0.0, 1.0, shape).astype(np.float32)
+    # Zero discounts cut the returns off, like the end of an episode
+    discounts[rng.uniform(size=shape) < 0.2] = 0.0
+    bootstrap = rng.uniform(-1.0, 1.0, (batch_size,)).astype(np.float32)
+    return rewards, discounts, values, bootstrap
+
+
+@pytest.mark.parametrize("length,batch_size", [(1, 1), (8, 1), (12, 4), (64, 16)])
+def test_agent_returns_discounted_match_trfl(length: int, batch_size: int):
+    rewards, discounts, _, bootstrap = get_segments(length, batch_size)
+    expected = scan_discounted_sum(
+        tf.constant(rewards), tf.constant(discounts), tf.constant(bootstrap), True
+    )
+    actual = discounted_returns(rewards, discounts, bootstrap)
+    np.testing.assert_allclose(actual, expected.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("lambda_", [0.0, 0.2, 0.5, 1.0])
+@pytest.mark.parametrize("length,batch_size", [(1, 1), (8, 1), (12, 4), (64, 16)])
+def test_agent_returns_td_lambda_match_trfl(
+    length: int, batch_size: int, lambda_: float
+):
+    rewards, discounts, values, bootstrap = get_segments(length, batch_size)
+    expected = td_lambda(
+        state_values=tf.constant(values),
+        rewards=tf.constant(rewards),
+        pcontinues=tf.constant(discounts),
+        bootstrap_value=tf.constant(bootstrap),
+        lambda_=lambda_,
+    )
+    actual = compute_returns(rewards, discounts, values, bootstrap, lambda_)
+    np.testing.assert_allclose(
+        actual.lambda_returns, expected.extra.discounted_returns.numpy(), atol=1e-5
+    )
+    np.testing.assert_allclose(
+        actual.advantages, expected.extra.temporal_differences.numpy(), atol=1e-5
+    )
+    np.testing.assert_allclose(
+        lambda_returns(rewards, discounts, values, bootstrap, lambda_),
+        actual.lambda_returns,
+    )
+
+
+def test_agent_returns_constant_discount():
+    rewards = np.array([[1.0], [0.0], [2.0]], dtype=np.float32)
+    discounts = np.full_like(rewards, 0.5)
+    returns = discounted_returns(rewards, discounts, [4.0])
+    # 1 + 0.5 * 2, 0 + 0.5 * 4, 2 + 0.5 * 4
+    np.testing.assert_allclose(returns[:, 0], [2.0, 2.0, 4.0])
@@ -1,3 +1,4 @@
+import os
 import shutil
 import tempfile
 from unittest.mock import patch
@@ -6,6 +7,7 @@ from mathy.envs.gym.mathy_gym_env import safe_register
 from mathy.types import MathyEnvDifficulty, MathyEnvProblem, MathyEnvProblemArgs
 
 import pytest
+import srsly
 from click.testing import CliRunner
 
 from mathy.cli import cli
@@ -36,6 +38,24 @@ def test_cli_contribute():
         assert result.exit_code == 0
 
 
+def test_cli_bench():
+    runner = CliRunner()
+    output = tempfile.mktemp(suffix=".json")
+    args = ["bench", f"--output={output}", "--steps=10", "--repeat=2"]
+    result = runner.invoke(cli, args + ["--envs=binomial,complex"])
+    assert result.exit_code == 0
+    results = srsly.read_json(output)
+    env_names = set(results["env_steps"].keys())
+    assert env_names == {"BinomialDistribute", "ComplexSimplify"}
+    for difficulty in ["easy", "normal", "hard"]:
+        assert results["env_steps"]["ComplexSimplify"][difficulty]["steps"] == 10
+    for key in ["parse", "featurize", "get_valid_moves"]:
+        assert results["expressions"][key]["mean_ms"] > 0.0
+    assert "numpy_round_trip" in results["serialization"]
+    assert "batch_1_window_1" in results["model_forward"]
+    os.remove(output)
+
+
 def test_cli_problems():
     runner = CliRunner()
     for problem_type in ["poly", "poly-combine", "complex", "binomial"]:
@@ -48,6 +68,25 @@ def test_cli_problems():
     )
     result = runner.invoke(cli, ["problems", "invalid", "--number=100"])
     assert result.exit_code == 1
+    # An empty environment name is a usage error, not a crash
+    result = runner.invoke(cli, ["problems", ""])
+    assert not isinstance(result.exception, IndexError)
+    assert result.exit_code == 2
+
+
+def test_cli_problems_build():
+    runner = CliRunner()
+    folder = tempfile.mkdtemp()
+    args = ["problems", "build", "poly,complex", folder, "--number=50", "--workers=1"]
+    result = runner.invoke(cli, args + ["--difficulties=easy,hard"])
+    assert result.exit_code == 0
+    assert sorted(os.listdir(folder)) == [
+        "mathy.monomials.complex_simplify.easy.bank",
+        "mathy.monomials.complex_simplify.hard.bank",
+        "mathy.polynomials.simplify.easy.bank",
+        "mathy.polynomials.simplify.hard.bank",
+    ]
+    shutil.rmtree(folder)
 
 
 def test_cli_simplify():
@@ -85,3 +124,21 @@ def test_cli_train():
 
     # Comment this out to keep your model
     shutil.rmtree(model_folder)
+
+
+def test_cli_train_process_workers():
+    runner = CliRunner()
+    model_folder = tempfile.mkdtemp()
+    result = runner.invoke(
+        cli,
+        [
+            "train",
+            "poly",
+            model_folder,
+            "--episodes=2",
+            "--workers=2",
+            "--worker-mode=process",
+        ],
+    )
+    assert result.exit_code == 0
+    shutil.rmtree(model_folder)
@@ -3,9 +3,10 @@ import random
 import pytest
 
 from mathy.env import MathyEnv
+from mathy.envs import MATHY_BUILTIN_ENVS
 from mathy.envs.poly_simplify import PolySimplify
 from mathy.state import MathyEnvState
-from mathy.types import EnvRewards
+from mathy.types import EnvRewards, MathyEnvDifficulty, MathyEnvProblemArgs
 from mathy.util import is_terminal_transition
 
 
@@ -105,3 +106,372 @@ def test_env_finalize_state():
     )
     with pytest.raises(ValueError):
         env.finalize_state(env_state)
+
+
+def test_env_expression_cache_parses_once_per_step():
+    env = PolySimplify()
+    env_state, _ = env.get_initial_state()
+    cache = env.expression_cache
+    misses = cache.misses
+    env.get_valid_moves(env_state)
+    env.state_to_observation(env_state)
+    env.get_agent_actions_count(env_state)
+    assert cache.misses - misses <= 1
+    for i in range(3):
+        action = env.get_valid_moves(env_state).index(1)
+        misses = cache.misses
+        env_state, transition, _ = env.get_next_state(env_state, action)
+        env.state_to_observation(env_state)
+        env.get_valid_moves(env_state)
+        # Only the new problem text can miss
+        assert cache.misses - misses <= 1
+    assert cache.hits > 0
+    assert cache.stats()["hit_rate"] > 0.0
+
+
+def test_env_expression_cache_is_bounded():
+    env = MathyEnv(expression_cache_size=2)
+    for problem in ["4x + 2x", "3 + 4", "x * x", "4x + 2x"]:
+        env.get_valid_moves(MathyEnvState(problem=problem))
+    assert len(env.expression_cache) == 2
+    assert env.expression_cache.misses == 4
+    assert "x * x" in env.expression_cache
+    assert "3 + 4" not in env.expression_cache
+
+
+def test_env_expression_cache_node_index():
+    env = PolySimplify()
+    env_state, _ = env.get_initial_state()
+    for i in range(4):
+        entry = env.get_cached_expression(env_state.agent.problem)
+        expression = env.parser.parse(env_state.agent.problem)
+        assert [str(n) for n in entry.nodes] == [str(n) for n in expression.to_list()]
+        assert [str(n) for n in entry.inorder] == [
+            str(n) for n in expression.to_list("inorder")
+        ]
+        for index in range(len(entry.inorder)):
+            token = env.get_token_at_index(entry.expression, index)
+            assert entry.token_at(index) is token
+        assert entry.token_at(len(entry.inorder)) is None
+        # The indexed mask matches visiting the tree once per rule
+        moves = env.get_valid_moves(env_state)
+        assert moves == env.get_actions_for_node(expression)
+        rules = env.get_valid_rules(env_state)
+        assert rules == [
+            0 if len(rule.find_nodes(expression)) == 0 else 1 for rule in env.rules
+        ]
+        action = random.choice([i for i, m in enumerate(moves) if m == 1])
+        env_state, transition, _ = env.get_next_state(env_state, action)
+        if is_terminal_transition(transition):
+            break
+
+
+def test_env_revisit_penalty_scales_with_visits():
+    env = PolySimplify()
+    env_state = MathyEnvState(problem="4x + 2x", max_moves=10)
+    problem = env_state.agent.problem
+    for i in range(3):
+        env_state = env_state.get_out_state(
+            problem=problem, focus=0, action=0, moves_remaining=9 - i
+        )
+        transition = env.get_state_transition(env_state)
+        assert transition.reward == EnvRewards.PREVIOUS_LOCATION * (i + 2)
+
+
+@pytest.mark.parametrize("env_class", MATHY_BUILTIN_ENVS)
+def test_env_incremental_masks_match_full_masks(env_class):
+    random.seed(1337)
+    env = env_class(incremental_masks=True)
+    full = env_class()
+    assert env.mask_cache is not None and full.mask_cache is None
+    args = MathyEnvProblemArgs(difficulty=MathyEnvDifficulty.hard)
+    for _ in range(3):
+        env_state, _ = env.get_initial_state(args, print_problem=False)
+        for _ in range(20):
+            moves = env.get_valid_moves(env_state)
+            assert moves == full.get_valid_moves(env_state)
+            expression = env.parser.parse(env_state.agent.problem)
+            assert moves == env.get_actions_for_node(expression)
+            actions = [i for i, m in enumerate(moves) if m == 1]
+            if len(actions) == 0:
+                break
+            env_state, transition, _ = env.get_next_state(
+                env_state, random.choice(actions)
+            )
+            if is_terminal_transition(transition):
+                break
+    # Most nodes keep their context between steps, so their rows are reused,
+    # and leaf nodes are skipped because no core rule applies to them
+    stats = env.mask_cache.stats()
+    assert stats["node_hits"] > 0
+    assert stats["node_hits"] + stats["node_skips"] > stats["node_checks"]
+
+
+def test_env_rule_node_types_prefilter():
+    from mathy_core.expressions import AddExpression
+    from mathy_core.rules import CommutativeSwapRule
+
+    class CountingRule(CommutativeSwapRule):
+        node_types = (AddExpression,)
+        checked = 0
+
+        def can_apply_to(self, node):
+            CountingRule.checked += 1
+            return super().can_apply_to(node)
+
+    rule = CountingRule()
+    env = MathyEnv(rules=[rule], incremental_masks=False)
+    expression = env.parser.parse("4x + 2y * 3 + 7")
+    nodes = expression.to_list("inorder")
+    expected = [1 if isinstance(n, AddExpression) else 0 for n in nodes]
+    # Custom rules are only asked about the node types they opt in to
+    assert env.get_actions_for_node(expression) == expected
+    assert CountingRule.checked == 2
+    env_state = MathyEnvState(problem="4x + 2y * 3 + 7")
+    assert env.get_valid_moves(env_state) == expected
+    assert CountingRule.checked == 4
+
+
+@pytest.mark.parametrize("env_class", MATHY_BUILTIN_ENVS)
+def test_env_prefiltered_masks_match_unfiltered_masks(env_class):
+    random.seed(1337)
+    env = env_class()
+    args = MathyEnvProblemArgs(difficulty=MathyEnvDifficulty.hard)
+    rule_count = len(env.rules)
+    for _ in range(5):
+        env_state, _ = env.get_initial_state(args, print_problem=False)
+        expression = env.parser.parse(env_state.agent.problem)
+        expected = [0] * rule_count * len(expression.to_list())
+        for rule_index, rule in enumerate(env.rules):
+            for node in rule.find_nodes(expression):
+                expected[node.r_index * rule_count + rule_index] = 1
+        assert env.get_actions_for_node(expression) == expected
+        assert env.get_valid_moves(env_state) == expected
+
+
+def test_env_valid_actions_are_sparse_valid_moves():
+    env = PolySimplify()
+    env_state, _ = env.get_initial_state(print_problem=False)
+    for _ in range(5):
+        valid_actions = env.get_valid_actions(env_state)
+        moves = env.get_valid_moves(env_state)
+        assert isinstance(valid_actions, tuple)
+        assert list(valid_actions) == [i for i, m in enumerate(moves) if m == 1]
+        rules = [0] * len(env.rules)
+        for action in valid_actions:
+            rules[action % len(env.rules)] = 1
+        assert env.get_valid_rules(env_state) == rules
+        env_state, _, _ = env.get_next_state(env_state, valid_actions[0])
+
+
+def test_env_observations_carry_sparse_masks():
+    import numpy as np
+
+    from mathy.masks import SparseActionMask
+    from mathy.state import (
+        MathyArrayObservation,
+        ObservationWindowBuffer,
+        observations_to_window,
+    )
+
+    env = PolySimplify()
+    env_state, _ = env.get_initial_state(print_problem=False)
+    observations = []
+    for _ in range(3):
+        observation = env.state_to_observation(env_state)
+        valid_actions = env.get_valid_actions(env_state)
+        assert isinstance(observation.mask, SparseActionMask)
+        assert observation.mask.actions == valid_actions
+        # It still reads like the dense mask
+        moves = env.get_valid_moves(env_state)
+        assert observation.mask == moves
+        assert list(observation.mask) == moves
+        assert np.asarray(observation.mask).tolist() == moves
+        assert [observation.mask[i] for i in range(len(moves))] == moves
+        observations.append(observation)
+        env_state, _, _ = env.get_next_state(env_state, valid_actions[0])
+    # The windows are dense
+    window = observations_to_window(observations)
+    width = max(len(o.mask) for o in observations)
+    expected = [o.mask.to_list() + [0] * (width - len(o.mask)) for o in observations]
+    assert window.mask == expected
+    np.testing.assert_array_equal(
+        ObservationWindowBuffer().build(observations).mask, np.array(expected)
+    )
+    arrays = [MathyArrayObservation.from_observation(o, 64) for o in observations]
+    np.testing.assert_array_equal(
+        ObservationWindowBuffer().build(arrays).mask, np.array(expected)
+    )
+
+
+def test_env_gym_action_space_samples_valid_actions():
+    import gym
+    from mathy.envs.gym import MathyGymEnv
+
+    env: MathyGymEnv = gym.make("mathy-poly-easy-v0")
+    env.reset()
+    assert env.state is not None
+    valid_actions = env.mathy.get_valid_actions(env.state)
+    assert env.action_space.n == env.mathy.get_agent_actions_count(env.state)
+    assert env.action_space.mask.tolist() == env.mathy.get_valid_moves(env.state)
+    env.action_space.seed(1337)
+    for _ in range(20):
+        assert env.action_space.sample() in valid_actions
+
+
+def test_env_step_featurizes_each_state_once():
+    import gym
+    from mathy.envs.gym import MathyGymEnv
+    from mathy.state import observations_to_window
+
+    env: MathyGymEnv = gym.make("mathy-poly-easy-v0")
+    env.reset()
+    assert env.state is not None
+    action = env.mathy.get_valid_actions(env.state)[0]
+    observation, _, _, info = env.step(action)
+    # The gym observation is the one the transition was computed with
+    assert observation is info["transition"].observation
+    assert env.mathy.state_to_observation(env.state) is observation
+    # Windows pad copies, so the shared observation isn't modified
+    length = len(observation.nodes)
+    longer = env.mathy.state_to_observation(
+        MathyEnvState(problem="4x + 2x + 7y + 3 + 2 + x", max_moves=10)
+    )
+    observations_to_window([observation, longer])
+    assert len(observation.nodes) == length
+    # Changing the state invalidates its cached observation
+    env.state.agent.moves_remaining -= 1
+    assert env.mathy.state_to_observation(env.state) is not observation
+    # Other envs don't use each other's observations
+    other = PolySimplify()
+    assert other.state_to_observation(env.state) is not observation
+
+
+@pytest.mark.parametrize("env_class", MATHY_BUILTIN_ENVS)
+def test_env_reuse_trees_matches_parsed_trees(env_class):
+    random.seed(1337)
+    env = env_class()
+    parsed = env_class(reuse_trees=False)
+    args = MathyEnvProblemArgs(difficulty=MathyEnvDifficulty.normal)
+    steps = 0
+    for _ in range(3):
+        env_state, _ = env.get_initial_state(args, print_problem=False)
+        parsed_state = MathyEnvState.copy(env_state)
+        for _ in range(20):
+            actions = env.get_valid_actions(env_state)
+            assert actions == parsed.get_valid_actions(parsed_state)
+            if len(actions) == 0:
+                break
+            action = random.choice(actions)
+            env_state, transition, _ = env.get_next_state(env_state, action)
+            parsed_state, expected, _ = parsed.get_next_state(parsed_state, action)
+            steps += 1
+            assert env_state.agent.problem == parsed_state.agent.problem
+            assert transition.reward == expected.reward
+            assert transition.observation == expected.observation
+            if is_terminal_transition(transition):
+                break
+    # Only the initial problems are parsed
+    assert env.expression_cache.misses <= 3
+    assert parsed.expression_cache.misses > 3
+    assert steps > 3
+
+
+def test_env_gym_np_observation_buffers():
+    import gym
+    import numpy as np
+    from mathy.envs.gym import MathyGymEnv
+
+    env: MathyGymEnv = gym.make("mathy-poly-easy-v0", np_observation=True)
+    nodes, mask = env.reset()
+    assert env.state is not None
+    assert nodes.dtype == np.int16 and mask.dtype == np.float32
+    assert env.observation_space.contains((nodes, mask))
+    observation = env.mathy.state_to_observation(env.state)
+    length = len(observation.nodes)
+    assert nodes[:length].tolist() == observation.nodes
+    assert not nodes[length:].any()
+    valid_actions = env.mathy.get_valid_actions(env.state)
+    assert np.flatnonzero(mask).tolist() == list(valid_actions)
+    np.testing.assert_almost_equal(mask.sum(), 1.0)
+    # The same buffers are written by every step
+    next_nodes, next_mask = env.step(valid_actions[0])[0]
+    assert next_nodes is nodes and next_mask is mask
+    assert np.flatnonzero(mask).tolist() == list(env.mathy.get_valid_actions(env.state))
+
+
+def test_env_gym_np_observation_capacity():
+    import gym
+    import numpy as np
+    from mathy.envs.gym import MathyGymEnv, ObservationCapacityError
+
+    env: MathyGymEnv = gym.make(
+        "mathy-poly-easy-v0",
+        np_observation=True,
+        np_capacity=8,
+        np_mask_dtype="uint8",
+        env_problem="4x + 2x",
+        repeat_problem=True,
+    )
+    assert env.observation_space[1].shape == (8 * env.mathy.action_size,)
+    nodes, mask = env.reset()
+    assert mask.dtype == np.uint8 and set(mask.tolist()) == {0, 1}
+    with pytest.raises(ObservationCapacityError):
+        env.reset_with_input("4x + 2x + 7y + 3 + 2 + x")
+
+
+def test_env_gym_registered_ids_make_named_classes():
+    import gym
+    from gym.envs.registration import load
+
+    from mathy.envs.gym import MATHY_GYM_ENVS, MathyGymEnv
+
+    # Other tests register their own envs, so only check the builtin ones
+    registered = {
+        spec.id: spec.entry_point
+        for spec in gym.envs.registry.all()
+        if str(spec.entry_point).startswith("mathy.envs.gym:")
+    }
+    assert set(registered.keys()) == set(env_id for env_id, _ in MATHY_GYM_ENVS)
+    for env_id, class_name in MATHY_GYM_ENVS:
+        assert registered[env_id] == f"mathy.envs.gym:{class_name}"
+        env_class = load(registered[env_id])
+        assert env_class.__name__ == class_name
+        assert issubclass(env_class, MathyGymEnv)
+
+
+def test_env_gym_env_pool_reuses_envs():
+    from mathy.envs.gym import MathyGymEnvPool
+
+    pool = MathyGymEnvPool({"repeat_problem": True})
+    easy = pool.get("mathy-poly-easy-v0")
+    assert pool.get("mathy-poly-easy-v0") is easy
+    assert easy.repeat_problem is True
+    hard = pool.get("mathy-poly-hard-v0")
+    assert hard is not easy
+    assert len(pool) == 2 and "mathy-poly-hard-v0" in pool
+    # The envs share the core rule instances
+    assert all(a is b for a, b in zip(easy.mathy.rules, hard.mathy.rules))
+    # A reused env starts each episode from its repeated problem
+    easy.reset()
+    assert easy.state is not None
+    problem = easy.state.agent.problem
+    easy.step(easy.mathy.get_valid_actions(easy.state)[0])
+    easy.reset()
+    assert easy.state.agent.problem == problem
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_env_gym_only_generates_repeated_problem_when_needed():
+    import gym
+    from mathy.envs.gym import MathyGymEnv
+
+    env: MathyGymEnv = gym.make("mathy-poly-easy-v0")
+    assert env._challenge is None
+    env.reset()
+    assert env._challenge is None
+    env = gym.make("mathy-poly-easy-v0", repeat_problem=True)
+    assert env._challenge is None
+    env.reset()
+    assert env._challenge is not None
@@ -1,4 +1,18 @@
+import numpy as np
+import pytest
+
 from mathy import MathyEnvState
+from mathy.envs import MATHY_BUILTIN_ENVS
+from mathy.state import (
+    BUILTIN_PROBLEM_TYPE_HASHES,
+    PROBLEM_TYPE_HASH_BUCKETS,
+    PROBLEM_TYPE_HASH_KEYS,
+    MathyEnvStateStep,
+    MathyHistory,
+    get_problem_type_hash,
+    states_from_np,
+    states_to_np,
+)
 
 
 def test_env_state():
@@ -51,7 +65,202 @@ def test_env_state_serialize_numpy():
         assert one.action == two.action
 
 
+def test_env_state_serialize_numpy_padded():
+    env_state = MathyEnvState(problem="4x+2", problem_type="mathy.test")
+    for i in range(10):
+        env_state = env_state.get_out_state(
+            problem=f"2+{i}x", focus=i, moves_remaining=10 - i, action=i
+        )
+    size = env_state.get_serialized_size()
+    state_np = env_state.to_np(pad_to=size + 32)
+    assert state_np.dtype == np.uint8
+    assert state_np.shape == (size + 32,)
+    compare = MathyEnvState.from_np(state_np)
+    assert compare.to_string() == env_state.to_string()
+    # Swarms may cast the states array to another dtype
+    compare = MathyEnvState.from_np(state_np.astype(np.float64))
+    assert compare.to_string() == env_state.to_string()
+    with pytest.raises(ValueError):
+        env_state.to_np(pad_to=size - 1)
+
+
+def test_env_state_serialize_numpy_legacy():
+    """Character code arrays from older versions can still be decoded"""
+    env_state = MathyEnvState(problem="4x+2")
+    env_state = env_state.get_out_state(
+        problem="2+4x", focus=1, moves_remaining=9, action=3
+    )
+    legacy = np.array([ord(c) for c in env_state.to_string()])
+    compare = MathyEnvState.from_np(legacy)
+    assert compare.to_string() == env_state.to_string()
+
+
+def test_env_state_serialize_numpy_batch():
+    states = [MathyEnvState(problem="4x+2")]
+    for i in range(5):
+        states.append(
+            states[-1].get_out_state(
+                problem=f"{i}y", focus=i, moves_remaining=10 - i, action=i
+            )
+        )
+    batch = states_to_np(states)
+    assert batch.dtype == np.uint8
+    assert batch.shape == (6, max(s.get_serialized_size() for s in states))
+    for one, two in zip(states, states_from_np(batch)):
+        assert one.to_string() == two.to_string()
+    assert states_to_np(states, pad_to=1024).shape == (6, 1024)
+    with pytest.raises(ValueError):
+        states_to_np(states, pad_to=8)
+
+
 def test_env_state_to_observation():
     """to_observation has defaults to allow calling with no arguments"""
     env_state = MathyEnvState(problem="4x+2")
     assert env_state.to_observation() is not None
+
+
+def test_env_state_visit_counts():
+    env_state = MathyEnvState(problem="4x+2")
+    problems = ["2+4x", "4x+2", "2+4x", "2+4x"]
+    for i, problem in enumerate(problems):
+        parent = env_state
+        before = parent.agent.get_visits(problem)
+        env_state = env_state.get_out_state(
+            problem=problem, focus=i, moves_remaining=10 - i, action=i
+        )
+        # Counting a visit doesn't change the state it was copied from
+        assert parent.agent.get_visits(problem) == before
+        assert env_state.agent.get_visits(problem) == before + 1
+    agent = env_state.agent
+    assert agent.get_visits("4x+2") == 2
+    assert agent.get_visits("2+4x") == 3
+    assert agent.get_visits("4x") == 0
+    # Deserialized states rebuild the same counts from their history
+    for compare in [
+        MathyEnvState.from_string(env_state.to_string()),
+        MathyEnvState.from_np(env_state.to_np()),
+    ]:
+        assert compare.agent.visits == agent.visits
+
+
+def test_env_state_history_is_list_compatible():
+    steps = [MathyEnvStateStep(f"{i}x", i, i) for i in range(5)]
+    history = MathyHistory(steps)
+    assert len(history) == 5
+    assert list(history) == steps
+    assert history == steps
+    assert history[:] == steps
+    assert history[1:3] == steps[1:3]
+    for i in range(-5, 5):
+        assert history[i] == steps[i]
+    with pytest.raises(IndexError):
+        history[5]
+    with pytest.raises(IndexError):
+        history[-6]
+    assert len(MathyHistory()) == 0
+    assert list(MathyHistory()) == []
+
+
+def test_env_state_history_is_shared_between_copies():
+    env_state = MathyEnvState(problem="4x+2")
+    for i in range(10):
+        env_state = env_state.get_out_state(
+            problem=f"{i}y", focus=i, moves_remaining=10 - i, action=i
+        )
+    history = env_state.agent.history
+    clone = env_state.clone()
+    # Cloning shares the history and visit counts rather than copying them
+    assert clone.agent.history is history
+    assert clone.agent.visits is env_state.agent.visits
+    # Stepping from either state leaves the other unchanged
+    a = clone.get_out_state(problem="4x+2", focus=0, moves_remaining=0, action=0)
+    b = env_state.get_out_state(problem="2+4x", focus=0, moves_remaining=0, action=0)
+    assert len(env_state.agent.history) == len(clone.agent.history) == 11
+    assert a.agent.history[-1].raw == "4x+2"
+    assert a.agent.history[-2] is history[-1]
+    assert b.agent.history[-1].raw == "2+4x"
+    assert a.agent.get_visits("4x+2") == 2
+    assert b.agent.get_visits("4x+2") == 1
+    assert env_state.agent.get_visits("4x+2") == 1
+    assert env_state.agent.get_visits("2+4x") == 0
+
+
+def test_env_state_problem_hash_matches_tensorflow():
+    import tensorflow as tf
+
+    namespaces = [env().get_env_namespace() for env in MATHY_BUILTIN_ENVS]
+    # Every builtin environment has a precomputed hash
+    assert set(namespaces).issubset(BUILTIN_PROBLEM_TYPE_HASHES.keys())
+    others = ["", "a", "mycorp.envs.solve_impossible_problems", "ünïcode.envs"]
+    # Strings that fill 0-3 blocks and the partial block after them
+    others += ["x" * i for i in range(1, 25)]
+    for problem_type in list(BUILTIN_PROBLEM_TYPE_HASHES.keys()) + others:
+        expected = [
+            int(
+                tf.strings.to_hash_bucket_strong(
+                    problem_type, PROBLEM_TYPE_HASH_BUCKETS, key
+                ).numpy()
+            )
+            for key in PROBLEM_TYPE_HASH_KEYS
+        ]
+        assert get_problem_type_hash(problem_type) == expected
+        state = MathyEnvState(problem="4x+2", problem_type=problem_type)
+        assert state.get_problem_hash() == expected
+
+
+@pytest.mark.parametrize("collide", [False, True])
+def test_env_state_visit_counts_are_persistent(monkeypatch, collide: bool):
+    from collections import Counter
+    import random
+
+    import mathy.state
+    from mathy.state import VisitCounts
+
+    if collide:
+        # Every key hashes the same, so they all end up in one bucket
+        monkeypatch.setattr(mathy.state, "_visit_hash", lambda key: 7)
+    rng = random.Random(1337)
+    keys = [f"{i}x + {i}" for i in range(300)]
+    expected: Counter = Counter()
+    counts = VisitCounts()
+    snapshots = []
+    for _ in range(1000):
+        key = rng.choice(keys)
+        snapshots.append((counts, dict(expected)))
+        counts = counts.increment(key)
+        expected[key] += 1
+    assert counts == dict(expected)
+    assert len(counts) == len(expected)
+    # Earlier maps are unchanged by the increments that followed them
+    for snapshot, snapshot_expected in snapshots[::100]:
+        assert snapshot == snapshot_expected
+    assert counts.get("not visited", 0) == 0
+
+
+def test_env_state_visit_counts_pickle_across_processes():
+    import os
+    import pickle
+    import subprocess
+    import sys
+
+    from mathy.state import VisitCounts
+
+    counts = VisitCounts()
+    for i in range(100):
+        for _ in range(i % 3 + 1):
+            counts = counts.increment(f"{i}x + {i}")
+    # Load the counts in a process with a different str hash seed
+    script = (
+        "import pickle, sys\n"
+        "counts = pickle.loads(sys.stdin.buffer.read())\n"
+        "print(sum(counts[f'{i}x + {i}'] for i in range(100)), len(counts))\n"
+    )
+    env = dict(os.environ, PYTHONHASHSEED="1234")
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        input=pickle.dumps(counts),
+        stdout=subprocess.PIPE,
+        env=env,
+        check=True,
+    )
+    assert result.stdout.decode("utf8").split() == [str(sum(counts.values())), "100"]
@@ -1,9 +1,15 @@
 from typing import List, Tuple
 
+import numpy as np
 import pytest
 
 from mathy.envs.poly_simplify import PolySimplify
-from mathy.state import MathyEnvState
+from mathy.state import (
+    MathyArrayObservation,
+    MathyEnvState,
+    ObservationWindowBuffer,
+    observations_to_window,
+)
 
 
 def test_mathy_features_from_state():
@@ -31,3 +37,52 @@ def test_mathy_features_hierarchy():
         obs_two = state_two.to_observation(env.get_valid_moves(state_two))
 
         assert obs_one.nodes != obs_two.nodes
+
+
+def test_mathy_features_window_buffer_matches_list_window():
+    """The array window builder produces the same values as observations_to_window
+    while reusing its buffers between calls"""
+    env = PolySimplify()
+    observations = []
+    state, _ = env.get_initial_state()
+    for i in range(4):
+        observations.append(env.state_to_observation(state))
+        valid = [i for i, v in enumerate(env.get_valid_moves(state)) if v == 1]
+        state, _, _ = env.get_next_state(state, valid[0])
+    buffer = ObservationWindowBuffer(window_size=2, max_length=2)
+    window = buffer.build(observations)
+    # observations_to_window pads the lists in place, so give it copies
+    copies = [
+        o._replace(nodes=o.nodes[:], mask=o.mask[:], values=o.values[:])
+        for o in observations
+    ]
+    expected = observations_to_window(copies)
+    np.testing.assert_array_equal(window.nodes, np.array(expected.nodes))
+    np.testing.assert_array_equal(window.mask, np.array(expected.mask))
+    np.testing.assert_array_almost_equal(window.values, np.array(expected.values))
+    np.testing.assert_array_almost_equal(window.type, np.array(expected.type))
+    np.testing.assert_array_almost_equal(window.time, np.array(expected.time))
+    assert window.nodes.dtype == np.int32 and window.values.dtype == np.float32
+    assert window.nodes.flags["C_CONTIGUOUS"]
+
+    # Array observations build the same window, and the buffer is reused
+    arrays = [MathyArrayObservation.from_observation(o, 64) for o in observations]
+    array_window = buffer.build(arrays)
+    assert np.shares_memory(array_window.nodes, window.nodes)
+    np.testing.assert_array_equal(array_window.nodes, np.array(expected.nodes))
+    np.testing.assert_array_equal(array_window.mask, np.array(expected.mask))
+    inputs = array_window.to_inputs()
+    assert inputs["nodes_in"] is array_window.nodes
+    tensors = array_window.to_inputs(as_tf_tensor=True)
+    assert tensors["nodes_in"].dtype.name == "int32"
+    np.testing.assert_array_equal(tensors["nodes_in"].numpy(), array_window.nodes)
+    # Padding matches the list window padded to the same total length
+    length = window.nodes.shape[1] + 3
+    padded = observations_to_window(copies, total_length=length)
+    padded_inputs = array_window.to_inputs(pad_length=length)
+    for key, values in zip(["nodes_in", "mask_in", "values_in"], padded[:3]):
+        np.testing.assert_array_almost_equal(padded_inputs[key], np.array(values))
+    np.testing.assert_array_almost_equal(padded_inputs["type_in"], padded.type)
+    np.testing.assert_array_almost_equal(padded_inputs["time_in"], padded.time)
+    with pytest.raises(ValueError):
+        array_window.to_inputs(pad_length=1)
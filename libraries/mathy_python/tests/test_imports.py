@@ -0,0 +1,51 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# The most seconds a cold import of the environment path may take. This is
+# generous because CI machines vary, but it fails if TensorFlow is imported.
+IMPORT_TIME_BUDGET = 3.0
+
+IMPORT_CHECK = """
+import json, sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+heavy = [m for m in ["tensorflow", "tf_siren", "fragile"] if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def cold_import(imports: str) -> dict:
+    """Run imports in a new interpreter and report the time and heavy modules"""
+    code = IMPORT_CHECK.format(imports=imports)
+    output = subprocess.check_output([sys.executable, "-c", code])
+    return json.loads(output.decode("utf8").strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize(
+    "imports",
+    [
+        "import mathy",
+        "from mathy.envs import PolySimplify; PolySimplify().get_initial_state()",
+        "import gym, mathy.envs.gym; gym.make('mathy-poly-easy-v0')",
+        "from mathy.api import Mathy",
+        "from mathy.models import load_model",
+        "from mathy.agent import AgentConfig",
+        "from mathy.agent.episode_memory import EpisodeMemory",
+        "from mathy.cli import cli",
+    ],
+)
+def test_imports_do_not_load_heavy_modules(imports: str):
+    result = cold_import(imports)
+    assert result["heavy"] == []
+    assert result["seconds"] < IMPORT_TIME_BUDGET
+
+
+def test_imports_lazy_attributes():
+    result = cold_import("from mathy.agent import A3CAgent")
+    assert "tensorflow" in result["heavy"]
+    result = cold_import("from mathy.swarm import swarm_solve")
+    assert result["heavy"] == ["fragile"]
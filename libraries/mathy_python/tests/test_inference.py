@@ -0,0 +1,123 @@
+import threading
+
+import numpy as np
+
+from mathy.agent import AgentConfig
+from mathy.agent.action_selectors import (
+    apply_pi_mask,
+    get_valid_action_pairs,
+    masked_softmax,
+    predict_next,
+)
+from mathy.agent.inference import InferenceBatcher
+from mathy.agent.model import build_agent_model
+from mathy.envs import PolySimplify
+from mathy.state import observations_to_window
+
+
+def get_windows(env, count: int):
+    windows = []
+    for i in range(count):
+        state, _ = env.get_initial_state(print_problem=False)
+        observations = [env.state_to_observation(state)]
+        # Take a few steps so the windows have different sizes
+        for j in range(i % 3):
+            action = env.get_valid_moves(state).index(1)
+            state, _, _ = env.get_next_state(state, action)
+            observations.append(env.state_to_observation(state))
+        windows.append(observations_to_window(observations))
+    return windows
+
+
+def test_inference_batcher_matches_predict_next():
+    env = PolySimplify()
+    config = AgentConfig(units=16, embedding_units=16)
+    model = build_agent_model(config=config, predictions=env.action_size)
+    windows = get_windows(env, 5)
+    batcher = InferenceBatcher(model, max_batch_size=4)
+    results = batcher.predict_batch(windows)
+    assert len(results) == 5
+    for window, (probs, value) in zip(windows, results):
+        expected_probs, _ = predict_next(model, window.to_inputs(as_tf_tensor=True))
+        np.testing.assert_allclose(probs, expected_probs.numpy(), atol=1e-5)
+        assert isinstance(value, float)
+    stats = batcher.stats()
+    assert stats["batches"] == 2
+    assert stats["requests"] == 5
+    assert stats["fill_ratio"] == 5 / 8
+
+
+def test_inference_batcher_threads():
+    env = PolySimplify()
+    config = AgentConfig(units=16, embedding_units=16)
+    model = build_agent_model(config=config, predictions=env.action_size)
+    windows = get_windows(env, 4)
+    batcher = InferenceBatcher(model, max_batch_size=4, max_latency=0.5).start()
+    results = [None] * len(windows)
+
+    def worker(i: int):
+        results[i] = batcher.predict(windows[i])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    batcher.stop()
+    for window, (probs, _) in zip(windows, results):
+        expected_probs, _ = predict_next(model, window.to_inputs(as_tf_tensor=True))
+        np.testing.assert_allclose(probs, expected_probs.numpy(), atol=1e-5)
+    stats = batcher.stats()
+    assert stats["requests"] == 4
+    assert stats["batches"] < 4
+    assert stats["queue_wait_ms"] >= 0.0
+
+
+def test_masked_softmax_matches_dense_mask():
+    import tensorflow as tf
+
+    predictions = 3
+    logits = np.random.RandomState(1337).normal(size=(2, 4, predictions))
+    logits = tf.convert_to_tensor(logits, dtype=tf.float32)
+    masks = np.zeros((2, 4 * predictions), dtype=np.int32)
+    masks[0, [1, 5, 11]] = 1
+    masks[1, [0]] = 1
+    dense = apply_pi_mask(logits, masks, predictions)
+    expected = tf.nn.softmax(tf.reshape(dense, [2, -1])).numpy()
+    flat_logits = tf.reshape(logits, [2, -1])
+    probs = masked_softmax(flat_logits, get_valid_action_pairs(list(masks))).numpy()
+    np.testing.assert_allclose(probs, expected, atol=1e-6)
+    assert probs[1, 0] == 1.0
+    assert np.count_nonzero(probs[0]) == 3
+
+
+def test_prediction_window_matches_full_window():
+    from mathy.agent.episode_memory import EpisodeMemory
+    from mathy.state import MathyEnvState
+    from mathy.util import is_terminal_transition
+
+    env = PolySimplify()
+    config = AgentConfig(units=16, embedding_units=16)
+    model = build_agent_model(config=config, predictions=env.action_size)
+    memory = EpisodeMemory()
+    state = MathyEnvState(problem="4x + 2x + 3", max_moves=10)
+    # Start with a longer observation so the newest ones are padded
+    longer = env.state_to_observation(
+        MathyEnvState(problem="4x + 2y + 3x + 7 + 2y^2 + 12x", max_moves=10)
+    )
+    memory.store(observation=longer, action=0, reward=0.0, value=0.0)
+    for _ in range(8):
+        observation = env.state_to_observation(state)
+        for window_size in [2, 3, 6]:
+            full = memory.to_window_observation(observation, window_size=window_size)
+            full_inputs = full.to_inputs(as_tf_tensor=True)
+            full_probs, full_value = predict_next(model, full_inputs)
+            newest = memory.to_prediction_window(observation, window_size=window_size)
+            assert len(newest.nodes) == 1
+            assert newest.nodes.shape[1] == full.nodes.shape[1]
+            probs, value = predict_next(model, newest.to_inputs(as_tf_tensor=True))
+            np.testing.assert_allclose(probs.numpy(), full_probs.numpy(), atol=1e-5)
+            np.testing.assert_allclose(value.numpy(), full_value.numpy(), atol=1e-5)
+        action = env.get_valid_actions(state)[0]
+        memory.store(observation=observation, action=action, reward=0.0, value=0.0)
+        state, transition, _ = env.get_next_state(state, action)
+        if is_terminal_transition(transition):
+            break
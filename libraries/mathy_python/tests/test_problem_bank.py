@@ -0,0 +1,137 @@
+import gym
+import numpy as np
+import pytest
+
+from mathy.envs import PolySimplify
+from mathy.envs.gym import MathyGymEnv
+from mathy.problem_bank import (
+    ProblemBank,
+    build_problem_bank,
+    get_problem_bank_path,
+    load_problem_bank,
+    write_problem_bank,
+)
+from mathy.types import MathyEnvDifficulty
+
+
+def test_problem_bank_write_and_read(tmpdir):
+    file_path = str(tmpdir.join("test.bank"))
+    problems = [("4x + 2x", 2), ("", 0), ("ünïcode + 2", 2), ("x^2 * y", 1)]
+    write_problem_bank(file_path, problems, {"env_namespace": "mathy.test"})
+    bank = ProblemBank(file_path)
+    assert len(bank) == len(problems)
+    assert bank.meta["env_namespace"] == "mathy.test"
+    for i, (text, complexity) in enumerate(problems):
+        assert bank[i] == (text, complexity, "mathy.test")
+    assert bank[-1].text == "x^2 * y"
+    with pytest.raises(IndexError):
+        bank[len(problems)]
+    rng = np.random.RandomState(1337)
+    assert bank.sample(rng).text in [text for text, _ in problems]
+
+
+def test_problem_bank_rejects_other_files(tmpdir):
+    file_path = str(tmpdir.join("not.bank"))
+    with open(file_path, "wb") as f:
+        f.write(b"this is not a problem bank at all")
+    with pytest.raises(ValueError):
+        ProblemBank(file_path)
+
+
+def test_problem_bank_build_is_unique_and_reproducible(tmpdir):
+    def build(name: str, workers: int) -> ProblemBank:
+        file_path = str(tmpdir.join(name))
+        count = build_problem_bank(
+            file_path,
+            env_class=PolySimplify,
+            difficulty=MathyEnvDifficulty.easy,
+            number=200,
+            seed=7,
+            workers=workers,
+            chunk_size=64,
+        )
+        bank = ProblemBank(file_path)
+        assert count == len(bank) == 200
+        return bank
+
+    one = build("one.bank", workers=1)
+    two = build("two.bank", workers=2)
+    texts = [p.text for p in one]
+    assert len(set(texts)) == len(texts)
+    # The bank depends on the seed, not the number of worker processes
+    assert texts == [p.text for p in two]
+    assert one.meta["env_namespace"] == PolySimplify().get_env_namespace()
+
+
+def test_problem_bank_gym_env_samples_from_bank(tmpdir):
+    folder = str(tmpdir)
+    env = PolySimplify()
+    file_path = get_problem_bank_path(
+        folder, env.get_env_namespace(), MathyEnvDifficulty.easy
+    )
+    build_problem_bank(
+        file_path, PolySimplify, MathyEnvDifficulty.easy, number=50, chunk_size=50
+    )
+    texts = set(p.text for p in ProblemBank(file_path))
+
+    def reset_texts(seed: int):
+        gym_env: MathyGymEnv = gym.make(
+            "mathy-poly-easy-v0", problem_bank=folder, problem_bank_seed=seed
+        )
+        assert gym_env.problem_bank is not None
+        out = []
+        for _ in range(10):
+            gym_env.reset()
+            out.append(gym_env.state.agent.problem)
+        return out
+
+    first = reset_texts(1337)
+    assert all(text in texts for text in first)
+    assert first == reset_texts(1337)
+    # Environments without a bank in the folder generate their problems
+    with pytest.warns(UserWarning, match="no problem bank"):
+        gym_env: MathyGymEnv = gym.make("mathy-poly-hard-v0", problem_bank=folder)
+    assert gym_env.problem_bank is None
+    gym_env.reset()
+
+
+def test_problem_bank_load_rejects_other_environments(tmpdir):
+    from mathy.envs import BinomialDistribute
+
+    file_path = str(tmpdir.join("poly.bank"))
+    build_problem_bank(
+        file_path, PolySimplify, MathyEnvDifficulty.easy, number=10, chunk_size=10
+    )
+    env = PolySimplify()
+    assert load_problem_bank(file_path, env, MathyEnvDifficulty.easy) is not None
+    with pytest.raises(ValueError, match="has problems for"):
+        load_problem_bank(file_path, BinomialDistribute(), MathyEnvDifficulty.easy)
+    with pytest.raises(ValueError, match="has easy problems"):
+        load_problem_bank(ProblemBank(file_path), env, MathyEnvDifficulty.hard)
+
+
+def test_problem_bank_generate_only_skips_parse_errors():
+    from mathy.problem_bank import generate_problems
+    from mathy.types import MathyEnvProblem, MathyEnvProblemArgs
+
+    class BadProblems(PolySimplify):
+        texts = ["4x + 2x", "4x + $", "4x + (2", "2y + 3y"]
+
+        def problem_fn(self, params: MathyEnvProblemArgs) -> MathyEnvProblem:
+            return MathyEnvProblem(self.texts.pop(0), 1, self.get_env_namespace())
+
+    problems = generate_problems(BadProblems, MathyEnvProblemArgs(), 4, 1337)
+    assert [text for text, _ in problems] == ["4x + 2x", "2y + 3y"]
+
+    class Interrupted(PolySimplify):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+
+            def parse(text: str):
+                raise KeyboardInterrupt()
+
+            self.parser.parse = parse
+
+    # Interrupting a build stops it rather than skipping the problem
+    with pytest.raises(KeyboardInterrupt):
+        generate_problems(Interrupted, MathyEnvProblemArgs(), 4, 1337)
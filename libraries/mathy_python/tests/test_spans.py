@@ -0,0 +1,49 @@
+import os
+import tempfile
+
+import srsly
+
+from mathy.envs import PolySimplify
+from mathy.spans import NULL_SPAN, SpanTimer, spans
+
+
+def test_spans_disabled():
+    timer = SpanTimer()
+    assert timer.span("test") is NULL_SPAN
+    with timer.span("test"):
+        pass
+    assert timer.stats() == {}
+
+
+def test_spans_stats():
+    timer = SpanTimer(enabled=True, max_samples=10)
+    for i in range(20):
+        timer.record("test", i / 1000.0)
+    with timer.span("block"):
+        pass
+    stats = timer.stats()
+    assert set(stats.keys()) == {"block", "test"}
+    # The count covers every call, percentiles only the recent samples
+    assert stats["test"]["count"] == 20
+    assert stats["test"]["p50_ms"] == 14.5
+    assert stats["test"]["p50_ms"] <= stats["test"]["p95_ms"] <= stats["test"]["p99_ms"]
+    out_file = os.path.join(tempfile.mkdtemp(), "spans.json")
+    timer.write_json(out_file)
+    assert srsly.read_json(out_file)["block"]["count"] == 1
+    timer.reset()
+    assert timer.stats() == {}
+
+
+def test_spans_env_step():
+    env = PolySimplify()
+    state, _ = env.get_initial_state(print_problem=False)
+    spans.enabled = True
+    try:
+        action = env.get_valid_moves(state).index(1)
+        env.get_next_state(state, action)
+        stats = spans.stats()
+    finally:
+        spans.enabled = False
+        spans.reset()
+    for name in ["env/parse", "env/valid_moves", "env/featurize", "env/apply_rule"]:
+        assert stats[name]["count"] >= 1
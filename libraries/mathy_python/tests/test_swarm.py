@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+
+from mathy.state import MathyEnvState, get_state_size_bound
+from mathy.swarm.fragile import FragileEnvironment
+
+# A hard combine-in-place problem whose 64 move episodes encode to more than 8KB
+LONG_PROBLEM = (
+    "9u^3 + 9a^2 + 9l^2 + 11g^2 + 10x^4 + 5f^3 + 3z^3 + 12s^2 + 7c + 12n + 8p^3"
+    " + 10o^2 + 4j^3 + (d^4 + 3d^4) + 7w^4 + 1r + 12h^4 + 12k^2"
+)
+
+
+def get_env(**kwargs) -> FragileEnvironment:
+    return FragileEnvironment(
+        name="mathy_v0",
+        environment="poly-combine",
+        difficulty="hard",
+        problem=LONG_PROBLEM,
+        repeat_problem=True,
+        **kwargs,
+    )
+
+
+def random_action(env: FragileEnvironment, state: np.ndarray, rng: random.Random):
+    env.set_state(state)
+    return rng.choice(env._env.mathy.get_valid_actions(env._env.state))
+
+
+def test_swarm_state_fits_full_length_hard_episode():
+    env = get_env(max_steps=64)
+    assert env.state_size == get_state_size_bound(64, 256)
+    rng = random.Random(1337)
+    state, _ = env.reset()
+    sizes = []
+    done = False
+    while not done:
+        action = random_action(env, state, rng)
+        state, _, _, oob, info = env.step(action, state)
+        assert oob is False
+        assert state.shape == (env.state_size,)
+        decoded = MathyEnvState.from_np(state)
+        sizes.append(decoded.get_serialized_size())
+        done = info["done"]
+    assert len(decoded.agent.history) == 65
+    assert max(sizes) > 8192
+
+
+def test_swarm_state_too_large_ends_walker():
+    env = get_env(max_steps=64, state_size=2048)
+    rng = random.Random(1337)
+    state, _ = env.reset()
+    for _ in range(64):
+        action = random_action(env, state, rng)
+        next_state, _, _, oob, info = env.step(action, state)
+        if oob:
+            # The walker keeps the last state that fit instead of crashing
+            assert np.array_equal(next_state, state)
+            break
+        state = next_state
+    else:
+        raise AssertionError("expected a state to outgrow 2048 bytes")
+
+
+def test_swarm_step_batch_matches_step():
+    env = get_env(max_steps=64)
+    rng = random.Random(1337)
+    state, _ = env.reset()
+    states = [state] * 6
+    for _ in range(12):
+        actions = [random_action(env, s, rng) for s in states]
+        expected = []
+        for action, state in zip(actions, states):
+            e_state, e_obs, e_reward, e_end, e_info = env.step(action, state)
+            # Each step overwrites the same observation array
+            assert e_obs is env.step(action, state)[1]
+            expected.append((e_state, e_obs.copy(), e_reward, e_end, e_info))
+        new_states, observs, rewards, ends, infos = env.step_batch(actions, states)
+        assert observs.dtype == np.float32
+        assert observs.shape == (len(states),) + env.observation_space.shape
+        for i, (e_state, e_obs, e_reward, e_end, e_info) in enumerate(expected):
+            np.testing.assert_array_equal(new_states[i], e_state)
+            np.testing.assert_array_equal(observs[i], e_obs)
+            assert rewards[i] == e_reward
+            assert ends[i] == e_end
+            assert infos[i]["done"] == e_info["done"]
+        states = [
+            state if info["done"] else new_state
+            for new_state, info in zip(new_states, infos)
+        ]
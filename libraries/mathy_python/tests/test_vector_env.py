@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from mathy.env import MathyEnv
+from mathy.envs.gym import MathyVectorEnv
+from mathy.envs.poly_simplify import PolySimplify
+from mathy.state import observations_to_window
+
+
+def random_valid_actions(masks: np.ndarray) -> np.ndarray:
+    actions = []
+    for mask in masks:
+        valid = np.nonzero(mask)[0]
+        actions.append(np.random.choice(valid))
+    return np.array(actions)
+
+
+def test_vector_env_reset_batch():
+    env = MathyVectorEnv(env_class=PolySimplify, num_envs=4)
+    window, masks = env.reset_batch()
+    assert len(env.states) == 4
+    assert window.nodes.shape[0] == 4
+    assert window.nodes.shape == window.values.shape
+    assert window.type.shape == window.nodes.shape + (2,)
+    assert window.time.shape == window.nodes.shape + (1,)
+    assert masks.shape[0] == 4
+    assert masks.shape[1] == window.nodes.shape[1] * env.action_size
+
+
+def test_vector_env_matches_observations_to_window():
+    """The stacked arrays hold the same values as a padded list window"""
+    env = MathyVectorEnv(env_class=PolySimplify, num_envs=3)
+    window, _ = env.reset_batch()
+    observations = [env.mathy.state_to_observation(s) for s in env.states]
+    expected = observations_to_window(observations)
+    np.testing.assert_array_equal(window.nodes, np.array(expected.nodes))
+    np.testing.assert_array_equal(window.mask, np.array(expected.mask))
+    np.testing.assert_array_almost_equal(window.values, np.array(expected.values))
+    np.testing.assert_array_almost_equal(window.type, np.array(expected.type))
+    np.testing.assert_array_almost_equal(window.time, np.array(expected.time))
+
+
+def test_vector_env_step_batch():
+    env = MathyVectorEnv(env_class=PolySimplify, num_envs=4)
+    _, masks = env.reset_batch()
+    for i in range(10):
+        window, rewards, dones, masks, infos = env.step_batch(
+            random_valid_actions(masks)
+        )
+        assert rewards.shape == (4,) and rewards.dtype == np.float32
+        assert dones.shape == (4,) and dones.dtype == np.bool_
+        assert len(infos) == 4
+        for done, info in zip(dones, infos):
+            assert info["valid"] is True
+            if done:
+                assert "terminal_state" in info
+        # Auto reset keeps every slot live
+        assert np.all(masks.sum(axis=1) > 0)
+
+
+def test_vector_env_requires_problem_generation():
+    with pytest.raises(ValueError):
+        MathyVectorEnv()
+    with pytest.raises(ValueError):
+        MathyVectorEnv(env_class=MathyEnv)
+    # An existing env can be shared
+    mathy = PolySimplify()
+    env = MathyVectorEnv(mathy=mathy, num_envs=2)
+    assert env.mathy is mathy
+    window, _ = env.reset_batch()
+    assert window.nodes.shape[0] == 2
+
+
+def test_vector_env_step_states():
+    env = MathyVectorEnv(env_class=PolySimplify, num_envs=2)
+    _, masks = env.reset_batch()
+    batch_states = list(env.states)
+    states = batch_states + batch_states[:1]
+    masks = np.concatenate([masks, masks[:1]])
+    next_states, window, rewards, dones, masks, infos = env.step_states(
+        states, random_valid_actions(masks)
+    )
+    assert len(next_states) == 3 and window.nodes.shape[0] == 3
+    assert rewards.shape == (3,) and dones.shape == (3,) and len(infos) == 3
+    # The batch's own episodes aren't stepped
+    assert env.states == batch_states
+    for state, next_state in zip(states, next_states):
+        assert next_state.agent.moves_remaining == state.agent.moves_remaining - 1